@@ -1,18 +1,31 @@
-from flask import render_template, redirect, url_for, flash, request, current_app
-from flask_login import login_required
+from flask import render_template, redirect, url_for, flash, request, current_app, abort, Response, stream_with_context
+from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
+import hmac
 import os
 
 from . import admin_bp
 from .decorators import admin_required
 # modelsとformsはアプリケーションルートからインポート
-from models import db, Question, UserAnswer, UserCheck, ExamResult, User
+from models import db, Question, ExamResult, User
 from forms import QuestionForm, QuestionImportForm # QuestionImportFormを追加
-import csv
-import io
-from sqlalchemy import text
+from question_cache import invalidate_question_cache
+from question_import import delete_all_questions, import_questions_file
+from user_checks import invalidate_user_checks
+from data_export import EXPORT_DATASETS, EXPORT_FORMATS, iter_export
+from exam_results import get_result_details, question_difficulty
+from keyset_pagination import cached_count, paginate_keyset
+from question_search import highlight_hits, index_questions, is_index_empty, paginate_search
+from question_analytics import (SORT_ORDERS, DEFAULT_SORT, forget_questions, get_last_refreshed_at,
+                                paginate_question_analytics, refresh_question_analytics)
+import user_stats
+import perf_metrics
 
 UPLOAD_FOLDER_NAME = 'question_images'
+# インポート時に画面に表示する行エラーの最大件数
+MAX_IMPORT_ERRORS_SHOWN = 10
+# 1リクエストあたりのSQL発行数がこれを超えたエンドポイントを計測画面で強調する (N+1 の疑い)
+METRICS_QUERY_WARNING_THRESHOLD = 20
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -42,9 +55,23 @@ def index():
 def list_questions():
     page = request.args.get('page', 1, type=int)
     per_page = 10
-    questions_pagination = Question.query.order_by(Question.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    questions = questions_pagination.items
-    return render_template('admin_questions.html', title='問題管理', questions=questions, pagination=questions_pagination)
+    query = request.args.get('q', '').strip()
+    search_hits = None
+    questions_page = None
+    # 検索語があれば全文検索の結果を関連度の高い順に、なければ全問題をIDの降順に表示する
+    questions_pagination = paginate_search(query, page=page, per_page=per_page) if query else None
+    if questions_pagination is not None:
+        search_hits = highlight_hits(questions_pagination.items, query)
+        questions = questions_pagination.items
+    else:
+        query = ''  # 記号だけなど、検索できる語がない場合は一覧を表示する
+        # 一覧は OFFSET を使わないキーセット方式で、件数はキャッシュした概数を表示する
+        questions_page = paginate_keyset(Question.query, [Question.id], request.args.get('cursor'), per_page,
+                                         total=cached_count('admin_questions', Question.query))
+        questions = questions_page.items
+    return render_template('admin_questions.html', title='問題管理', questions=questions, pagination=questions_pagination,
+                           questions_page=questions_page, query=query, search_hits=search_hits,
+                           search_index_empty=bool(query) and is_index_empty())
 
 @admin_bp.route('/question/add', methods=['GET', 'POST'])
 @login_required
@@ -84,7 +111,10 @@ def add_question():
                 image_filename=image_filename_to_save
             )
             db.session.add(new_question)
+            db.session.flush()
+            index_questions([new_question.id])
             db.session.commit()
+            invalidate_question_cache([new_question.id])
             flash('新しい問題が追加されました！', 'success')
             return redirect(url_for('admin.list_questions'))
         except ValueError as e:
@@ -144,7 +174,9 @@ def edit_question(question_id):
                 elif file.filename != '':
                      flash('許可されていないファイル形式です。画像は更新されませんでした。', 'warning')
 
+            index_questions([question_id])
             db.session.commit()
+            invalidate_question_cache([question_id])
             flash('問題が更新されました！', 'success')
             return redirect(url_for('admin.list_questions'))
         except ValueError as e:
@@ -180,8 +212,13 @@ def delete_question(question_id):
 
 
     try:
+        # 削除される解答履歴の分をマイページの集計から差し引く
+        user_stats.forget_question(question_id)
+        forget_questions([question_id])
         db.session.delete(question)
         db.session.commit()
+        invalidate_question_cache([question_id])
+        invalidate_user_checks()
         flash(f'問題 ID: {question.id} が削除されました。', 'success')
     except Exception as e:
         db.session.rollback()
@@ -202,60 +239,16 @@ def import_questions():
             delete_all = request.form.get('delete_all')
 
             if delete_all:
-                UserAnswer.query.delete()
-                UserCheck.query.delete()
-                Question.query.delete()
-                # 'question'テーブルのIDシーケンスをリセットするSQLを実行
-                # このSQLはPostgreSQLに特有のものです
-                try:
-                    db.session.execute(text('TRUNCATE TABLE question RESTART IDENTITY CASCADE;'))
-                    db.session.commit()
-                except Exception:
-                    # SQLiteなど、TRUNCATEをサポートしないDBの場合は通常のDELETEに戻す
-                    db.session.rollback()
-                    Question.query.delete()
-                    db.session.commit()
+                delete_all_questions()
                 flash("既存の全問題データを削除しました。", "warning")
 
-            # --- ▼▼▼【ここが修正のポイントです】▼▼▼ ---
-            csv_file = form.csv_file.data
-            # 1. アップロードされたバイナリデータを、UTF-8形式のテキストに変換します
-            stream = io.TextIOWrapper(csv_file.stream, 'utf-8-sig')
-            # 2. 変換後のテキストストリームをCSVリーダーに渡します
-            reader = csv.DictReader(stream)
-            # --- ▲▲▲【ここまでが修正のポイントです】▲▲▲ ---
-
-            questions_to_add = []
-            questions_to_update_count = 0
-            
-            for row in reader:
-                options_list = [opt.strip() for opt in row['options'].split('|') if opt.strip()]
-                correct_answers_list = [ans.strip() for ans in row['correct_answers'].split('|') if ans.strip()]
-                question_id = row.get('id')
-
-                if question_id and Question.query.get(question_id):
-                    q = Question.query.get(question_id)
-                    q.question_text = row['question_text']
-                    q.options = options_list
-                    q.correct_answer = correct_answers_list
-                    q.explanation = row['explanation']
-                    q.image_filename = row['image_filename'] or None
-                    questions_to_update_count += 1
-                else:
-                    new_question = Question(
-                        question_text=row['question_text'],
-                        options=options_list,
-                        correct_answer=correct_answers_list,
-                        explanation=row['explanation'],
-                        image_filename=row['image_filename'] or None
-                    )
-                    questions_to_add.append(new_question)
-
-            if questions_to_add:
-                db.session.add_all(questions_to_add)
-            
-            db.session.commit()
-            flash(f"{len(questions_to_add)}件の問題を新規追加し、{questions_to_update_count}件の問題を更新しました。", "success")
+            # CSVをチャンク単位で読み込み、チャンクごとにまとめて書き込む
+            report = import_questions_file(form.csv_file.data)
+            flash(f"{report.inserted}件の問題を新規追加し、{report.updated}件の問題を更新しました。", "success")
+            if report.errors:
+                flash(f"{len(report.errors)}行はエラーのためスキップしました。", "warning")
+                for line_num, message in report.errors[:MAX_IMPORT_ERRORS_SHOWN]:
+                    flash(f"{line_num}行目: {message}", "warning")
         
         except Exception as e:
             db.session.rollback()
@@ -271,16 +264,115 @@ def import_questions():
 @login_required
 @admin_required
 def list_exam_results():
-    page = request.args.get('page', 1, type=int)
     per_page = 20
-    # User情報も一緒に取得するためにjoinする
-    results_pagination = ExamResult.query.join(User).order_by(ExamResult.submitted_at.desc()).paginate(page=page, per_page=per_page, error_out=False)
-    return render_template('admin_exam_results.html', title='本番試験結果一覧', results_pagination=results_pagination)
+    # User情報も同じクエリで取得する (行ごとにユーザーを読み込まない)
+    # (submitted_at, id) の降順にキーセット方式で読む (ix_exam_result_submitted_at を使う)
+    results_page = paginate_keyset(ExamResult.query.join(User).options(db.contains_eager(ExamResult.user)),
+                                   [ExamResult.submitted_at, ExamResult.id], request.args.get('cursor'), per_page,
+                                   total=cached_count('admin_exam_results', ExamResult.query))
+    return render_template('admin_exam_results.html', title='本番試験結果一覧', results_page=results_page,
+                           difficult_questions=question_difficulty())
 
 # 個別の試験結果詳細を表示するルート
 @admin_bp.route('/exam_result/<int:result_id>')
 @login_required
 @admin_required
 def view_exam_result(result_id):
-    result = ExamResult.query.get_or_404(result_id)
-    return render_template('admin_exam_result_detail.html', title=f"試験結果詳細 (User: {result.user.username})", result=result)
\ No newline at end of file
+    result = ExamResult.query.options(db.joinedload(ExamResult.user)).filter_by(id=result_id).first_or_404()
+    return render_template('admin_exam_result_detail.html', title=f"試験結果詳細 (User: {result.user.username})", result=result,
+                           details=get_result_details(result.id))
+
+# 問題ごとの正答率・選択肢の分布・識別力
+@admin_bp.route('/analytics')
+@login_required
+@admin_required
+def question_analytics():
+    page = request.args.get('page', 1, type=int)
+    sort = request.args.get('sort', DEFAULT_SORT)
+    if sort not in SORT_ORDERS:
+        sort = DEFAULT_SORT
+    analytics_pagination = paginate_question_analytics(page, sort=sort)
+    return render_template('admin_question_analytics.html', title='問題分析',
+                           analytics_pagination=analytics_pagination, sort=sort, sort_orders=SORT_ORDERS,
+                           refreshed_at=get_last_refreshed_at())
+
+# 前回の集計より後に追加された解答だけを集計に加える
+@admin_bp.route('/analytics/refresh', methods=['POST'])
+@login_required
+@admin_required
+def refresh_analytics():
+    try:
+        report = refresh_question_analytics()
+        db.session.commit()
+        flash(f'{report.answers}件の解答と{report.exam_answers}件の本番試験の解答を集計しました ({report.questions}問)。', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'集計中にエラーが発生しました: {e}', 'danger')
+        current_app.logger.error(f"Error refreshing question analytics: {e}", exc_info=True)
+    return redirect(url_for('admin.question_analytics'))
+
+# データのエクスポート画面
+@admin_bp.route('/export')
+@login_required
+@admin_required
+def export_data():
+    return render_template('admin_export.html', title='データのエクスポート',
+                           datasets=EXPORT_DATASETS, formats=EXPORT_FORMATS)
+
+# 問題・解答履歴・試験結果をCSV/JSONLでストリーミング出力するルート
+@admin_bp.route('/export/<string:dataset>.<string:fmt>')
+@login_required
+@admin_required
+def export_download(dataset, fmt):
+    if dataset not in EXPORT_DATASETS or fmt not in EXPORT_FORMATS:
+        abort(404)
+    # 全件をメモリに載せず、チャンクごとに生成しながら送信する
+    response = Response(stream_with_context(iter_export(dataset, fmt)), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={dataset}.{fmt}'
+    return response
+
+
+# ルートごとの処理時間・SQL発行数などの計測結果 (このワーカープロセスの起動後の集計)
+@admin_bp.route('/metrics')
+@login_required
+@admin_required
+def metrics():
+    summaries = perf_metrics.get_endpoint_summaries()
+    return render_template('admin_metrics.html', title='パフォーマンス計測',
+                           summaries=summaries,
+                           enabled=current_app.config.get('PERF_METRICS_ENABLED', False),
+                           query_warning_threshold=METRICS_QUERY_WARNING_THRESHOLD,
+                           mail_stats=current_app.extensions['mail_queue'].get_stats(),
+                           answer_stats=current_app.extensions['answer_buffer'].get_stats())
+
+@admin_bp.route('/metrics/reset', methods=['POST'])
+@login_required
+@admin_required
+def reset_metrics():
+    perf_metrics.reset_metrics()
+    flash('計測結果をリセットしました。', 'success')
+    return redirect(url_for('admin.metrics'))
+
+# Prometheus 用。METRICS_TOKEN を設定した場合は Authorization: Bearer <トークン> でも取得できる
+@admin_bp.route('/metrics/prometheus')
+def metrics_prometheus():
+    token = current_app.config.get('METRICS_TOKEN')
+    # トークンの一致を調べる時間から中身を推測されないよう、定数時間で比較する
+    authorized_by_token = bool(token) and hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode())
+    if not authorized_by_token:
+        if not current_user.is_authenticated:
+            return current_app.login_manager.unauthorized()
+        if not current_user.is_admin:
+            abort(403)
+
+    mail_stats = current_app.extensions['mail_queue'].get_stats()
+    extra_gauges = [
+        ('quiz_mail_queue_messages', 'Number of messages in the mail outbox.',
+         [({'status': status}, mail_stats[status]) for status in ('pending', 'sending', 'failed')]),
+        ('quiz_mail_queue_oldest_pending_seconds', 'Age of the oldest unsent message.',
+         [({}, mail_stats['oldest_pending_seconds'])]),
+    ]
+    return Response(perf_metrics.render_prometheus(extra_gauges),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
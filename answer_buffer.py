@@ -0,0 +1,263 @@
+import atexit
+import datetime
+import os
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy.exc import IntegrityError
+
+import leaderboard
+import spaced_repetition
+import user_stats
+from models import db, Question, User, UserAnswer
+
+# 解答履歴の書き込み
+# ANSWER_WRITE_MODE が 'sync' (既定) の場合は、解答の保存と集計の更新をリクエストのトランザクションで行う。
+# 'batched' の場合は、解答をプロセス内のバッファに追加するだけで返し、書き込み用のスレッドが
+# ANSWER_FLUSH_INTERVAL_MS ミリ秒ごと (または ANSWER_FLUSH_MAX_ROWS 件たまったら) に、まとめて
+# INSERT し、ユーザー・日付ごとにまとめた集計の upsert と合わせて1回でコミットする (グループコミット)。
+# 正誤の判定と画面の表示はリクエストの中で行うので、バッファは表示に影響しない。
+# 'batched' ではマイページなどへの反映が最大 ANSWER_FLUSH_INTERVAL_MS 遅れ、プロセスが強制終了
+# (SIGKILL など) された場合はバッファ内の解答が失われる。通常の終了時 (gunicorn の worker_exit と
+# atexit) には残りを書き込む。
+# 学習進捗のリセットは他のワーカーのバッファを空にできないので、user.progress_reset_at を記録する。
+# 書き込み時にそのユーザーの行を (PostgreSQL では FOR UPDATE で) 読み、リセットより前の解答・削除は捨てる。
+
+DEFAULT_MODE = 'sync'
+WRITE_MODES = ('sync', 'batched')
+DEFAULT_FLUSH_INTERVAL_MS = 200
+DEFAULT_FLUSH_MAX_ROWS = 500
+# バッファの上限。これを超えたら、追加したリクエストのスレッドで書き込む (メモリを使い続けない)
+DEFAULT_BUFFER_MAX_ROWS = 10000
+
+# 解答1件
+PendingAnswer = namedtuple('PendingAnswer',
+                           ['user_id', 'question_id', 'selected_options', 'is_correct', 'answered_at'])
+# 間違えた問題の復習で正解したときの、その問題の不正解の履歴の削除
+ForgetIncorrect = namedtuple('ForgetIncorrect', ['user_id', 'question_id', 'requested_at'])
+
+
+def _insert_answers(answers):
+    if not answers:
+        return
+    db.session.execute(UserAnswer.__table__.insert(), [
+        {'user_id': answer.user_id, 'question_id': answer.question_id,
+         'user_selected_option': list(answer.selected_options), 'is_correct': answer.is_correct,
+         'timestamp': answer.answered_at}
+        for answer in answers
+    ])
+    user_stats.record_answers((answer.user_id, answer.question_id, answer.is_correct, answer.answered_at)
+                              for answer in answers)
+    leaderboard.record_answers((answer.user_id, answer.answered_at) for answer in answers)
+    spaced_repetition.record_answers((answer.user_id, answer.question_id, answer.is_correct, answer.answered_at)
+                                     for answer in answers)
+
+
+def write_entries(entries):
+    """解答と削除を順番どおりに書き込みます。連続する解答はまとめて INSERT します。コミットはしません。"""
+    answers = []
+    for entry in entries:
+        if isinstance(entry, PendingAnswer):
+            answers.append(entry)
+            continue
+        # 削除より前の解答を先に書き込む (削除の対象に含めるため)
+        _insert_answers(answers)
+        answers = []
+        removed_count = UserAnswer.query.filter_by(
+            user_id=entry.user_id, question_id=entry.question_id, is_correct=False,
+        ).delete(synchronize_session=False)
+        user_stats.forget_answers(entry.user_id, entry.question_id, removed_count)
+    _insert_answers(answers)
+
+
+def _entry_time(entry):
+    return entry.answered_at if isinstance(entry, PendingAnswer) else entry.requested_at
+
+
+def _drop_reset(entries):
+    """バッファに入れた後で学習進捗をリセットしたユーザーの解答・削除を除きます。
+
+    ユーザーの行をロックして読むので、リセット (user の行を更新してから削除する) とは順番に実行される。
+    """
+    user_ids = {entry.user_id for entry in entries}
+    reset_at = dict(db.session.query(User.id, User.progress_reset_at)
+                              .filter(User.id.in_(user_ids), User.progress_reset_at.isnot(None))
+                              .with_for_update())
+    if not reset_at:
+        return entries
+    return [entry for entry in entries
+            if entry.user_id not in reset_at or _entry_time(entry) > reset_at[entry.user_id]]
+
+
+def _drop_orphans(entries):
+    """書き込むまでの間に削除された問題・ユーザーの解答を除きます。"""
+    question_ids = {entry.question_id for entry in entries}
+    user_ids = {entry.user_id for entry in entries}
+    existing_questions = {question_id for (question_id,) in
+                          db.session.query(Question.id).filter(Question.id.in_(question_ids))}
+    existing_users = {user_id for (user_id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+    return [entry for entry in entries
+            if entry.question_id in existing_questions and entry.user_id in existing_users]
+
+
+class AnswerBuffer:
+    """解答履歴の書き込みと、'batched' モードでのグループコミット用のバッファ・スレッド。"""
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._entries = []
+        self._thread = None
+        self._pid = None
+        self._atexit_registered = False
+        self.flushed_total = 0
+        self.flush_count = 0
+        self.dropped_total = 0
+        self.last_flush_ms = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get('ANSWER_WRITE_MODE', DEFAULT_MODE) not in WRITE_MODES:
+            raise ValueError(f"ANSWER_WRITE_MODE must be one of {WRITE_MODES}: {app.config['ANSWER_WRITE_MODE']}")
+        self.app = app
+        app.extensions['answer_buffer'] = self
+
+    @property
+    def mode(self):
+        return self.app.config.get('ANSWER_WRITE_MODE', DEFAULT_MODE)
+
+    @property
+    def flush_interval(self):
+        return self.app.config.get('ANSWER_FLUSH_INTERVAL_MS', DEFAULT_FLUSH_INTERVAL_MS) / 1000
+
+    @property
+    def flush_max_rows(self):
+        return self.app.config.get('ANSWER_FLUSH_MAX_ROWS', DEFAULT_FLUSH_MAX_ROWS)
+
+    @property
+    def buffer_max_rows(self):
+        return self.app.config.get('ANSWER_BUFFER_MAX_ROWS', DEFAULT_BUFFER_MAX_ROWS)
+
+    def record_answer(self, user_id, question_id, selected_options, is_correct, answered_at):
+        """解答を保存します ('sync' ではリクエストのトランザクションに追加し、コミットは呼び出し側で行う)。"""
+        self._submit(PendingAnswer(user_id, question_id, tuple(selected_options), bool(is_correct), answered_at))
+
+    def forget_incorrect(self, user_id, question_id):
+        """問題の不正解の履歴を削除し、集計から差し引きます (それまでに記録した解答も対象)。"""
+        self._submit(ForgetIncorrect(user_id, question_id, datetime.datetime.utcnow()))
+
+    def _submit(self, entry):
+        if self.mode != 'batched':
+            write_entries([entry])
+            return
+        with self._lock:
+            self._entries.append(entry)
+            pending = len(self._entries)
+        if pending >= self.buffer_max_rows:
+            # 書き込みが追いついていない場合は、このリクエストで書き込んで待たせる
+            self.flush()
+            return
+        self.start()
+        if pending >= self.flush_max_rows:
+            self._wakeup.set()
+
+    def start(self):
+        """書き込み用のスレッドを起動します。fork 後の子プロセスでは新しく起動し直します。"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='answer-writer', daemon=True)
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.close)
+                self._atexit_registered = True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # DBに接続できないなどの場合も、スレッドは止めずに次の書き込みで再試行する
+                self.app.logger.exception('Answer writer failed')
+
+    def flush(self):
+        """バッファ内の解答をすべて書き込んでコミットし、書き込んだ件数を返します。"""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._entries = self._entries, []
+            if not entries:
+                return 0
+            started = time.perf_counter()
+            try:
+                self._write(entries)
+            except Exception:
+                # 書き込めなかった分はバッファの先頭に戻し、順番を保ったまま次回に再試行する
+                with self._lock:
+                    self._entries[:0] = entries
+                raise
+            with self._lock:
+                self.flushed_total += len(entries)
+                self.flush_count += 1
+                self.last_flush_ms = (time.perf_counter() - started) * 1000
+            return len(entries)
+
+    def _write(self, entries):
+        # リクエストのセッションとは別の、新しいアプリケーションコンテキストのセッションで書き込む
+        with self.app.app_context():
+            try:
+                kept = _drop_reset(entries)
+                if len(kept) < len(entries):
+                    with self._lock:
+                        self.dropped_total += len(entries) - len(kept)
+                    self.app.logger.info('Dropped %d buffered answers made before a progress reset',
+                                         len(entries) - len(kept))
+                entries = kept
+                write_entries(entries)
+                db.session.commit()
+            except IntegrityError:
+                # 書き込みまでの間に問題やユーザーが削除された解答があれば、それを除いて書き込み直す
+                db.session.rollback()
+                kept = _drop_orphans(_drop_reset(entries))
+                write_entries(kept)
+                db.session.commit()
+                dropped = len(entries) - len(kept)
+                with self._lock:
+                    self.dropped_total += dropped
+                self.app.logger.warning('Dropped %d buffered answers for deleted questions or users', dropped)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def close(self):
+        """書き込み用のスレッドを止め、残りの解答を書き込みます (ワーカーの終了時に呼ぶ)。"""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(timeout=5)
+        try:
+            return self.flush()
+        except Exception:
+            self.app.logger.exception('Failed to flush buffered answers on shutdown')
+            return 0
+
+    def get_stats(self):
+        """バッファの状態を辞書で返します (このプロセスでの値)。"""
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'pending': len(self._entries),
+                'writer_alive': self._thread is not None and self._thread.is_alive(),
+                'flushed_total': self.flushed_total,
+                'flush_count': self.flush_count,
+                'dropped_total': self.dropped_total,
+                'last_flush_ms': self.last_flush_ms,
+            }
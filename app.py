@@ -4,25 +4,43 @@ from urllib.parse import urlparse
 from flask_migrate import Migrate
 from flask_bootstrap import Bootstrap5
 from flask_wtf.csrf import CSRFProtect
-from sqlalchemy import func
 from whitenoise import WhiteNoise
+import click
 import json
 import os
-import random
+import time
 import datetime
-from datetime import timedelta
 import pytz
 
-from models import db, User, Question, UserAnswer, UserCheck, ExamResult
+from models import db, User, Question, UserAnswer, UserCheck, UserQuestionStats
+from question_cache import get_question_range_grid, get_question_or_404
+from incorrect_answers import paginate_latest_incorrect
+from keyset_pagination import paginate_keyset
+import user_stats
+import leaderboard
+import question_analytics
+import spaced_repetition
+import question_search
+import quiz_run
+import exam_attempts
+import exam_assembly
+from exam_results import save_exam_result
+import user_checks
+from mail_queue import MailQueue
+from answer_buffer import AnswerBuffer
+from db_utils import relax_commit_durability
+from question_import import DEFAULT_IMPORT_CHUNK_SIZE, delete_all_questions, import_questions_csv
+from data_export import DEFAULT_EXPORT_CHUNK_SIZE, EXPORT_DATASETS, EXPORT_FORMATS, iter_export
 from admin import admin_bp
 from admin.routes import setup_admin_upload_folder
 from forms import RegistrationForm, LoginForm, QuestionForm, EditProfileForm
-from flask_mail import Mail, Message
+from flask_mail import Mail
 from itsdangerous import URLSafeTimedSerializer
-from threading import Thread
 from dotenv import load_dotenv
 from forms import RegistrationForm, LoginForm, QuestionForm, EditProfileForm, PasswordResetRequestForm, PasswordResetForm, PasswordConfirmForm
-from flask_session import Session
+from session_store import init_session_store
+from perf_metrics import PerformanceMiddleware, init_perf_metrics
+from query_budget import init_query_debug, query_budget
 
 load_dotenv()
 
@@ -31,10 +49,33 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'json_serializer': lambda obj: json.dumps(obj, ensure_ascii=False)
 }
 # ▼▼▼サーバーサイドセッションの設定 ▼▼▼
-app.config['SESSION_TYPE'] = 'filesystem'  # セッションをファイルシステムに保存
+# 保存先: filesystem / database / redis / local (詳細は session_store.py)
+app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'filesystem')
+app.config['SESSION_REDIS_URL'] = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+# database の場合、期限切れのセッションを平均してこの回数のリクエストに1回削除する (0 なら `flask session_cleanup` で削除)
+app.config['SESSION_CLEANUP_N_REQUESTS'] = int(os.environ.get('SESSION_CLEANUP_N_REQUESTS', 1000)) or None
+# このバイト数以上のセッションは圧縮して保存する (database / redis / local)
+app.config['SESSION_COMPRESS_MIN_SIZE'] = int(os.environ.get('SESSION_COMPRESS_MIN_SIZE', 1024))
+app.config['SESSION_REFRESH_EACH_REQUEST'] = False  # 変更のないリクエストではセッションを書き込まない
 app.config['SESSION_PERMANENT'] = False   # ブラウザを閉じたらセッションを無効に
 app.config['SESSION_USE_SIGNER'] = True   # セッションIDを安全に署名
 app.config['PROCTORED_EXAM_PASSWORD'] = os.environ.get('PROCTORED_EXAM_PASSWORD')
+# 問題範囲選択画面で1つの範囲にまとめる問題数と、問題キャッシュの有効期限(秒)
+app.config['QUIZ_RANGE_SIZE'] = int(os.environ.get('QUIZ_RANGE_SIZE', 5))
+# 問題キャッシュを作り直す間隔 (秒)。管理画面での変更は共有の版番号ですぐに全ワーカーへ反映されるので、
+# これはDBを直接書き換えた場合の上限
+app.config['QUIZ_CACHE_TTL'] = int(os.environ.get('QUIZ_CACHE_TTL', 300))
+# 試験モードの出題数
+app.config['EXAM_QUESTION_COUNT'] = int(os.environ.get('EXAM_QUESTION_COUNT', 20))
+app.config['EXAM_TIME_LIMIT_MINUTES'] = int(os.environ.get('EXAM_TIME_LIMIT_MINUTES', 20))
+# 試験の出題条件 (JSON)。ID範囲・難易度ごとの出題数を指定できる (書式は exam_assembly.py を参照)
+app.config['EXAM_BLUEPRINT'] = os.environ.get('EXAM_BLUEPRINT')
+# ランキング集計結果のキャッシュ有効期限(秒)
+app.config['RANKING_CACHE_TTL'] = int(os.environ.get('RANKING_CACHE_TTL', 30))
+# ユーザーごとのチェック状態のキャッシュの有効期間 (秒)。別の端末でのチェックはこの秒数で反映される
+app.config['CHECK_CACHE_TTL'] = int(os.environ.get('CHECK_CACHE_TTL', 60))
+# 管理画面の一覧に表示する件数 (概数) のキャッシュの有効期間 (秒)。0 なら毎回数える
+app.config['KEYSET_COUNT_CACHE_TTL'] = int(os.environ.get('KEYSET_COUNT_CACHE_TTL', 60))
 
 # --- Mail Configuration ---
 # ★★★★★重要★★★★★
@@ -46,7 +87,29 @@ app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() in [
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME') # 例: 'your-email@gmail.com'
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD') # 例: Googleのアプリパスワードなど
 app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'])
-
+# メール送信キュー: ワーカースレッド数、1本のSMTP接続で送る最大通数、再試行の回数と最初の間隔(秒)
+app.config['MAIL_WORKERS'] = int(os.environ.get('MAIL_WORKERS', 2))
+app.config['MAIL_BATCH_SIZE'] = int(os.environ.get('MAIL_BATCH_SIZE', 20))
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 5))
+app.config['MAIL_RETRY_DELAY'] = int(os.environ.get('MAIL_RETRY_DELAY', 30))
+# 解答履歴の書き込み: 'sync' はリクエストごとにコミット、'batched' はまとめて書き込む (answer_buffer.py)
+app.config['ANSWER_WRITE_MODE'] = os.environ.get('ANSWER_WRITE_MODE', 'sync').lower()
+app.config['ANSWER_FLUSH_INTERVAL_MS'] = int(os.environ.get('ANSWER_FLUSH_INTERVAL_MS', 200))
+app.config['ANSWER_FLUSH_MAX_ROWS'] = int(os.environ.get('ANSWER_FLUSH_MAX_ROWS', 500))
+app.config['ANSWER_BUFFER_MAX_ROWS'] = int(os.environ.get('ANSWER_BUFFER_MAX_ROWS', 10000))
+
+# ルートごとの処理時間・SQL・テンプレート・セッションの計測 (/admin/metrics で確認できる)
+# WhiteNoise の内側に置き、静的ファイルの配信は計測しない
+app.config['PERF_METRICS_ENABLED'] = os.environ.get('PERF_METRICS_ENABLED', 'true').lower() in ['true', 'on', '1']
+# Prometheus から /admin/metrics/prometheus を取得するときの Bearer トークン (未設定なら管理者のログインが必要)
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# 開発用: リクエストごとのSQL数を数え、@query_budget の上限超えや同じ文の繰り返し (N+1) を警告する
+# QUERY_BUDGET_STRICT を有効にすると警告の代わりにエラーにする (benchmarks/check_query_budgets.py で使用)
+app.config['QUERY_DEBUG'] = os.environ.get('QUERY_DEBUG', 'false').lower() in ['true', 'on', '1']
+app.config['QUERY_BUDGET_STRICT'] = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() in ['true', 'on', '1']
+app.config['QUERY_REPEAT_THRESHOLD'] = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 5))
+if app.config['PERF_METRICS_ENABLED']:
+    app.wsgi_app = PerformanceMiddleware(app.wsgi_app)
 app.wsgi_app = WhiteNoise(app.wsgi_app, root='static/')
 # --- Configuration ---
 instance_folder_path = os.path.join(
@@ -78,7 +141,8 @@ app.config['BOOTSTRAP_SERVE_LOCAL'] = True
 # --- Extensions Initialization ---
 csrf = CSRFProtect(app)
 db.init_app(app)
-migrate = Migrate(app, db)
+# FTS5 の仮想テーブルなど、モデルにない検索用のテーブル・インデックスはマイグレーションの自動生成で無視する
+migrate = Migrate(app, db, include_name=question_search.include_name)
 bootstrap = Bootstrap5(app)
 
 login_manager = LoginManager()
@@ -87,10 +151,16 @@ login_manager.login_view = 'login'
 login_manager.login_message = "このページにアクセスするにはログインが必要です。"
 login_manager.login_message_category = "info"
 
-sess = Session()
-sess.init_app(app)
+init_session_store(app)
+if app.config['PERF_METRICS_ENABLED']:
+    init_perf_metrics(app)
+init_query_debug(app)
 
 mail = Mail(app)
+mail_queue = MailQueue(app, mail)
+answer_buffer = AnswerBuffer(app)
+# 出題条件の書き間違いは、最初の試験の開始時ではなく起動時に検出する
+exam_assembly.parse_blueprint(app.config['EXAM_BLUEPRINT'], app.config['EXAM_QUESTION_COUNT'])
 # --- Blueprint Registration ---
 app.register_blueprint(admin_bp)
 
@@ -122,26 +192,6 @@ def inject_current_year():
     return {'current_year': datetime.date.today().year}
 
 # --- Helper Functions ---
-def get_dynamic_ranges(range_size=5):
-    with app.app_context():
-        max_id = db.session.query(func.max(Question.id)).scalar() or 0
-        if max_id == 0:
-            return {}
-        ranges = {}
-        start_id_loop = 1
-        while start_id_loop <= max_id:
-            end_id = min(start_id_loop + range_size - 1, max_id)
-            count = Question.query.filter(Question.id.between(start_id_loop, end_id)).count()
-            if count > 0:
-                range_key = f'range_{start_id_loop}_{end_id}'
-                if start_id_loop == end_id:
-                    range_name = f'No.{start_id_loop}'
-                else:
-                    range_name = f'No.{start_id_loop} ~ No.{end_id}'
-                ranges[range_key] = {'name': range_name}
-            start_id_loop += range_size
-    return ranges
-
 def generate_confirmation_token(email):
     serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
     return serializer.dumps(email, salt=app.config.get('SECURITY_PASSWORD_SALT', 'my-precious-salt'))
@@ -158,27 +208,11 @@ def confirm_token(token, expiration=3600): # 有効期限は1時間
         return False
     return email
 
-#非同期でメールを送信するための関数
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
 def send_email(to, subject, template):
-    msg = Message(
-        subject,
-        recipients=[to],
-        html=template,
-        sender=app.config['MAIL_DEFAULT_SENDER']
-    )
-    # スレッドを使用して非同期にメールを送信し、レスポンスをブロックしないようにする
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
-
-# --- Constants ---
-REVIEW_MODE_KEY = 'review_mode'
-REVIEW_TYPE_KEY = 'review_type'
-EXAM_MODE_KEY = 'is_exam_mode'
+    # メールは送信キュー (mail_outbox) に入れ、ワーカースレッドが SMTP 接続を使い回してまとめて送信する
+    mail_queue.enqueue(to, subject, template)
+    db.session.commit()
+    mail_queue.wake()
 
 # --- Flask-Login User Loader ---
 @login_manager.user_loader
@@ -231,6 +265,100 @@ def create_admin_command():
     db.session.commit()
     print('SUCCESS: Admin user created.')
 
+@app.cli.command("import-questions")
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk-size', default=DEFAULT_IMPORT_CHUNK_SIZE, show_default=True, help='1回のコミットで書き込む行数')
+@click.option('--delete-all', is_flag=True, help='インポート前に既存の全問題と解答履歴を削除する')
+def import_questions_command(csv_path, chunk_size, delete_all):
+    """CSVファイルから問題を一括インポートします (管理画面と同じ形式)。"""
+    if delete_all:
+        delete_all_questions()
+        print('INFO: All existing questions were deleted.')
+    with open(csv_path, encoding='utf-8-sig', newline='') as stream:
+        report = import_questions_csv(stream, chunk_size=chunk_size)
+    for line_num, message in report.errors:
+        print(f'ERROR: line {line_num}: {message}')
+    print(f'SUCCESS: {report.inserted} questions added, {report.updated} updated, {len(report.errors)} rows skipped.')
+
+@app.cli.command("export-data")
+@click.argument('dataset', type=click.Choice(list(EXPORT_DATASETS)))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='出力先ファイル (省略時は標準出力)')
+@click.option('--chunk-size', default=DEFAULT_EXPORT_CHUNK_SIZE, show_default=True, help='1回に読み込む行数')
+def export_data_command(dataset, fmt, output, chunk_size):
+    """問題・解答履歴・本番試験結果をCSV/JSONLで出力します。"""
+    for chunk in iter_export(dataset, fmt, chunk_size=chunk_size):
+        output.write(chunk)
+
+@app.cli.command("rebuild-user-stats")
+def rebuild_user_stats_command():
+    """解答履歴からマイページ用の集計テーブルを作り直します。"""
+    user_stats.rebuild_user_stats()
+    db.session.commit()
+    print('SUCCESS: User stats rebuilt.')
+
+@app.cli.command("rebuild-leaderboard")
+def rebuild_leaderboard_command():
+    """解答履歴からランキング用の日別集計を作り直します。"""
+    leaderboard.rebuild_leaderboard()
+    db.session.commit()
+    print('SUCCESS: Leaderboard rebuilt.')
+
+@app.cli.command("rebuild-review-schedule")
+def rebuild_review_schedule_command():
+    """解答履歴から間隔反復の復習の予定を作り直します (導入時・復旧用)。"""
+    spaced_repetition.rebuild_review_schedule()
+    db.session.commit()
+    print('SUCCESS: Review schedule rebuilt.')
+
+@app.cli.command("rebuild-search-index")
+@click.option('--batch-size', default=question_search.DEFAULT_REBUILD_BATCH_SIZE, show_default=True, help='1回に読み込む問題の件数')
+def rebuild_search_index_command(batch_size):
+    """全問題の全文検索用のトークンを作り直します (導入時・復旧用)。"""
+    started = time.perf_counter()
+    count = question_search.rebuild_search_index(batch_size=batch_size)
+    db.session.commit()
+    print(f'SUCCESS: Search index rebuilt for {count} questions in {time.perf_counter() - started:.1f}s.')
+
+@app.cli.command("refresh-question-analytics")
+@click.option('--full', is_flag=True, help='集計を削除して、全件から作り直す')
+@click.option('--batch-size', default=question_analytics.ANALYTICS_BATCH_SIZE, show_default=True, help='1回に読み込む解答の件数')
+def refresh_question_analytics_command(full, batch_size):
+    """前回の集計より後に追加された解答を、管理画面の問題分析用の集計に加えます。"""
+    started = time.perf_counter()
+    report = question_analytics.refresh_question_analytics(full=full, batch_size=batch_size)
+    db.session.commit()
+    print(f'SUCCESS: {report.answers} answers and {report.exam_answers} exam answers added to '
+          f'{report.questions} questions in {time.perf_counter() - started:.1f}s.')
+
+@app.cli.command("preview-exam")
+@click.option('--seed', type=int, default=None, help='抽選に使うシード値 (省略すると新しく作る)')
+@click.option('--blueprint', default=None, help='出題条件の JSON (省略すると EXAM_BLUEPRINT)')
+def preview_exam_command(seed, blueprint):
+    """出題条件に沿って試験の問題を抽選し、問題IDを表示します (保存済みのシード値で出題を再現する)。"""
+    if blueprint is not None:
+        blueprint = exam_assembly.parse_blueprint(blueprint, app.config['EXAM_QUESTION_COUNT'])
+    plan = exam_assembly.assemble_exam(blueprint, seed=seed)
+    print(f'seed: {plan.seed}')
+    print(f'blueprint: {json.dumps(plan.blueprint)}')
+    print(f'questions ({len(plan.question_ids)}/{plan.requested_count}): '
+          f'{" ".join(map(str, plan.question_ids))}')
+
+@app.cli.command("send-queued-mail")
+@click.option('--retry-failed', is_flag=True, help='再試行の上限に達したメールも送信待ちに戻して送る')
+def send_queued_mail_command(retry_failed):
+    """送信キューのメールをこのプロセスで送信します (ワーカーが動いていない環境や動作確認用)。"""
+    if retry_failed:
+        print(f'Requeued {mail_queue.retry_failed()} failed mails.')
+        db.session.commit()
+    print(f'Processed {mail_queue.drain()} mails.')
+
+@app.cli.command("mail-queue-stats")
+def mail_queue_stats_command():
+    """メール送信キューの件数を表示します。"""
+    for name, value in mail_queue.get_stats().items():
+        print(f'{name}: {value}')
+
 # --- 認証ルート ---
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -322,36 +450,28 @@ def logout():
 
 # --- マイページ用のルート ---
 @app.route('/mypage')
+@query_budget(4)
 @login_required
 def mypage():
-    user_answers = UserAnswer.query.filter_by(user_id=current_user.id).all()
-    
-    total_answered = len(user_answers)
-    correct_answered = 0
+    # 解答履歴を全件読み込まず、解答時に更新している集計テーブルを参照する
+    total_answered, correct_answered = user_stats.get_user_summary(current_user.id)
     average_accuracy = 0.0
 
     if total_answered > 0:
-        correct_answered = sum(1 for answer in user_answers if answer.is_correct)
         average_accuracy = (correct_answered / total_answered) * 100
 
-    subquery = db.session.query(
-        UserAnswer.question_id,
-        func.max(UserAnswer.timestamp).label('max_timestamp')
-    ).filter_by(user_id=current_user.id).group_by(UserAnswer.question_id).subquery()
-
-    page = request.args.get('page', 1, type=int) # URLからページ番号を取得（デフォルトは1）
     per_page = 10 # 1ページあたりの表示件数
     
-    latest_answers_query = db.session.query(UserAnswer).join(
-        subquery,
-        db.and_(
-            UserAnswer.question_id == subquery.c.question_id,
-            UserAnswer.timestamp == subquery.c.max_timestamp,
-            UserAnswer.user_id == current_user.id
-        )
-    ).order_by(UserAnswer.timestamp.desc())
-
-    pagination = latest_answers_query.paginate(page=page, per_page=per_page, error_out=False)
+    # 問題ごとの最新の解答結果 (ユーザー×問題の集計行) を新しい順に表示
+    # OFFSET を使わないキーセット方式で、(last_answered_at, question_id) の降順に1ページ分だけ読む
+    # (解答日時のない行はキーセットで比較できないので除く。解答の記録では必ず日時が入る)
+    latest_answers_query = UserQuestionStats.query\
+        .filter(UserQuestionStats.user_id == current_user.id, UserQuestionStats.last_answered_at.isnot(None))\
+        .options(db.joinedload(UserQuestionStats.question_detail))
+
+    pagination = paginate_keyset(latest_answers_query,
+                                 [UserQuestionStats.last_answered_at, UserQuestionStats.question_id],
+                                 request.args.get('cursor'), per_page)
     answer_history = pagination.items # 現在のページに表示するアイテムリスト
 
     return render_template(
@@ -385,74 +505,45 @@ def edit_profile():
 
 
 @app.route('/ranking')
+@query_budget(4)
 @login_required
 def ranking():
     # URLクエリから集計期間を取得 (例: /ranking?period=daily), デフォルトは'weekly'
-    period = request.args.get('period', 'weekly')
-    
-    # 現在時刻(UTC)を取得
-    now_utc = datetime.datetime.now(pytz.utc)
-    
-    # 期間に応じて開始日時とタイトルを設定
-    if period == 'daily':
-        # JSTでの今日の始まりを計算し、UTCに変換してDB検索に使用
-        jst = pytz.timezone('Asia/Tokyo')
-        now_jst = now_utc.astimezone(jst)
-        start_of_day_jst = now_jst.replace(hour=0, minute=0, second=0, microsecond=0)
-        start_date = start_of_day_jst.astimezone(pytz.utc)
-        title = '日間ランキング (解答数)'
-    elif period == 'monthly':
-        jst = pytz.timezone('Asia/Tokyo')
-        now_jst = now_utc.astimezone(jst)
-        start_of_month_jst = now_jst.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        start_date = start_of_month_jst.astimezone(pytz.utc)
-        title = '月間ランキング (解答数)'
-    else: # デフォルトは週間 (過去7日間)
-        period = 'weekly'
-        start_date = now_utc - timedelta(days=7)
-        title = '週間ランキング (解答数)'
-
-    # ランキングデータを集計するクエリ
-    ranking_data = db.session.query(
-        User.username,
-        func.count(UserAnswer.id).label('answer_count')
-    ).join(
-        UserAnswer, User.id == UserAnswer.user_id
-    ).filter(
-        User.is_admin == False,
-        User.show_in_ranking == True,
-        UserAnswer.timestamp >= start_date
-    ).group_by(
-        User.id
-    ).order_by(
-        func.count(UserAnswer.id).desc()
-    ).limit(100).all()  # .paginate() から .limit(100).all() に戻す
+    period, start_day, title = leaderboard.period_window(request.args.get('period', 'weekly'))
+
+    # 日別の解答数カウンタを合計して集計する (集計結果は短時間キャッシュされる)
+    ranking_data = leaderboard.get_ranking(period, start_day)
 
     return render_template(
         'ranking.html',
         title=title,
         ranking_data=ranking_data,
         current_period=period
-        # pagination=pagination は削除
     )
 
 # --- ★★★ 新規追加: 試験モード情報ページ表示ルート ★★★ ---
 @app.route('/exam')
+@query_budget(2)
 @login_required
 def exam_info():
     """試験モードの概要を表示するページ"""
-    return render_template('exam.html', title='試験モード')
+    return render_template('exam.html', title='試験モード',
+                           exam_question_count=exam_assembly.blueprint_question_count(),
+                           exam_time_limit_minutes=app.config['EXAM_TIME_LIMIT_MINUTES'],
+                           uses_blueprint=bool(app.config['EXAM_BLUEPRINT']))
 
 # --- クイズ関連ルート ---
 @app.route('/')
+@query_budget(4)
 def quiz_range_select():
-    quiz_ranges = get_dynamic_ranges()
+    range_grid_html = get_question_range_grid()
     if not current_user.is_authenticated and 'user_id' not in session:
         session['user_id'] = str(os.urandom(16).hex())
-    return render_template('quiz_range_select.html', quiz_ranges=quiz_ranges)
+    return render_template('quiz_range_select.html', range_grid_html=range_grid_html)
 
 
 @app.route('/start_multi_quiz', methods=['POST'])
+@query_budget(6)
 @login_required # ★★★ 修正箇所 ★★★
 def start_multi_quiz():
     selected_range_keys = request.form.getlist('selected_ranges')
@@ -460,75 +551,53 @@ def start_multi_quiz():
         flash("問題範囲を選択してください。", "warning")
         return redirect(url_for('quiz_range_select'))
 
-    all_question_ids = []
+    id_filters = []
     for range_key in selected_range_keys:
         try:
             parts = range_key.split('_')
             if len(parts) == 3 and parts[0] == 'range':
                 start_id = int(parts[1])
                 end_id = int(parts[2])
-                range_question_ids = [q.id for q in Question.query.filter(Question.id.between(start_id, end_id)).with_entities(Question.id).all()]
-                all_question_ids.extend(range_question_ids)
+                id_filters.append(Question.id.between(start_id, end_id))
         except (ValueError, IndexError):
             continue
 
+    all_question_ids = []
+    if id_filters:
+        all_question_ids = [question_id for (question_id,) in
+                            db.session.query(Question.id).filter(db.or_(*id_filters))]
+
     if not all_question_ids:
         flash("選択された範囲に有効な問題が見つかりませんでした。", "warning")
         return redirect(url_for('quiz_range_select'))
 
-    random.shuffle(all_question_ids)
-
-    # セッション初期化
-    session.pop(EXAM_MODE_KEY, None)
-    session.pop('exam_end_time', None)
-    session.pop(REVIEW_MODE_KEY, None)
-    session.pop(REVIEW_TYPE_KEY, None)
-    session['correct_count'] = 0
-    session['total_questions_answered'] = 0
-    session['answered_question_ids'] = []
-    session['current_range_key'] = 'multi_select'
+    # 出題順と進捗はサーバー側の QuizRun に保存し、セッションにはその id だけを入れる
     session.pop('last_answer_result', None)
     session.pop('last_user_answer', None)
-    session['quiz_order_ids'] = all_question_ids
-    session['current_question_index_in_order'] = 0
-        
-    first_question_id = all_question_ids[0]
-    return redirect(url_for('show_question', question_id=first_question_id))
+    run = quiz_run.start_run(current_user.id, all_question_ids)
+    db.session.commit()
+
+    return redirect(url_for('show_question', question_id=quiz_run.current_question_id(run)))
 
 
 @app.route('/start_exam', methods=['POST'])
+@query_budget(8)
 @login_required
 def start_exam():
-    all_q_ids = [q.id for q in Question.query.with_entities(Question.id).all()]
-    if len(all_q_ids) < 20:
-        flash(f"問題が20問に満たないため、全{len(all_q_ids)}問で試験を開始します。", "warning")
-        exam_questions_ids = all_q_ids
-    else:
-        exam_questions_ids = random.sample(all_q_ids, 20)
-
-    if not exam_questions_ids:
+    # 問題は出題条件 (EXAM_BLUEPRINT) に沿って、キャッシュ済みの問題IDから抽選する
+    plan = exam_assembly.assemble_exam()
+    if not plan.question_ids:
         flash("試験を開始できる問題がありません。", "danger")
         return redirect(url_for('quiz_range_select'))
+    if plan.is_short:
+        flash(f"出題条件に合う問題が{plan.requested_count}問に満たないため、{len(plan.question_ids)}問で試験を開始します。", "warning")
 
-    # --- ▼▼▼【ここからが修正箇所です】▼▼▼ ---
-
-    # 試験の状態を管理する新しいセッション構造を初期化します
-    session['exam_state'] = {
-        'question_ids': exam_questions_ids,
-        'answers': {},  # {question_id: [user_answer1, user_answer2], ...} という形式で解答を保存
-        'start_time': datetime.datetime.now(pytz.utc).isoformat()
-    }
-    
-    # 以前の不要になったセッション変数をクリアします
-    session.pop('quiz_order_ids', None)
-    session.pop('correct_count', None)
-    session.pop('total_questions_answered', None)
-    session.pop('answered_question_ids', None)
-    session.pop('current_range_key', None)
+    # 試験の問題と期限はDBに保存し、セッションには入れない (途中の試験とクイズは削除する)
+    exam_attempts.start_attempt(current_user.id, plan.question_ids, seed=plan.seed, blueprint=plan.blueprint)
+    quiz_run.discard_run(current_user.id)
+    db.session.commit()
     session.pop('last_answer_result', None)
     session.pop('last_user_answer', None)
-    session.pop(EXAM_MODE_KEY, None) # EXAM_MODE_KEY も exam_state に統合するので不要
-    session.pop('exam_end_time', None) # start_time を使うので不要
 
     # 試験の最初の問題（インデックス0）へリダイレクトします
     # リダイレクト先が 'show_question' から新しい 'exam_question' に変わります
@@ -536,121 +605,115 @@ def start_exam():
 
 # 試験問題を表示する新しいルート
 @app.route('/exam/question/<int:q_index>')
+@query_budget(4)
 @login_required
 def exam_question(q_index):
-    # セッションに試験情報がなければ、試験選択画面に戻す
-    if 'exam_state' not in session:
+    attempt = exam_attempts.get_active_attempt(current_user.id)
+    if attempt is None:
         flash("試験セッションが開始されていません。", "warning")
         return redirect(url_for('exam_info'))
+    if exam_attempts.is_expired(attempt):
+        flash("時間切れです！試験を終了します。", "warning")
+        return redirect(url_for('submit_exam'))
 
-    question_ids = session['exam_state']['question_ids']
+    question_ids = attempt.question_ids
     
     # 無効なインデックスなら、最初か最後の問題に補正
     if not 0 <= q_index < len(question_ids):
         return redirect(url_for('exam_question', q_index=0))
     
     question_id = question_ids[q_index]
-    question = Question.query.get_or_404(question_id)
-    
-    options_list = json.loads(question.options) if isinstance(question.options, str) else question.options
-    correct_answers_list = json.loads(question.correct_answer) if isinstance(question.correct_answer, str) else question.correct_answer
-    is_multi_select_question = len(correct_answers_list) > 1
+    question = get_question_or_404(question_id)
 
     # 過去の解答があれば取得
-    previous_answers = session['exam_state']['answers'].get(str(question_id), [])
+    answers = exam_attempts.get_answers(attempt)
+    previous_answers = answers.get(str(question_id), [])
 
     return render_template('exam_question.html',
                            question=question,
-                           options=options_list,
-                           is_multi_select_question=is_multi_select_question,
+                           options=question.options,
+                           is_multi_select_question=question.is_multi_select,
                            q_index=q_index,
                            total_questions=len(question_ids),
                            previous_answers=previous_answers,
                            all_question_ids=question_ids,
-                           answered_map=session['exam_state']['answers'].keys())
+                           answered_map=answers.keys(),
+                           remaining_seconds=exam_attempts.remaining_seconds(attempt))
 
 
-# 試験中の解答をセッションに保存する新しいルート
+# 試験中の解答を保存するルート (その問題の1行だけを追加・更新する)
 @app.route('/exam/answer', methods=['POST'])
+@query_budget(3)
 @login_required
 def exam_answer():
-    if 'exam_state' not in session:
+    attempt = exam_attempts.get_active_attempt(current_user.id)
+    if attempt is None:
         return redirect(url_for('exam_info'))
-        
+    if exam_attempts.is_expired(attempt):
+        flash("時間切れです！試験を終了します。", "warning")
+        return redirect(url_for('submit_exam'))
+
     q_index = request.form.get('q_index', type=int)
-    question_id = request.form.get('question_id', type=str)
+    question_id = request.form.get('question_id', type=int)
     user_answers = request.form.getlist('selected_option')
+    if q_index is None or question_id is None:
+        return redirect(url_for('exam_question', q_index=0))
 
-    # 解答をセッションに保存
-    session['exam_state']['answers'][question_id] = user_answers
-    session.modified = True  # ネストした辞書を変更した場合は必須
+    total_questions = len(attempt.question_ids)  # コミット後に試験を読み込み直さないよう先に取得
+    exam_attempts.record_answer(attempt, question_id, user_answers)
+    db.session.commit()
 
     # 次の問題へリダイレクト（最後の問題ならサマリーページへ）
     next_index = q_index + 1
-    if next_index < len(session['exam_state']['question_ids']):
+    if next_index < total_questions:
         return redirect(url_for('exam_question', q_index=next_index))
     else:
         # ここでは最後の問題のページに戻るようにしておく（後でサマリーページなどに変更も可能）
         return redirect(url_for('exam_question', q_index=q_index))
 
 @app.route('/question/<int:question_id>')
+@query_budget(4)
 @login_required
 def show_question(question_id):
-    question = Question.query.get_or_404(question_id)
-    options_list = json.loads(question.options) if isinstance(question.options, str) else question.options
-    correct_answers_list = json.loads(question.correct_answer) if isinstance(question.correct_answer, str) else question.correct_answer
-    is_multi_select_question = isinstance(correct_answers_list, list) and len(correct_answers_list) > 1
-    
-    # ... (以下のロジックは変更なし)
-    quiz_order_ids = session.get('quiz_order_ids', [])
-    total_questions = len(quiz_order_ids)
-    current_question_index_in_order = session.get('current_question_index_in_order', 0)
-    display_question_number = current_question_index_in_order + 1
+    question = get_question_or_404(question_id)
+
+    run = quiz_run.get_run(current_user.id)
+    total_questions = run.question_count if run else 0
+    display_question_number = (run.position if run else 0) + 1
 
     display_correct_count = 0
     display_total_answered = 0
     display_accuracy = 0.0
-    if not session.get(REVIEW_MODE_KEY) and not session.get(EXAM_MODE_KEY):
-        display_correct_count = session.get('correct_count', 0)
-        display_total_answered = session.get('total_questions_answered', 0)
+    if run and not run.review_type:
+        display_correct_count = run.correct_count
+        display_total_answered = run.answered_count
         if display_total_answered > 0:
             display_accuracy = (display_correct_count / display_total_answered * 100)
     
-    checked_status = {'type1': False, 'type2': False, 'type3': False}
-    if current_user.is_authenticated:
-        user_id = current_user.id
-        for check_type_key in checked_status.keys():
-            existing_check = UserCheck.query.filter_by(user_id=user_id, question_id=question_id, check_type=check_type_key).first()
-            if existing_check and existing_check.is_checked:
-                checked_status[check_type_key] = True
+    # チェック状態はユーザーごとにまとめて読み込んだキャッシュから引く
+    checked_status = user_checks.get_check_status(current_user.id, question_id)
 
     last_answer_result = session.pop('last_answer_result', None) 
     last_user_answer = session.pop('last_user_answer', None)     
     
     return render_template('question.html',
                            question=question,
-                           options=options_list,
+                           options=question.options,
                            total_questions=total_questions,
                            current_question_index=display_question_number,
                            correct_count=display_correct_count,
                            total_answered=display_total_answered,
                            accuracy=f"{display_accuracy:.1f}",
                            checked_status=checked_status,
+                           quiz_run_id=run.id if run else None,
                            last_answer_result=last_answer_result,
                            last_user_answer=last_user_answer,
-                           is_multi_select_question=is_multi_select_question)
+                           is_multi_select_question=question.is_multi_select)
 
 @app.route('/answer', methods=['POST'])
+@query_budget(10)
 @login_required
 def handle_answer():
-    if session.get(EXAM_MODE_KEY):
-        end_time_str = session.get('exam_end_time')
-        if end_time_str:
-            end_time = datetime.datetime.fromisoformat(end_time_str)
-            if datetime.datetime.now(pytz.utc) > end_time:
-                flash("時間切れです！試験を終了します。", "warning")
-                return redirect(url_for('submit_exam'))
-
     user_selected_options = request.form.getlist('selected_option')
     question_id = request.form.get('question_id', type=int)
 
@@ -658,36 +721,29 @@ def handle_answer():
         flash("解答が選択されていないか、問題IDが不明です。", "warning")
         return redirect(request.referrer or url_for('quiz_range_select'))
 
-    question = Question.query.get_or_404(question_id)
-    correct_answers_list = json.loads(question.correct_answer) if isinstance(question.correct_answer, str) else question.correct_answer
-
-    is_correct = (set(user_selected_options) == set(correct_answers_list))
-    
-    correct_answer_for_display = " & ".join(map(str, correct_answers_list))
+    question = get_question_or_404(question_id)
+    is_correct = question.is_correct(user_selected_options)
+    correct_answer_for_display = question.correct_answer_display
 
     if current_user.is_authenticated:
         user_id = current_user.id
-        new_user_answer = UserAnswer(
-            user_id=user_id,
-            question_id=question.id,
-            user_selected_option=user_selected_options,
-            is_correct=is_correct
-        )
-        db.session.add(new_user_answer)
-        db.session.commit()
+        answered_at = datetime.datetime.utcnow()
+        # 解答履歴と集計の書き込み ('batched' ではバッファに追加するだけで、まとめて書き込まれる)
+        answer_buffer.record_answer(user_id, question.id, user_selected_options, is_correct, answered_at)
 
-        if session.get(REVIEW_MODE_KEY) and session.get(REVIEW_TYPE_KEY) == 'incorrect' and is_correct:
-            UserAnswer.query.filter_by(user_id=user_id, question_id=question_id, is_correct=False).delete()
-            db.session.commit()
+        run = quiz_run.get_run(user_id)
+        if run is not None:
+            quiz_run.record_answer(run, question.id, is_correct)
+
+        if run is not None and run.review_type == 'incorrect' and is_correct:
+            answer_buffer.forget_incorrect(user_id, question_id)
+
+        if answer_buffer.mode == 'batched' and run is not None:
+            # ここでコミットするのはクイズの進捗だけなので、ディスクへの書き込みを待たない
+            relax_commit_durability()
+        # 'sync' では解答の保存と集計・進捗の更新を1つのトランザクションでコミットする
+        db.session.commit()
 
-    answered_question_ids_in_session = session.get('answered_question_ids', [])
-    if question_id not in answered_question_ids_in_session:
-        if is_correct:
-            session['correct_count'] = session.get('correct_count', 0) + 1
-        session['total_questions_answered'] = session.get('total_questions_answered', 0) + 1
-        answered_question_ids_in_session.append(question_id)
-        session['answered_question_ids'] = answered_question_ids_in_session
-                
     session['last_answer_result'] = {
         'is_correct': is_correct,
         'message': "正解！" if is_correct else "不正解！",
@@ -700,47 +756,37 @@ def handle_answer():
 
 
 @app.route('/next_question')
+@query_budget(4)
 @login_required # ★★★ 修正箇所 ★★★
 def next_question():
-    if session.get(EXAM_MODE_KEY):
-        end_time_str = session.get('exam_end_time')
-        if end_time_str:
-            end_time = datetime.datetime.fromisoformat(end_time_str)
-            if datetime.datetime.now(pytz.utc) > end_time:
-                flash("時間切れです！試験を終了します。", "warning")
-                return redirect(url_for('submit_exam'))
-
-    quiz_order_ids = session.get('quiz_order_ids', [])
-    current_index = session.get('current_question_index_in_order', -1)
-    next_index = current_index + 1
-    
+    run = quiz_run.get_run(current_user.id)
+
     session.pop('last_answer_result', None) 
     session.pop('last_user_answer', None)
 
-    if next_index < len(quiz_order_ids):
-        next_question_id = quiz_order_ids[next_index]
-        session['current_question_index_in_order'] = next_index
+    if run is not None and run.position + 1 < run.question_count:
+        run.position += 1
+        next_question_id = quiz_run.current_question_id(run)
+        db.session.commit()
         return redirect(url_for('show_question', question_id=next_question_id))
     else:
-        if session.get(EXAM_MODE_KEY):
-            return redirect(url_for('submit_exam'))
-        
-        review_mode = session.pop(REVIEW_MODE_KEY, None)
-        review_type = session.pop(REVIEW_TYPE_KEY, None)
-        
-        correct_count_for_completion = session.pop('correct_count', 0)
-        total_answered = session.pop('total_questions_answered', 0)
-        session.pop('current_question_index_in_order', None)
-        session.pop('quiz_order_ids', None)
-        session.pop('answered_question_ids', None)
-        session.pop('current_range_key', None)
+        review_type = run.review_type if run else None
+        correct_count_for_completion = run.correct_count if run else 0
+        total_answered = run.answered_count if run else 0
+        quiz_run.discard_run(current_user.id)
+        db.session.commit()
         
-        if review_mode:
+        if review_type:
             flash_message = "復習が完了しました。"
             target_url = url_for('quiz_range_select')
             if review_type == 'incorrect':
                 flash_message = '間違えた問題の復習が完了しました。'
                 target_url = url_for('review_incorrect')
+            elif review_type == 'due':
+                flash_message = '今日の復習が完了しました。'
+            elif review_type == 'search':
+                flash_message = '検索した問題をすべて解きました。'
+                target_url = url_for('search')
             elif review_type and review_type.startswith('checked_'):
                 flash_message = 'チェック問題の復習が完了しました。'
                 target_url = url_for('my_checked_questions_by_type', check_type=review_type.replace('checked_', ''))
@@ -751,51 +797,24 @@ def next_question():
 
 # 「試験を終了して採点する」ボタンが押されたときの処理
 @app.route('/submit_exam')
+@query_budget(7)
 @login_required
 def submit_exam():
-    if 'exam_state' not in session:
+    attempt = exam_attempts.get_active_attempt(current_user.id)
+    if attempt is None:
         return redirect(url_for('exam_info'))
 
-    score = 0
-    results_detail = []
-    
-    question_ids = session['exam_state']['question_ids']
-    user_answers_map = session['exam_state']['answers']
-
-    for q_id in question_ids:
-        question = Question.query.get(q_id)
-        if not question: continue
+    # 保存済みの解答を1回のクエリで読み込み、問題はキャッシュから取得して採点する
+    # (期限を過ぎてから送られた解答は保存されていないので、採点にも含まれない)
+    question_ids = attempt.question_ids
+    score, results_detail = exam_attempts.score_attempt(attempt)
 
-        user_submitted_str_id = str(q_id)
-        user_submitted_answers = user_answers_map.get(user_submitted_str_id, [])
-        
-        correct_answers = json.loads(question.correct_answer) if isinstance(question.correct_answer, str) else question.correct_answer
-        
-        is_correct = (set(user_submitted_answers) == set(correct_answers))
-        if is_correct:
-            score += 1
-            
-        results_detail.append({
-            'question_id': q_id,
-            'question_text': question.question_text,
-            'image_filename': question.image_filename,
-            'user_answer': user_submitted_answers,
-            'correct_answer': correct_answers,
-            'explanation': question.explanation,
-            'is_correct': is_correct
-        })
-    
     # もし本番モードだったら、結果をDBに保存する
-    if session.get('exam_state', {}).get('proctored'):
-        new_exam_result = ExamResult(
-            user_id=current_user.id,
-            score=score,
-            total_questions=len(question_ids),
-            results_detail=results_detail
-        )
-        db.session.add(new_exam_result)
-        db.session.commit()
+    if attempt.proctored:
+        save_exam_result(current_user.id, score, results_detail, seed=attempt.seed, blueprint=attempt.blueprint)
         flash("本番モードの試験結果が保存されました。", "success")
+    exam_attempts.discard_attempts(current_user.id)
+    db.session.commit()
 
     # セッションに最終結果を保存する際、キーを'details'に統一する
     session['exam_results'] = {
@@ -804,12 +823,11 @@ def submit_exam():
         'details': results_detail
     }
 
-    session.pop('exam_state', None)
-
     return redirect(url_for('exam_results'))
 
 # 試験結果を表示する新しいルート
 @app.route('/exam/results')
+@query_budget(2)
 @login_required
 def exam_results():
     results = session.get('exam_results')
@@ -843,31 +861,16 @@ def quiz_completion():
 
 
 @app.route('/review_incorrect')
+@query_budget(3)
 @login_required
 def review_incorrect():
-    user_id = current_user.id
-    incorrect_answers_raw = UserAnswer.query.filter_by(user_id=user_id, is_correct=False).order_by(UserAnswer.timestamp.desc()).all()
-    
-    reviewed_questions = []
-    seen_question_ids = set()
-    for ua in incorrect_answers_raw:
-        if ua.question_id not in seen_question_ids:
-            if ua.question_detail:
-                # ▼▼▼ json.loads() を削除 ▼▼▼
-                user_selected_list = json.loads(ua.user_selected_option) if isinstance(ua.user_selected_option, str) else ua.user_selected_option
-                user_selected_display = " & ".join(map(str, user_selected_list))
-                
-                correct_answer_list = json.loads(ua.question_detail.correct_answer) if isinstance(ua.question_detail.correct_answer, str) else ua.question_detail.correct_answer
-                correct_answer_display = " & ".join(map(str, correct_answer_list))
-                reviewed_questions.append({
-                    'question': ua.question_detail,
-                    'user_selected_option': user_selected_display,
-                    'correct_answer_display': correct_answer_display,
-                })
-                seen_question_ids.add(ua.question_id)
-    return render_template('review_incorrect.html', reviewed_questions=reviewed_questions)
+    # 問題ごとの最新の不正解だけを SQL で選び、1ページ分だけ問題と結合して読み込む
+    page = request.args.get('page', 1, type=int)
+    pagination = paginate_latest_incorrect(current_user.id, page)
+    return render_template('review_incorrect.html', reviewed_questions=pagination.items, pagination=pagination)
 
 @app.route('/api/toggle_check', methods=['POST'])
+@query_budget(4)
 @login_required
 def toggle_check():
     data = request.get_json()
@@ -877,8 +880,7 @@ def toggle_check():
     check_type = data.get('check_type')
     user_id = current_user.id
 
-    allowed_check_types = ['type1', 'type2', 'type3']
-    if check_type not in allowed_check_types or question_id is None:
+    if check_type not in user_checks.CHECK_TYPES or question_id is None:
         return jsonify({'status': 'error', 'message': '無効なパラメータです。'}), 400
 
     existing_check = UserCheck.query.filter_by(user_id=user_id, question_id=question_id, check_type=check_type).first()
@@ -886,73 +888,86 @@ def toggle_check():
     if existing_check:
         db.session.delete(existing_check)
         db.session.commit()
+        user_checks.set_check(user_id, question_id, check_type, False)
         return jsonify({'status': 'success', 'checked': False, 'question_id': question_id, 'check_type': check_type}), 200
     else:
         new_check = UserCheck(user_id=user_id, question_id=question_id, check_type=check_type, is_checked=True)
         db.session.add(new_check)
         db.session.commit()
+        user_checks.set_check(user_id, question_id, check_type, True)
         return jsonify({'status': 'success', 'checked': True, 'question_id': question_id, 'check_type': check_type}), 200
 
+# 問題ごとに問い合わせずに済むよう、複数の問題のチェック状態をまとめて返す
+# ?question_ids=1,2,3 を省略すると、進行中のクイズに含まれる問題のうちチェックのあるものを返す
+@app.route('/api/check_status')
+@query_budget(3)
+@login_required
+def check_status():
+    checks = user_checks.get_user_checks(current_user.id)
+    question_ids_param = request.args.get('question_ids')
+    if question_ids_param:
+        try:
+            question_ids = {int(value) for value in question_ids_param.split(',') if value}
+        except ValueError:
+            return jsonify({'status': 'error', 'message': '無効なパラメータです。'}), 400
+        selected = {question_id: checks.get(question_id, frozenset()) for question_id in question_ids}
+    else:
+        run = quiz_run.get_run(current_user.id)
+        selected = {question_id: check_types for question_id, check_types in checks.items()
+                    if run is not None and quiz_run.contains(run, question_id)}
+    return jsonify({'status': 'success',
+                    'checks': {question_id: sorted(check_types) for question_id, check_types in selected.items()}})
+
 @app.route('/my_checked_questions/<string:check_type>')
+@query_budget(3)
 @login_required
 def my_checked_questions_by_type(check_type):
-    user_id = current_user.id
-    check_type_display_names = {'type1': '重要（緑）', 'type2': '苦手（オレンジ）', 'type3': '後で（ピンク）'}
-    if check_type not in check_type_display_names:
+    if check_type not in user_checks.CHECK_TYPE_NAMES:
         abort(404)
 
-    checked_entries = UserCheck.query.join(Question).filter(UserCheck.user_id == user_id, UserCheck.check_type == check_type, UserCheck.is_checked == True)\
-                                  .order_by(UserCheck.timestamp.desc()).all()
-    
-    checked_questions_data = []
-    for entry in checked_entries:
-        if entry.question_detail:
-            # ▼▼▼ json.loads() を削除 ▼▼▼
-            correct_answer_list = json.loads(entry.question_detail.correct_answer) if isinstance(entry.question_detail.correct_answer, str) else entry.question_detail.correct_answer
-            correct_answer_display = " & ".join(map(str, correct_answer_list))
-            checked_questions_data.append({
-                'question': entry.question_detail,
-                'correct_answer_display': correct_answer_display,
-                'check_type': entry.check_type
-            })
-    
+    # 問題は結合して読み込み、OFFSET を使わないキーセット方式で1ページ分だけ取得する
+    page = user_checks.checked_questions_page(current_user.id, check_type, request.args.get('cursor'))
     return render_template('my_checked_questions.html',
-                           checked_questions=checked_questions_data,
-                           current_check_type=check_type)
+                           checked_questions=page.items,
+                           current_check_type=check_type,
+                           page=page)
 
 
 @app.route('/checked_questions_overview')
+@query_budget(3)
 @login_required
 def checked_questions_overview():
-    user_id = current_user.id
-    check_counts = {}
-    check_type_display_names = {'type1': '重要（緑）', 'type2': '苦手（オレンジ）', 'type3': '後で（ピンク）'}
-    
-    for key, name in check_type_display_names.items():
-        count = UserCheck.query.filter_by(user_id=user_id, check_type=key, is_checked=True).count()
-        check_counts[key] = {'name': name, 'count': count}
-    
+    counts = user_checks.count_by_type(current_user.id)
+    check_counts = {key: {'name': name, 'count': counts[key]}
+                    for key, name in user_checks.CHECK_TYPE_NAMES.items()}
     return render_template('checked_questions_overview.html', check_counts=check_counts)
 
 
 @app.route('/reset_my_progress', methods=['POST'])
 @login_required
 def reset_my_progress():
+    """ログイン中のユーザーの解答履歴・チェック・集計を削除します。
+
+    'batched' では他のワーカーのバッファに残っている解答がリセットの後に書き込まれることがあるので、
+    先に user.progress_reset_at を更新する (行ロックを取る)。書き込み側はその行を読んで、
+    リセットより前の解答を捨てる (answer_buffer.py)。
+    """
     user_id = current_user.id
+    # このプロセスのバッファは先に書き込んでから、下で一緒に削除する
+    answer_buffer.flush()
+    User.query.filter_by(id=user_id).update({User.progress_reset_at: datetime.datetime.utcnow()},
+                                            synchronize_session=False)
     UserAnswer.query.filter_by(user_id=user_id).delete()
     UserCheck.query.filter_by(user_id=user_id).delete()
+    user_stats.reset_user_stats(user_id)
+    leaderboard.reset_user(user_id)
+    spaced_repetition.reset_user(user_id)
+    quiz_run.discard_run(user_id)
     db.session.commit()
+    user_checks.invalidate_user_checks(user_id)
     
-    session.pop('correct_count', None)
-    session.pop('total_questions_answered', None)
-    session.pop('answered_question_ids', None)
-    session.pop('current_range_key', None)
-    session.pop('quiz_order_ids', None)
-    session.pop('current_question_index_in_order', None)
     session.pop('last_answer_result', None) 
     session.pop('last_user_answer', None)
-    session.pop(REVIEW_MODE_KEY, None)
-    session.pop(REVIEW_TYPE_KEY, None)
     
     flash('あなたの学習進捗をリセットしました。', 'success')
     return redirect(url_for('quiz_range_select'))
@@ -961,24 +976,18 @@ def reset_my_progress():
 @app.route('/retry_question/<int:question_id>')
 @login_required # ★★★ 修正箇所 ★★★
 def retry_question(question_id):
-    _ = Question.query.get_or_404(question_id)
+    _ = get_question_or_404(question_id)
 
-    session.pop(REVIEW_MODE_KEY, None)
-    session.pop(REVIEW_TYPE_KEY, None)
-    session.pop('correct_count', None)
-    session.pop('total_questions_answered', None)
-    session.pop('answered_question_ids', None)
     session.pop('last_answer_result', None) 
     session.pop('last_user_answer', None)
-
-    session['quiz_order_ids'] = [question_id]
-    session['current_question_index_in_order'] = 0
-    session['current_range_key'] = f'retry_{question_id}'
+    quiz_run.start_run(current_user.id, [question_id])
+    db.session.commit()
 
     return redirect(url_for('show_question', question_id=question_id))
 
 
 @app.route('/review_all_incorrect')
+@query_budget(6)
 @login_required
 def review_all_incorrect():
     user_id = current_user.id
@@ -992,29 +1001,78 @@ def review_all_incorrect():
         flash("復習対象の間違えた問題はありません。", "info")
         return redirect(url_for('review_incorrect'))
 
-    random.shuffle(incorrect_question_ids)
-
-    session.pop('correct_count', None)
-    session.pop('total_questions_answered', None)
-    session.pop('answered_question_ids', None)
-    session.pop('current_range_key', None)
     session.pop('last_answer_result', None) 
     session.pop('last_user_answer', None)
+    run = quiz_run.start_run(user_id, incorrect_question_ids, review_type='incorrect')
+    db.session.commit()
+
+    return redirect(url_for('show_question', question_id=quiz_run.current_question_id(run)))
+
+
+# 間隔反復で期限の来た問題を、期限の古い順に REVIEW_BATCH_SIZE 問ずつ復習する
+@app.route('/review_due')
+@query_budget(5)
+@login_required
+def review_due():
+    user_id = current_user.id
+    due_question_ids = spaced_repetition.due_question_ids(user_id)
+
+    if not due_question_ids:
+        _, next_due_at = spaced_repetition.count_due(user_id)
+        if next_due_at:
+            flash(f"今復習する問題はありません。次の復習は {to_jst_str_filter(next_due_at)} からです。", "info")
+        else:
+            flash("復習する問題はありません。問題を解くと、復習の予定が作られます。", "info")
+        return redirect(url_for('quiz_range_select'))
+
+    session.pop('last_answer_result', None)
+    session.pop('last_user_answer', None)
+    # 期限の古い順に出題する
+    run = quiz_run.start_run(user_id, due_question_ids, review_type='due', shuffle=False)
+    db.session.commit()
+
+    return redirect(url_for('show_question', question_id=quiz_run.current_question_id(run)))
 
-    session['quiz_order_ids'] = incorrect_question_ids
-    session['current_question_index_in_order'] = 0
-    session[REVIEW_MODE_KEY] = True
-    session[REVIEW_TYPE_KEY] = 'incorrect'
 
-    return redirect(url_for('show_question', question_id=incorrect_question_ids[0]))
+# 問題の検索 (問題文・選択肢・解説の全文検索。関連度の高い順)
+@app.route('/search')
+@query_budget(4)
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    pagination = question_search.paginate_search(query, page=page) if query else None
+    hits = question_search.highlight_hits(pagination.items, query) if pagination else []
+    return render_template('search.html', title='問題の検索', query=query, pagination=pagination, hits=hits,
+                           quiz_limit=question_search.SEARCH_QUIZ_LIMIT)
+
+
+# 検索結果の問題 (関連度の高い順に SEARCH_QUIZ_LIMIT 問まで) をクイズとして解く
+@app.route('/search/start', methods=['POST'])
+@query_budget(5)
+@login_required
+def start_search_quiz():
+    query = request.form.get('q', '').strip()
+    question_ids = question_search.search_question_ids(query, question_search.SEARCH_QUIZ_LIMIT)
+    if not question_ids:
+        flash("検索に一致する問題はありません。", "info")
+        return redirect(url_for('search', q=query))
+
+    session.pop('last_answer_result', None)
+    session.pop('last_user_answer', None)
+    # 関連度の高い順に出題する
+    run = quiz_run.start_run(current_user.id, question_ids, review_type='search', shuffle=False)
+    db.session.commit()
+
+    return redirect(url_for('show_question', question_id=quiz_run.current_question_id(run)))
 
 
 @app.route('/review_all_checked/<string:check_type>')
+@query_budget(6)
 @login_required
 def review_all_checked(check_type):
     user_id = current_user.id
-    allowed_check_types = ['type1', 'type2', 'type3']
-    if check_type not in allowed_check_types:
+    if check_type not in user_checks.CHECK_TYPES:
         abort(404)
 
     checked_question_ids = [
@@ -1027,21 +1085,12 @@ def review_all_checked(check_type):
         flash(f"このタイプのチェック問題はありません。", "info")
         return redirect(url_for('my_checked_questions_by_type', check_type=check_type))
 
-    random.shuffle(checked_question_ids)
-
-    session.pop('correct_count', None)
-    session.pop('total_questions_answered', None)
-    session.pop('answered_question_ids', None)
-    session.pop('current_range_key', None)
     session.pop('last_answer_result', None) 
     session.pop('last_user_answer', None)
+    run = quiz_run.start_run(user_id, checked_question_ids, review_type=f'checked_{check_type}')
+    db.session.commit()
 
-    session['quiz_order_ids'] = checked_question_ids
-    session['current_question_index_in_order'] = 0
-    session[REVIEW_MODE_KEY] = True
-    session[REVIEW_TYPE_KEY] = f'checked_{check_type}'
-
-    return redirect(url_for('show_question', question_id=checked_question_ids[0]))
+    return redirect(url_for('show_question', question_id=quiz_run.current_question_id(run)))
 
 @app.route('/reset_password_request', methods=['GET', 'POST'])
 def reset_password_request():
@@ -1093,23 +1142,16 @@ def start_proctored_exam_request():
         # 入力されたパスワードが正しいかチェック
         if form.password.data == app.config.get('PROCTORED_EXAM_PASSWORD'):
             # パスワードが正しければ、start_examとほぼ同じ処理を実行
-            all_q_ids = [q.id for q in Question.query.with_entities(Question.id).all()]
-            if len(all_q_ids) < 20:
-                exam_questions_ids = all_q_ids
-            else:
-                exam_questions_ids = random.sample(all_q_ids, 20)
-
-            if not exam_questions_ids:
+            plan = exam_assembly.assemble_exam()
+            if not plan.question_ids:
                 flash("試験を開始できる問題がありません。", "danger")
                 return redirect(url_for('exam_info'))
 
-            # exam_stateを初期化し、「本番モード」である印をつける
-            session['exam_state'] = {
-                'question_ids': exam_questions_ids,
-                'answers': {},
-                'start_time': datetime.datetime.now(pytz.utc).isoformat(),
-                'proctored': True  # ★本番モードであるフラグ
-            }
+            # 「本番モード」の試験として保存する (結果は採点時にDBへ保存される)
+            exam_attempts.start_attempt(current_user.id, plan.question_ids, proctored=True,
+                                        seed=plan.seed, blueprint=plan.blueprint)
+            quiz_run.discard_run(current_user.id)
+            db.session.commit()
             return redirect(url_for('exam_question', q_index=0))
         else:
             flash("パスワードが違います。", "danger")
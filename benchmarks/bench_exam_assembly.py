@@ -0,0 +1,112 @@
+"""試験の問題の抽選 (exam_assembly.assemble_exam) にかかる時間を、問題数を変えて計測するベンチマーク。
+
+    python benchmarks/bench_exam_assembly.py [--sizes 1000,10000,100000,500000] [--requests 200]
+
+マイグレーションを適用した一時的な SQLite データベースに問題 (3割は削除済みの欠番) を投入し、
+問題数ごとに、以前の方法 (問題ID全件を読み込んで random.sample) と、exam_assembly による抽選
+(全範囲の20問と、ID範囲・難易度別の出題条件) の1回あたりの時間と SQL の発行数を比べます。
+最後の列は、導入直後のように問題分析がまだない (全問題が normal で、easy / hard の問題がない) 場合に
+同じ出題条件で抽選する時間です。
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import exam_assembly  # noqa: E402
+from models import db, Question, QuestionAnalytics  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+EXAM_QUESTION_COUNT = 20
+DELETED_RATE = 0.3
+BLUEPRINT = '[{"range": [1, 1000], "count": 5}, {"difficulty": {"easy": 5, "normal": 5, "hard": 5}}]'
+
+
+def add_questions(rng, first_id, last_id):
+    for start in range(first_id, last_id + 1, BATCH_SIZE):
+        end = min(start + BATCH_SIZE - 1, last_id)
+        ids = [i for i in range(start, end + 1) if rng.random() >= DELETED_RATE]
+        db.session.execute(Question.__table__.insert(), [
+            {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B'], 'correct_answer': ['A'],
+             'explanation': '', 'question_type': 'multiple_choice'}
+            for i in ids
+        ])
+        # 難易度別の出題用に、問題分析の正答率をばらつかせておく
+        db.session.execute(QuestionAnalytics.__table__.insert(), [
+            {'question_id': i, 'attempts': 20, 'correct_count': rng.randint(0, 20), 'option_counts': {}}
+            for i in ids
+        ])
+    db.session.commit()
+
+
+def old_sample():
+    all_q_ids = [q.id for q in Question.query.with_entities(Question.id).all()]
+    return random.sample(all_q_ids, min(len(all_q_ids), EXAM_QUESTION_COUNT))
+
+
+def per_call(func, requests):
+    """1回あたりの時間 (ミリ秒) と SQL の発行数を返します。"""
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    started = time.perf_counter()
+    try:
+        for _ in range(requests):
+            func()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    return (time.perf_counter() - started) * 1000 / requests, len(statements) / requests
+
+
+def without_analytics(func):
+    """問題分析を空にした状態で func を実行します (終わったらロールバックして元に戻す)。"""
+    QuestionAnalytics.query.delete(synchronize_session=False)
+    try:
+        return func()
+    finally:
+        db.session.rollback()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,500000')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    rng = random.Random(0)
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        default = exam_assembly.parse_blueprint(None, EXAM_QUESTION_COUNT)
+        blueprint = exam_assembly.parse_blueprint(BLUEPRINT, EXAM_QUESTION_COUNT)
+        count = 0
+        print(f'{"max id":>10} {"old":>18} {"assemble":>18} {"blueprint":>18} {"no analytics":>18}')
+        for size in sizes:
+            add_questions(rng, count + 1, size)
+            count = size
+            results = [per_call(old_sample, max(1, args.requests // 20)),
+                       per_call(lambda: exam_assembly.assemble_exam(default), args.requests),
+                       per_call(lambda: exam_assembly.assemble_exam(blueprint), args.requests),
+                       without_analytics(lambda: per_call(lambda: exam_assembly.assemble_exam(blueprint),
+                                                          max(1, args.requests // 20)))]
+            print(f'{size:>10} ' + ' '.join(f'{ms:>8.2f}ms {queries:>4.1f} SQL' for ms, queries in results))
+
+
+if __name__ == '__main__':
+    main()
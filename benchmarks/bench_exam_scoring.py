@@ -0,0 +1,110 @@
+"""submit_exam の採点処理を旧実装と比較するマイクロベンチマーク。
+
+    python benchmarks/bench_exam_scoring.py [--questions 5000] [--exam-size 20] [--rounds 200]
+
+旧実装 (問題ごとに Question.query.get) と score_exam() について、
+1回の採点あたりの所要時間と発行クエリ数を表示します。
+score_exam() は出題された問題がキャッシュにない場合 (IN クエリ1本) とキャッシュ済みの場合を計測します。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import event  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+from exam_scoring import score_exam  # noqa: E402
+from models import db, Question  # noqa: E402
+from question_cache import invalidate_question_cache  # noqa: E402
+
+app = quiz_app.app
+
+
+def legacy_score_exam(question_ids, answers_map):
+    # 旧 submit_exam() と同じく、問題ごとに1回ずつ取得して採点する
+    score = 0
+    results_detail = []
+    for q_id in question_ids:
+        question = Question.query.get(q_id)
+        if not question:
+            continue
+        user_answer = answers_map.get(str(q_id), [])
+        correct_answers = json.loads(question.correct_answer) if isinstance(question.correct_answer, str) else question.correct_answer
+        is_correct = set(user_answer) == set(correct_answers)
+        score += is_correct
+        results_detail.append({'question_id': q_id, 'is_correct': is_correct})
+    return score, results_detail
+
+
+def seed_questions(count):
+    db.drop_all()
+    db.create_all()
+    rows = [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B', 'C', 'D'],
+         'correct_answer': ['A'] if i % 3 else ['A', 'B'], 'explanation': '解説',
+         'question_type': 'multiple_choice'}
+        for i in range(1, count + 1)
+    ]
+    db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+
+
+def measure(label, rounds, exams, scorer, before_round=None):
+    query_count = 0
+
+    def count_query(*args):
+        nonlocal query_count
+        query_count += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    elapsed = 0.0
+    try:
+        for question_ids, answers in exams[:rounds]:
+            if before_round:
+                before_round(question_ids)
+            # リクエストごとに新しいセッションになる状況を再現する
+            db.session.remove()
+            started = time.perf_counter()
+            scorer(question_ids, answers)
+            elapsed += time.perf_counter() - started
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+    print(f'{label:<26} {elapsed / rounds * 1000:>10.3f} {query_count / rounds:>10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=5000)
+    parser.add_argument('--exam-size', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    exams = []
+    for _ in range(args.rounds):
+        question_ids = rng.sample(range(1, args.questions + 1), args.exam_size)
+        answers = {str(q_id): [rng.choice('ABCD')] for q_id in question_ids}
+        exams.append((question_ids, answers))
+
+    with app.app_context():
+        seed_questions(args.questions)
+        print(f"{'scorer':<26} {'ms/submit':>10} {'queries':>10}")
+        measure('legacy (get per id)', args.rounds, exams, legacy_score_exam)
+        score_exam(*exams[0])
+        measure('score_exam (uncached)', args.rounds, exams, score_exam,
+                before_round=invalidate_question_cache)
+        measure('score_exam (warm)', args.rounds, exams, score_exam)
+
+
+if __name__ == '__main__':
+    main()
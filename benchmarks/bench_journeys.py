@@ -0,0 +1,455 @@
+"""クイズと試験の一連の操作 (ジャーニー) を繰り返して、ルートごとのレイテンシを計測するベンチマーク。
+
+    python benchmarks/bench_journeys.py [--users 200] [--questions 1000] [--answers 200000]
+                                        [--journey quiz|exam|both] [--iterations 5] [--concurrency 1]
+                                        [--mode client|gunicorn] [--url URL] [--database-url URL]
+                                        [--save-baseline FILE] [--compare FILE] [--max-regression 0.2]
+
+合成データ (ユーザー・問題・解答履歴) を投入したデータベースに対して、仮想ユーザーごとにログインし、
+次の流れを --iterations 回繰り返します。
+
+    quiz: / → start_multi_quiz → (問題表示 → 解答 → next_question) × --quiz-answers
+    exam: start_exam → (問題表示 → exam_answer) × EXAM_QUESTION_COUNT → submit_exam → 結果表示
+
+ステップごとの p50/p95/p99 レイテンシ、スループット、1リクエストあたりの SQL 数 (QUERY_DEBUG の
+X-Query-Count ヘッダー) を表示します。--mode client は Flask のテストクライアントで同じプロセス内から、
+--mode gunicorn は gunicorn を起動して HTTP で計測します (--url を付けると起動済みのサーバーを使う。
+サーバーは --database-url と同じデータベースを使っていること)。既定は一時的な SQLite データベースで、
+--database-url に空の PostgreSQL データベースを指定するとそちらにマイグレーションと投入を行います。
+
+--save-baseline で結果を JSON に保存し、--compare で保存した結果と比べます。p95 が --max-regression
+(割合) を超えて遅くなったステップや、SQL 数が増えたステップがあれば終了コード1で終了します。
+"""
+import argparse
+import datetime
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, namedtuple
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_journey_')
+BATCH_SIZE = 20000
+PASSWORD = 'password'
+QUANTILES = (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+RANGE_KEY = re.compile(r'name="selected_ranges" value="([^"]+)"')
+QUESTION_ID = re.compile(r'name="question_id" value="(\d+)"')
+OPTION = re.compile(r'name="selected_option" value="([^"]*)"')
+
+Reply = namedtuple('Reply', 'status location body queries')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--questions', type=int, default=1000)
+    parser.add_argument('--answers', type=int, default=200_000, help='投入する解答履歴の件数')
+    parser.add_argument('--days', type=int, default=30, help='解答履歴を散らばらせる日数')
+    parser.add_argument('--journey', choices=('quiz', 'exam', 'both'), default='both')
+    parser.add_argument('--iterations', type=int, default=5, help='仮想ユーザーごとのジャーニーの回数')
+    parser.add_argument('--quiz-answers', type=int, default=10, help='クイズ1回で解答する問題数')
+    parser.add_argument('--concurrency', type=int, default=1, help='同時に動かす仮想ユーザーの数')
+    parser.add_argument('--mode', choices=('client', 'gunicorn'), default='client')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn のワーカー数')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn のワーカーごとのスレッド数')
+    parser.add_argument('--url', help='起動済みのサーバーを計測する (例: http://127.0.0.1:8000)')
+    parser.add_argument('--database-url', help='既定は一時的な SQLite データベース')
+    parser.add_argument('--skip-seed', action='store_true', help='投入済みのデータベースをそのまま使う')
+    parser.add_argument('--seed', type=int, default=0, help='データ投入とジャーニーの乱数の seed')
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    args = parser.parse_args()
+    if args.url:
+        args.mode = 'gunicorn'
+    return args
+
+
+# --- データ投入 ---
+
+def seed(db, users, questions, answers, days, rng):
+    from flask_migrate import upgrade
+    from models import User, Question, UserAnswer
+    import leaderboard
+    import user_stats
+
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    if db.session.query(User.id).first() is not None:
+        sys.exit('データベースが空ではありません。空のデータベースを指定するか --skip-seed を付けてください。')
+
+    template = User(username='template')
+    template.set_password(PASSWORD)
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'bench{i}', 'email': f'bench{i}@example.com', 'password_hash': template.password_hash,
+         'is_admin': False, 'show_in_ranking': True, 'is_confirmed': True}
+        for i in range(1, users + 1)
+    ])
+    db.session.execute(Question.__table__.insert(), [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B', 'C', 'D'],
+         'correct_answer': [rng.choice('ABCD')], 'explanation': f'解説 {i}', 'question_type': 'multiple_choice'}
+        for i in range(1, questions + 1)
+    ])
+
+    now = datetime.datetime.utcnow()
+    span = days * 86400
+    for offset in range(0, answers, BATCH_SIZE):
+        db.session.execute(UserAnswer.__table__.insert(), [
+            {'user_id': rng.randint(1, users), 'question_id': rng.randint(1, questions),
+             'user_selected_option': [rng.choice('ABCD')], 'is_correct': rng.random() < 0.6,
+             'timestamp': now - datetime.timedelta(seconds=rng.randint(0, span))}
+            for _ in range(min(BATCH_SIZE, answers - offset))
+        ])
+    db.session.commit()
+
+    # 解答時に更新している集計テーブルを、投入した解答履歴から作る
+    user_stats.rebuild_user_stats()
+    leaderboard.rebuild_leaderboard()
+    db.session.commit()
+
+
+# --- リクエストの送信 ---
+
+def _relative(location):
+    if not location:
+        return None
+    parts = urllib.parse.urlsplit(location)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+class ClientDriver:
+    """Flask のテストクライアントでリクエストを送ります。"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return Reply(response.status_code, _relative(response.headers.get('Location')),
+                     response.get_data(as_text=True), response.headers.get('X-Query-Count'))
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPDriver:
+    """起動したサーバーに HTTP でリクエストを送ります (リダイレクトは追わない)。"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            response = self.opener.open(request, timeout=60)
+        except urllib.error.HTTPError as e:
+            response = e
+        with response:
+            return Reply(response.status, _relative(response.headers.get('Location')),
+                         response.read().decode('utf-8', errors='replace'), response.headers.get('X-Query-Count'))
+
+
+# --- ジャーニー ---
+
+class Recorder:
+    """ステップごとのレイテンシ (ms) と SQL 数を記録します。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, step, elapsed_ms, reply):
+        with self.lock:
+            self.latencies[step].append(elapsed_ms)
+            if reply.queries is not None:
+                self.queries[step].append(int(reply.queries))
+            if reply.status >= 400:
+                self.errors[step] += 1
+
+
+class VirtualUser:
+
+    def __init__(self, driver, recorder, username, rng):
+        self.driver = driver
+        self.recorder = recorder
+        self.username = username
+        self.rng = rng
+        self.csrf_token = None
+
+    def call(self, step, method, path, data=None, expect=(200, 302)):
+        if data is not None and self.csrf_token:
+            data = dict(data, csrf_token=self.csrf_token)
+        started = time.perf_counter()
+        reply = self.driver.request(method, path, data)
+        self.recorder.add(step, (time.perf_counter() - started) * 1000, reply)
+        if reply.status not in expect:
+            raise RuntimeError(f'{self.username}: {method} {path} returned {reply.status}')
+        token = CSRF_TOKEN.search(reply.body)
+        if token:
+            self.csrf_token = token.group(1)
+        return reply
+
+    def login(self):
+        self.call('login_form', 'GET', '/login')
+        reply = self.call('login', 'POST', '/login', {'username': self.username, 'password': PASSWORD})
+        if reply.status != 302 or reply.location.startswith('/login'):
+            raise RuntimeError(f'{self.username}: login failed')
+
+    def answer_options(self, body):
+        options = OPTION.findall(body)
+        return [self.rng.choice(options)] if options else ['A']
+
+    def quiz_journey(self, answers):
+        reply = self.call('quiz_range_select', 'GET', '/')
+        # 解答する問題数に足りるだけ、ランダムに範囲を選ぶ (range_開始_終了)
+        ranges = RANGE_KEY.findall(reply.body)
+        self.rng.shuffle(ranges)
+        selected, size = [], 0
+        for key in ranges:
+            if size >= answers:
+                break
+            _, start_id, end_id = key.split('_')
+            selected.append(key)
+            size += int(end_id) - int(start_id) + 1
+        reply = self.call('start_multi_quiz', 'POST', '/start_multi_quiz',
+                          {'selected_ranges': selected}, expect=(302,))
+        location = reply.location
+        for _ in range(answers):
+            if not location.startswith('/question/'):
+                break
+            reply = self.call('show_question', 'GET', location)
+            question_id = QUESTION_ID.search(reply.body).group(1)
+            self.call('handle_answer', 'POST', '/answer',
+                      {'question_id': question_id, 'selected_option': self.answer_options(reply.body)}, expect=(302,))
+            reply = self.call('next_question', 'GET', '/next_question', expect=(302,))
+            location = reply.location
+
+    def exam_journey(self):
+        reply = self.call('start_exam', 'POST', '/start_exam', {}, expect=(302,))
+        q_index = 0
+        while True:
+            reply = self.call('exam_question', 'GET', f'/exam/question/{q_index}')
+            question_id = QUESTION_ID.search(reply.body).group(1)
+            reply = self.call('exam_answer', 'POST', '/exam/answer',
+                              {'q_index': q_index, 'question_id': question_id,
+                               'selected_option': self.answer_options(reply.body)}, expect=(302,))
+            # 最後の問題では同じ問題に戻される
+            next_index = int(reply.location.rsplit('/', 1)[1])
+            if next_index == q_index:
+                break
+            q_index = next_index
+        self.call('submit_exam', 'GET', '/submit_exam', expect=(302,))
+        self.call('exam_results', 'GET', '/exam/results')
+
+
+def run_users(make_driver, recorder, args):
+    journeys = ['quiz', 'exam'] if args.journey == 'both' else [args.journey]
+    user_ids = list(range(1, args.users + 1))
+    random.Random(args.seed).shuffle(user_ids)
+    errors = []
+
+    def worker(number):
+        rng = random.Random(args.seed * 1000 + number)
+        user = VirtualUser(make_driver(), recorder, f'bench{user_ids[number % len(user_ids)]}', rng)
+        try:
+            user.login()
+            for iteration in range(args.iterations):
+                if journeys[iteration % len(journeys)] == 'quiz':
+                    user.quiz_journey(args.quiz_answers)
+                else:
+                    user.exam_journey()
+        except Exception as e:
+            errors.append(e)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for error in errors:
+        print('error:', error)
+    return elapsed, len(errors)
+
+
+# --- gunicorn ---
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(database_url, args):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, SESSION_BACKEND='database', QUERY_DEBUG='true',
+               MAIL_WORKERS='0')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+         '--workers', str(args.workers), '--threads', str(args.threads), '--log-level', 'warning'],
+        cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'gunicorn exited with {process.returncode}')
+        try:
+            HTTPDriver(base_url).request('GET', '/login')
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit('gunicorn did not start within 60s')
+
+
+# --- 集計・ベースライン ---
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(recorder, elapsed):
+    steps = {}
+    for step, latencies in recorder.latencies.items():
+        values = sorted(latencies)
+        queries = recorder.queries.get(step)
+        steps[step] = {
+            'count': len(values),
+            'errors': recorder.errors.get(step, 0),
+            'mean': sum(values) / len(values),
+            **{name: percentile(values, q) for name, q in QUANTILES},
+            'queries': sum(queries) / len(queries) if queries else None,
+        }
+    total = sum(len(values) for values in recorder.latencies.values())
+    return {'steps': steps, 'requests': total, 'elapsed': elapsed, 'throughput': total / elapsed if elapsed else 0.0}
+
+
+def print_summary(result):
+    print(f"{'step':<22} {'count':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'SQL/req':>8}")
+    for step, stats in result['steps'].items():
+        queries = f"{stats['queries']:.1f}" if stats['queries'] is not None else '-'
+        print(f"{step:<22} {stats['count']:>6} {stats['mean']:>8.1f} {stats['p50']:>8.1f} "
+              f"{stats['p95']:>8.1f} {stats['p99']:>8.1f} {queries:>8}"
+              + (f"  ({stats['errors']} errors)" if stats['errors'] else ''))
+    print(f"{result['requests']} requests in {result['elapsed']:.1f}s ({result['throughput']:.1f} req/s), latency in ms")
+
+
+def compare(result, baseline, max_regression):
+    """ベースラインと比べて表示し、悪化したステップの数を返します。"""
+    print(f"\ncompared with {baseline['meta']['created_at']} ({baseline['meta']['mode']})")
+    if baseline['meta']['args'] != result['meta']['args'] or baseline['meta']['mode'] != result['meta']['mode']:
+        print('note: the baseline was recorded with different options:', baseline['meta'])
+    print(f"{'step':<22} {'p50':>16} {'p95':>16} {'p99':>16} {'SQL/req':>12}")
+    regressions = 0
+    for step, stats in result['steps'].items():
+        base = baseline['steps'].get(step)
+        if base is None:
+            continue
+        cells = []
+        for name, _ in QUANTILES:
+            change = (stats[name] - base[name]) / base[name] if base[name] else 0.0
+            cells.append(f'{stats[name]:.1f} ({change:+.0%})')
+        slower = base['p95'] and (stats['p95'] - base['p95']) / base['p95'] > max_regression
+        more_queries = (stats['queries'] is not None and base['queries'] is not None
+                        and stats['queries'] > base['queries'])
+        queries = f"{base['queries'] or 0:.1f}→{stats['queries'] or 0:.1f}"
+        flag = '  NG' if slower or more_queries else ''
+        regressions += bool(flag)
+        print(f'{step:<22} {cells[0]:>16} {cells[1]:>16} {cells[2]:>16} {queries:>12}{flag}')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    database_url = args.database_url or 'sqlite:///' + os.path.join(WORK_DIR, 'journeys.db')
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['SESSION_BACKEND'] = 'local'
+    os.environ['QUERY_DEBUG'] = 'true'
+    os.environ['MAIL_WORKERS'] = '0'
+    sys.path.insert(0, ROOT)
+
+    import app as quiz_app
+    from models import db
+    from question_cache import invalidate_question_cache
+
+    app = quiz_app.app
+    if not args.skip_seed:
+        with app.app_context():
+            started = time.perf_counter()
+            seed(db, args.users, args.questions, args.answers, args.days, random.Random(args.seed))
+            invalidate_question_cache()
+        print(f'seeded {args.users} users, {args.questions} questions, {args.answers} answers '
+              f'in {time.perf_counter() - started:.1f}s')
+
+    server = None
+    if args.mode == 'client':
+        def make_driver():
+            return ClientDriver(app)
+    else:
+        base_url = args.url
+        if base_url is None:
+            server, base_url = start_gunicorn(database_url, args)
+
+        def make_driver():
+            return HTTPDriver(base_url)
+
+    recorder = Recorder()
+    try:
+        elapsed, failed_users = run_users(make_driver, recorder, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = summarize(recorder, elapsed)
+    result['meta'] = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'mode': 'http' if args.mode != 'client' else 'client',
+        'database': database_url.split(':', 1)[0],
+        'args': {name: getattr(args, name) for name in
+                 ('users', 'questions', 'answers', 'journey', 'iterations', 'quiz_answers', 'concurrency',
+                  'workers', 'threads', 'seed')},
+    }
+    print_summary(result)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'saved baseline to {args.save_baseline}')
+
+    regressions = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+
+    if failed_users or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
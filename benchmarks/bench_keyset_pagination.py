@@ -0,0 +1,112 @@
+"""管理画面の試験結果一覧のページ分割を、OFFSET 方式とキーセット方式で比べるベンチマーク。
+
+    python benchmarks/bench_keyset_pagination.py [--results 200000] [--per-page 20] [--requests 10]
+
+マイグレーションを適用した一時的な SQLite データベースに試験結果を投入し、最初・中ほど・最後のページを
+次の2つの方法で読む時間を比べます。
+  offset: 以前の一覧と同じ .paginate() (COUNT(*) と OFFSET 付きの SELECT)
+  keyset: keyset_pagination.paginate_keyset() (前のページの最後の行からのカーソル。件数はキャッシュした概数)
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+from keyset_pagination import cached_count, encode_cursor, paginate_keyset  # noqa: E402
+from models import db, User, ExamResult  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+USER_COUNT = 100
+
+
+def seed(results):
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+         'is_confirmed': True, 'is_admin': False, 'show_in_ranking': True}
+        for i in range(1, USER_COUNT + 1)
+    ])
+    rng = random.Random(0)
+    # 同じ日時の結果も混ざるように、秒単位で古い順に投入する
+    start = datetime.datetime(2024, 1, 1)
+    for offset in range(0, results, BATCH_SIZE):
+        db.session.execute(ExamResult.__table__.insert(), [
+            {'user_id': rng.randint(1, USER_COUNT), 'score': rng.randint(0, 20), 'total_questions': 20,
+             'submitted_at': start + datetime.timedelta(seconds=(offset + i) // 2)}
+            for i in range(min(BATCH_SIZE, results - offset))
+        ])
+    db.session.commit()
+
+
+def results_query():
+    return ExamResult.query.join(User).options(db.contains_eager(ExamResult.user))
+
+
+def offset_page(page, per_page):
+    return results_query().order_by(ExamResult.submitted_at.desc()) \
+                          .paginate(page=page, per_page=per_page, error_out=False).items
+
+
+def keyset_cursor(page, per_page):
+    """page ページ目を読むためのカーソル (前のページの最後の行) を作ります。"""
+    if page == 1:
+        return None
+    row = ExamResult.query.order_by(ExamResult.submitted_at.desc(), ExamResult.id.desc()) \
+                          .offset((page - 1) * per_page - 1).first()
+    return encode_cursor((row.submitted_at, row.id))
+
+
+def keyset_page(cursor, per_page):
+    return paginate_keyset(results_query(), [ExamResult.submitted_at, ExamResult.id], cursor, per_page,
+                           total=cached_count('admin_exam_results', ExamResult.query)).items
+
+
+def timed(function, requests):
+    times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--results', type=int, default=200_000)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args.results)
+        print(f'seeded {args.results} exam results in {time.perf_counter() - started:.1f}s')
+
+        last_page = (args.results + args.per_page - 1) // args.per_page
+        for label, page in (('first', 1), ('middle', last_page // 2), ('last', last_page)):
+            cursor = keyset_cursor(page, args.per_page)
+            expected = [result.id for result in offset_page(page, args.per_page)]
+            got = [result.id for result in keyset_page(cursor, args.per_page)]
+            # 同じ日時の結果の並びは OFFSET 方式では決まらないので、件数だけ比べる
+            assert len(got) == len(expected), (len(got), len(expected))
+            offset_ms = timed(lambda: offset_page(page, args.per_page), args.requests)
+            keyset_ms = timed(lambda: keyset_page(cursor, args.per_page), args.requests)
+            print(f'{label:>6} page {page:>6}: offset {offset_ms:7.2f}ms  keyset {keyset_ms:6.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
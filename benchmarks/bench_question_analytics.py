@@ -0,0 +1,107 @@
+"""問題分析の集計 (flask refresh-question-analytics) の所要時間を計測するベンチマーク。
+
+    python benchmarks/bench_question_analytics.py [--answers 1000000] [--questions 3000] [--users 2000]
+                                                  [--new-answers 10000]
+
+マイグレーションを適用した一時的な SQLite データベースに解答履歴を投入し、全件からの集計 (--full 相当) と、
+その後に追加した --new-answers 件だけの差分集計の時間を計測します。最後に、集計結果の解答数・正解数が
+解答履歴の GROUP BY と一致することを確認します。
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import case, func  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import question_analytics  # noqa: E402
+import user_stats  # noqa: E402
+from models import db, User, Question, UserAnswer, QuestionAnalytics  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+OPTIONS = ['A', 'B', 'C', 'D']
+
+
+def insert_answers(rng, count, users, questions, newest):
+    for offset in range(0, count, BATCH_SIZE):
+        rows = []
+        for _ in range(min(BATCH_SIZE, count - offset)):
+            selected = rng.choice(OPTIONS)
+            rows.append({'user_id': rng.randint(1, users), 'question_id': rng.randint(1, questions),
+                         'user_selected_option': [selected], 'is_correct': selected == 'A',
+                         'timestamp': newest - datetime.timedelta(seconds=rng.randint(0, 10 ** 6))})
+        db.session.execute(UserAnswer.__table__.insert(), rows)
+
+
+def seed(answers, questions, users):
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '',
+         'is_admin': False, 'show_in_ranking': True, 'is_confirmed': True}
+        for i in range(1, users + 1)
+    ])
+    db.session.execute(Question.__table__.insert(), [
+        {'id': i, 'question_text': f'問題 {i}', 'options': OPTIONS, 'correct_answer': ['A'],
+         'explanation': '', 'question_type': 'multiple_choice'}
+        for i in range(1, questions + 1)
+    ])
+    # 直近の解答は集計の対象外になるので、少し前の時刻にしておく
+    insert_answers(random.Random(0), answers, users, questions,
+                   datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+    user_stats.rebuild_user_stats()
+    db.session.commit()
+
+
+def timed_refresh(label, **kwargs):
+    started = time.perf_counter()
+    report = question_analytics.refresh_question_analytics(**kwargs)
+    db.session.commit()
+    print(f'{label:>12}: {report.answers} answers, {report.questions} questions '
+          f'in {time.perf_counter() - started:.2f}s')
+
+
+def verify():
+    expected = dict((question_id, (attempts, correct)) for question_id, attempts, correct in db.session.query(
+        UserAnswer.question_id, func.count(), func.sum(case((UserAnswer.is_correct == True, 1), else_=0)))
+        .group_by(UserAnswer.question_id))
+    actual = dict((row.question_id, (row.attempts, row.correct_count)) for row in QuestionAnalytics.query)
+    assert actual == expected, 'analytics differ from the answer history'
+    print('analytics match the answer history')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answers', type=int, default=1_000_000)
+    parser.add_argument('--questions', type=int, default=3000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--new-answers', type=int, default=10_000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args.answers, args.questions, args.users)
+        print(f'seeded {args.answers} answers in {time.perf_counter() - started:.1f}s')
+
+        timed_refresh('full', full=True)
+        insert_answers(random.Random(1), args.new_answers, args.users, args.questions,
+                       datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
+        db.session.commit()
+        timed_refresh('incremental')
+        timed_refresh('no changes')
+        verify()
+
+
+if __name__ == '__main__':
+    main()
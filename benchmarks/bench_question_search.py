@@ -0,0 +1,106 @@
+"""問題の全文検索 (question_search) の検索時間を、LIKE による検索と比べるベンチマーク。
+
+    python benchmarks/bench_question_search.py [--questions 100000] [--requests 20]
+
+マイグレーションを適用した一時的な SQLite データベースに、語 (よく使う語と、カタカナの語 3000 個) を
+組み合わせた問題を投入して
+flask rebuild-search-index と同じ処理でトークンを作り、いくつかの検索語について、FTS5 での検索
+(1ページ目と件数) と、問題文・選択肢・解説への LIKE '%検索語%' の検索の時間を比べます。
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import cast, or_, String  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import question_search  # noqa: E402
+from models import db, Question  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 10000
+WORDS = ['データベース', '正規化', 'ネットワーク', '暗号化', '公開鍵', 'プロトコル', 'アルゴリズム', '計算量',
+         'オブジェクト指向', '継承', 'トランザクション', '排他制御', 'キャッシュ', '仮想記憶', 'ページング',
+         'スケジューリング', 'SQL', 'TCP', 'HTTP', 'Python', '二分探索', 'ハッシュ表', 'ソート', '再帰',
+         'セキュリティ', '認証', 'ファイアウォール', 'バックアップ', 'クラウド', 'コンテナ']
+KANA = 'アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン'
+QUERIES = ['正規化', 'オブジェクト指向 継承', 'tcp', '探索', 'キャッシュ']
+
+
+def vocabulary(rng, size=3000):
+    # 出現頻度の低い語 (問題ごとに違う用語) の代わり
+    return WORDS + [''.join(rng.choice(KANA) for _ in range(rng.randint(3, 6))) for _ in range(size)]
+
+
+def sentence(rng, vocab, words):
+    # 前半のよく使う語ほど選ばれやすくする
+    return 'の'.join(vocab[min(int(rng.paretovariate(1.0)) - 1, len(vocab) - 1)] if rng.random() < 0.3
+                     else rng.choice(vocab) for _ in range(words)) + 'について正しいものはどれか。'
+
+
+def seed(questions):
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    rng = random.Random(0)
+    vocab = vocabulary(rng)
+    for start in range(1, questions + 1, BATCH_SIZE):
+        db.session.execute(Question.__table__.insert(), [
+            {'id': i, 'question_text': sentence(rng, vocab, 3), 'options': [rng.choice(vocab) for _ in range(4)],
+             'correct_answer': [], 'explanation': sentence(rng, vocab, 6), 'question_type': 'multiple_choice'}
+            for i in range(start, min(start + BATCH_SIZE, questions + 1))
+        ])
+    db.session.commit()
+
+
+def like_search(query):
+    conditions = []
+    for term in query.split():
+        pattern = f'%{term}%'
+        conditions.append(or_(Question.question_text.like(pattern), cast(Question.options, String).like(pattern),
+                              Question.explanation.like(pattern)))
+    return Question.query.filter(*conditions).order_by(Question.id.desc()).paginate(page=1, per_page=20, error_out=False)
+
+
+def median_ms(func, requests):
+    times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--questions', type=int, default=100_000)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args.questions)
+        print(f'seeded {args.questions} questions in {time.perf_counter() - started:.1f}s')
+        started = time.perf_counter()
+        question_search.rebuild_search_index()
+        db.session.commit()
+        print(f'rebuilt search index in {time.perf_counter() - started:.1f}s')
+
+        print(f'{"query":<24} {"hits":>7} {"fts":>10} {"like":>10}')
+        for query in QUERIES:
+            hits = question_search.paginate_search(query).total
+            fts_ms = median_ms(lambda: question_search.paginate_search(query), args.requests)
+            like_ms = median_ms(lambda: like_search(query), args.requests)
+            print(f'{query:<24} {hits:>7} {fts_ms:>8.1f}ms {like_ms:>8.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""問題範囲選択画面 (/) のレイテンシを問題数ごとに計測するベンチマーク。
+
+    python benchmarks/bench_quiz_ranges.py [--sizes 100,1000,10000,100000] [--requests 50]
+
+一時的な SQLite データベースに問題を投入し、テストクライアントで / を繰り返し取得します。
+キャッシュ無効化直後 (cold) とキャッシュ済み (warm) の時間、および比較用に
+旧実装 (範囲ごとに COUNT を発行) の範囲一覧作成時間を表示します。
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+import app as quiz_app  # noqa: E402
+from models import db, Question  # noqa: E402
+from question_cache import invalidate_question_cache  # noqa: E402
+
+app = quiz_app.app
+
+
+def legacy_dynamic_ranges(range_size=5):
+    # 旧 get_dynamic_ranges() と同じく、範囲ごとに COUNT を発行する
+    max_id = db.session.query(db.func.max(Question.id)).scalar() or 0
+    ranges = {}
+    start_id = 1
+    while start_id <= max_id:
+        end_id = min(start_id + range_size - 1, max_id)
+        if Question.query.filter(Question.id.between(start_id, end_id)).count() > 0:
+            ranges[f'range_{start_id}_{end_id}'] = {'name': f'No.{start_id} ~ No.{end_id}'}
+        start_id += range_size
+    return ranges
+
+
+def seed_questions(count):
+    db.drop_all()
+    db.create_all()
+    rows = [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B', 'C', 'D'],
+         'correct_answer': ['A'], 'explanation': '', 'question_type': 'multiple_choice'}
+        for i in range(1, count + 1)
+    ]
+    db.session.execute(Question.__table__.insert(), rows)
+    db.session.commit()
+    invalidate_question_cache()
+
+
+def timed_get(client, path):
+    started = time.perf_counter()
+    response = client.get(path)
+    elapsed = time.perf_counter() - started
+    assert response.status_code == 200, response.status_code
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+
+    print(f"{'questions':>10} {'cold ms':>10} {'warm ms':>10} {'legacy ms':>10}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        with app.app_context():
+            seed_questions(size)
+        client = app.test_client()
+
+        invalidate_question_cache()
+        cold = timed_get(client, '/')
+        warm = sorted(timed_get(client, '/') for _ in range(args.requests))[args.requests // 2]
+
+        legacy = float('nan')
+        if not args.skip_legacy:
+            with app.app_context():
+                started = time.perf_counter()
+                legacy_dynamic_ranges(app.config['QUIZ_RANGE_SIZE'])
+                legacy = time.perf_counter() - started
+
+        print(f'{size:>10} {cold * 1000:>10.2f} {warm * 1000:>10.2f} {legacy * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""/ranking のレイテンシを大量の解答履歴で計測するベンチマーク。
+
+    python benchmarks/bench_ranking.py [--users 5000] [--answers 10000000] [--days 60] [--legacy]
+
+一時的な SQLite データベースに解答履歴を投入し、日別カウンタを作成 (flask rebuild-leaderboard と同じ処理)
+してから、日間・週間・月間ランキングをテストクライアントで取得します。
+キャッシュ無効化直後 (cold) とキャッシュ済み (warm) の時間を表示し、--legacy を付けると
+旧実装 (user_answer を直接 GROUP BY する) のクエリ時間も計測します。
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import leaderboard  # noqa: E402
+from models import db, User, Question, UserAnswer  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+
+
+def seed(users, answers, days):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '',
+         'is_admin': False, 'show_in_ranking': i % 10 != 0, 'is_confirmed': True}
+        for i in range(1, users + 1)
+    ])
+    db.session.execute(Question.__table__.insert(), [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B'], 'correct_answer': ['A'],
+         'explanation': '', 'question_type': 'multiple_choice'}
+        for i in range(1, 1001)
+    ])
+    login_user = db.session.get(User, 1)
+    login_user.set_password('password')
+    db.session.commit()
+
+    # 件数が多いため、ORM を通さず SQLite へ直接まとめて投入する
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    span = days * 86400
+    conn = db.session.connection()
+    for offset in range(0, answers, BATCH_SIZE):
+        rows = [
+            (int(rng.paretovariate(1.2)) % users + 1, rng.randint(1, 1000), '["A"]', 1,
+             (now - datetime.timedelta(seconds=rng.randint(0, span))).strftime('%Y-%m-%d %H:%M:%S.%f'))
+            for _ in range(min(BATCH_SIZE, answers - offset))
+        ]
+        conn.exec_driver_sql(
+            'INSERT INTO user_answer (user_id, question_id, user_selected_option, is_correct, timestamp) '
+            'VALUES (?, ?, ?, ?, ?)', rows)
+    db.session.commit()
+
+
+def legacy_ranking(start_date):
+    return db.session.query(User.username, func.count(UserAnswer.id).label('answer_count')) \
+        .join(UserAnswer, User.id == UserAnswer.user_id) \
+        .filter(User.is_admin == False, User.show_in_ranking == True, UserAnswer.timestamp >= start_date) \
+        .group_by(User.id).order_by(func.count(UserAnswer.id).desc()).limit(100).all()
+
+
+def timed_get(client, path):
+    started = time.perf_counter()
+    response = client.get(path)
+    assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--answers', type=int, default=10_000_000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(args.users, args.answers, args.days)
+        print(f'seeded {args.answers} answers in {time.perf_counter() - started:.1f}s')
+        started = time.perf_counter()
+        leaderboard.rebuild_leaderboard()
+        db.session.commit()
+        print(f'rebuilt daily counters in {time.perf_counter() - started:.1f}s')
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'password'})
+
+    print(f"{'period':>8} {'cold ms':>10} {'warm ms':>10} {'legacy ms':>10}")
+    for period in ('daily', 'weekly', 'monthly'):
+        leaderboard.invalidate_ranking_cache()
+        cold = timed_get(client, f'/ranking?period={period}')
+        warm = sorted(timed_get(client, f'/ranking?period={period}') for _ in range(args.requests))[args.requests // 2]
+
+        legacy = float('nan')
+        if args.legacy:
+            with app.app_context():
+                _, start_day, _ = leaderboard.period_window(period)
+                start_date = datetime.datetime.combine(start_day, datetime.time()) - datetime.timedelta(hours=9)
+                started = time.perf_counter()
+                legacy_ranking(start_date)
+                legacy = (time.perf_counter() - started) * 1000
+        print(f'{period:>8} {cold:>10.2f} {warm:>10.2f} {legacy:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""/review_due (間隔反復の復習) の開始にかかる時間を、解答の多いユーザーで計測するベンチマーク。
+
+    python benchmarks/bench_review_due.py [--answers 100000] [--questions 5000] [--requests 10]
+
+マイグレーションを適用した一時的な SQLite データベースに、1人のユーザーの解答履歴 (3割が不正解) を
+投入し、flask rebuild-review-schedule と同じ処理で復習の予定を作ります。その後、/review_due と
+/review_all_incorrect (解答履歴から間違えた問題を集める) で復習を開始するまでの時間を比べます。
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import spaced_repetition  # noqa: E402
+from models import db, User, Question, UserAnswer, ReviewSchedule  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+
+
+def seed(answers, questions):
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    user = User(username='user1', email='user1@example.com', is_confirmed=True)
+    user.set_password('password')
+    db.session.add(user)
+    db.session.execute(Question.__table__.insert(), [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B'], 'correct_answer': ['A'],
+         'explanation': '', 'question_type': 'multiple_choice'}
+        for i in range(1, questions + 1)
+    ])
+    db.session.flush()
+
+    rng = random.Random(0)
+    # 1年分の解答履歴を古い順に投入する (予定は解答した順に再生して作るため)
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    step = datetime.timedelta(days=365) / answers
+    for offset in range(0, answers, BATCH_SIZE):
+        db.session.execute(UserAnswer.__table__.insert(), [
+            {'user_id': user.id, 'question_id': rng.randint(1, questions), 'user_selected_option': ['A'],
+             'is_correct': rng.random() >= 0.3, 'timestamp': start + step * (offset + i)}
+            for i in range(min(BATCH_SIZE, answers - offset))
+        ])
+    db.session.commit()
+    return user.id
+
+
+def timed_start(client, path):
+    started = time.perf_counter()
+    response = client.get(path)
+    elapsed = (time.perf_counter() - started) * 1000
+    assert response.status_code == 302 and '/question/' in response.headers['Location'], response.headers
+    return elapsed
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answers', type=int, default=100_000)
+    parser.add_argument('--questions', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=10)
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        started = time.perf_counter()
+        user_id = seed(args.answers, args.questions)
+        print(f'seeded {args.answers} answers in {time.perf_counter() - started:.1f}s')
+        started = time.perf_counter()
+        spaced_repetition.rebuild_review_schedule()
+        db.session.commit()
+        print(f'rebuilt review schedule in {time.perf_counter() - started:.1f}s')
+        due_count, _ = spaced_repetition.count_due(user_id)
+        print(f'{ReviewSchedule.query.count()} scheduled questions, {due_count} due now')
+
+        times = []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            spaced_repetition.due_question_ids(user_id)
+            times.append((time.perf_counter() - started) * 1000)
+        print(f'      due query: median {median(times):.2f}ms')
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'password'})
+    for label, path in (('review_due', '/review_due'), ('review_all_incorrect', '/review_all_incorrect')):
+        times = [timed_start(client, path) for _ in range(args.requests)]
+        print(f'{label:>20}: median {median(times):.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""/review_incorrect のレイテンシを、不正解の多いユーザーで計測するベンチマーク。
+
+    python benchmarks/bench_review_incorrect.py [--answers 150000] [--questions 3000] [--legacy]
+
+マイグレーションを適用した一時的な SQLite データベースに、1人のユーザーの解答履歴 (9割が不正解) を
+投入し、最初のページと最後のページの表示時間を計測します。--legacy を付けると、旧実装 (不正解を全件
+読み込んで Python で問題ごとに重複を除く) の時間も計測し、両者の結果が一致することを確認します。
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_bench_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'bench.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+from incorrect_answers import paginate_latest_incorrect  # noqa: E402
+from models import db, User, Question, UserAnswer  # noqa: E402
+
+app = quiz_app.app
+BATCH_SIZE = 50000
+
+
+def seed(answers, questions):
+    upgrade(directory=os.path.join(ROOT, 'migrations'))
+    user = User(username='user1', email='user1@example.com', is_confirmed=True)
+    user.set_password('password')
+    db.session.add(user)
+    db.session.execute(Question.__table__.insert(), [
+        {'id': i, 'question_text': f'問題 {i}', 'options': ['A', 'B'], 'correct_answer': ['A'],
+         'explanation': '', 'question_type': 'multiple_choice'}
+        for i in range(1, questions + 1)
+    ])
+    db.session.flush()
+
+    rng = random.Random(0)
+    now = datetime.datetime.utcnow()
+    for offset in range(0, answers, BATCH_SIZE):
+        db.session.execute(UserAnswer.__table__.insert(), [
+            {'user_id': user.id, 'question_id': rng.randint(1, questions), 'user_selected_option': ['B'],
+             'is_correct': rng.random() < 0.1, 'timestamp': now - datetime.timedelta(seconds=rng.randint(0, 10 ** 7))}
+            for _ in range(min(BATCH_SIZE, answers - offset))
+        ])
+    db.session.commit()
+    return user.id
+
+
+def legacy_review(user_id):
+    seen = []
+    seen_question_ids = set()
+    for answer in UserAnswer.query.filter_by(user_id=user_id, is_correct=False) \
+                                  .options(db.joinedload(UserAnswer.question_detail)) \
+                                  .order_by(UserAnswer.timestamp.desc()):
+        if answer.question_id not in seen_question_ids:
+            seen_question_ids.add(answer.question_id)
+            seen.append(answer.question_id)
+    return seen
+
+
+def timed_get(client, path):
+    started = time.perf_counter()
+    response = client.get(path)
+    assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--answers', type=int, default=150_000)
+    parser.add_argument('--questions', type=int, default=3000)
+    parser.add_argument('--requests', type=int, default=10)
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        started = time.perf_counter()
+        user_id = seed(args.answers, args.questions)
+        print(f'seeded {args.answers} answers in {time.perf_counter() - started:.1f}s')
+        with app.test_request_context():
+            pagination = paginate_latest_incorrect(user_id, 1)
+        print(f'{pagination.total} questions answered incorrectly, {pagination.pages} pages')
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'password'})
+    for label, page in (('first page', 1), ('last page', pagination.pages)):
+        times = sorted(timed_get(client, f'/review_incorrect?page={page}') for _ in range(args.requests))
+        print(f'{label:>10}: median {times[len(times) // 2]:.1f}ms')
+
+    if args.legacy:
+        with app.test_request_context():
+            started = time.perf_counter()
+            legacy = legacy_review(user_id)
+            print(f'    legacy: {(time.perf_counter() - started) * 1000:.1f}ms')
+            current = [item.question.id for item in paginate_latest_incorrect(user_id, 1, per_page=len(legacy)).items]
+        assert current == legacy, 'results differ from the legacy implementation'
+        print('results match the legacy implementation')
+
+
+if __name__ == '__main__':
+    main()
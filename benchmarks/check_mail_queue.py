@@ -0,0 +1,139 @@
+"""メール送信キューをローカルのSMTPサーバーに対して動かす確認スクリプト。
+
+    python benchmarks/check_mail_queue.py [--mails 300] [--fail-every 0]
+
+外部のメールサーバーの代わりに、受信したメールを数えるだけの簡易SMTPサーバーをこのプロセス内で起動し、
+一時的な SQLite データベースを使って send_email() でメールを送信キューに追加します。
+全通の送信が終わるまでの時間と、使ったSMTP接続の数 (MAIL_BATCH_SIZE 通ごとに1本になるはず) を表示します。
+--fail-every N を付けると N 通に1通を一時エラー (451) で拒否し、再試行で最終的に全通届くことを確認します。
+--drop-every N を付けると N 通に1通の送信中に接続を切断し、残りのメールが試行回数を使わずに
+送り直されること (再試行の回数が切断の回数と同じになること) を確認します。
+"""
+import argparse
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_mail_')
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """EHLO / MAIL / RCPT / DATA / QUIT だけに答える、テスト用のSMTPサーバー。"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost test SMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command.startswith('RCPT'):
+                with server.lock:
+                    server.attempts += 1
+                    rejected = server.fail_every and server.attempts % server.fail_every == 0
+                self.reply('451 try again later' if rejected else '250 OK')
+            elif command.startswith('MAIL'):
+                with server.lock:
+                    server.mails += 1
+                    dropped = server.drop_every and server.mails % server.drop_every == 0
+                    server.drops += bool(dropped)
+                if dropped:
+                    return
+                self.reply('250 OK')
+            elif command.startswith(('RSET', 'NOOP')):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with server.lock:
+                    server.delivered += 1
+                self.reply('250 queued')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, fail_every=0, drop_every=0):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.attempts = 0
+        self.delivered = 0
+        self.mails = 0
+        self.drops = 0
+        self.fail_every = fail_every
+        self.drop_every = drop_every
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mails', type=int, default=300)
+    parser.add_argument('--fail-every', type=int, default=0, help='N通に1通を一時エラーで拒否する')
+    parser.add_argument('--drop-every', type=int, default=0, help='N通に1通の送信中に接続を切断する')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.fail_every, args.drop_every)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+    os.environ.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(WORK_DIR, 'mail.db'),
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(sink.server_address[1]),
+        'MAIL_USE_TLS': 'false',
+        'MAIL_USERNAME': '',
+        'MAIL_DEFAULT_SENDER': 'noreply@example.com',
+        'MAIL_RETRY_DELAY': '0',
+        'SESSION_BACKEND': 'local',
+    })
+    sys.path.insert(0, ROOT)
+    import app as quiz_app
+    from models import db
+
+    app = quiz_app.app
+    with app.app_context():
+        db.create_all()
+        started = time.perf_counter()
+        for number in range(args.mails):
+            quiz_app.send_email(f'user{number}@example.com', f'test {number}', '<p>hello</p>')
+        enqueued = time.perf_counter() - started
+
+        deadline = time.monotonic() + args.timeout
+        while sink.delivered < args.mails and time.monotonic() < deadline:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        stats = quiz_app.mail_queue.get_stats()
+
+    print(f'enqueued {args.mails} mails in {enqueued * 1000:.0f}ms')
+    print(f'delivered {sink.delivered}/{args.mails} in {elapsed:.2f}s '
+          f'over {sink.connections} SMTP connections ({sink.attempts} RCPT attempts)')
+    print('queue:', stats)
+    if sink.drops:
+        print(f'dropped {sink.drops} connections, {stats["retried_total"]} retries')
+    if sink.delivered != args.mails or stats['pending'] or stats['failed']:
+        sys.exit(1)
+    if not args.fail_every and stats['retried_total'] != sink.drops:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""主要ルートの SQL 発行数が、@query_budget で宣言した上限に収まっているかを確認するチェック。
+
+    python benchmarks/check_query_budgets.py [-v]
+
+マイグレーションを適用した一時的な SQLite データベースに、解答履歴やチェックを一覧が複数件になるだけ
+入れてから各ルートを実行し、ルートごとの発行数と上限を表示します。問題キャッシュが温まった状態と、
+各リクエストの直前にキャッシュを無効化した状態 (ワーカーの最初のリクエスト、TTL 切れ、管理画面での
+変更の後と同じ) の両方で実行します。上限を超えたルートや、同じ形の
+文を QUERY_REPEAT_THRESHOLD 回以上発行したルート (N+1 の疑い) があれば終了コード1で終了します (CI 用)。
+-v を付けると、各ルートで発行された文を表示します。
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_budget_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'budget.db')
+os.environ['SESSION_BACKEND'] = 'local'
+os.environ['QUERY_DEBUG'] = 'true'
+os.environ['MAIL_WORKERS'] = '0'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import question_search  # noqa: E402
+from models import db, User, Question, UserAnswer, UserCheck  # noqa: E402
+from query_budget import QueryCounter, get_query_budget  # noqa: E402
+from question_cache import invalidate_question_cache, warm_question_cache  # noqa: E402
+
+app = quiz_app.app
+
+QUESTION_COUNT = 30
+
+# (説明, メソッド, パス, client.open への追加の引数)
+ROUTES = [
+    ('quiz_range_select', 'GET', '/', {}),
+    ('start_multi_quiz', 'POST', '/start_multi_quiz', {'data': {'selected_ranges': ['range_1_10', 'range_11_20']}}),
+    ('show_question', 'GET', '/question/1', {}),
+    ('handle_answer', 'POST', '/answer', {'data': {'question_id': 1, 'selected_option': ['A']}}),
+    ('next_question', 'GET', '/next_question', {}),
+    ('toggle_check', 'POST', '/api/toggle_check', {'json': {'question_id': 2, 'check_type': 'type2'}}),
+    ('show_question (cached checks)', 'GET', '/question/2', {}),
+    ('check_status', 'GET', '/api/check_status', {}),
+    ('mypage', 'GET', '/mypage', {}),
+    ('ranking', 'GET', '/ranking?period=weekly', {}),
+    ('review_incorrect', 'GET', '/review_incorrect', {}),
+    ('checked_questions_overview', 'GET', '/checked_questions_overview', {}),
+    ('my_checked_questions_by_type', 'GET', '/my_checked_questions/type1', {}),
+    ('review_all_incorrect', 'GET', '/review_all_incorrect', {}),
+    ('review_all_checked', 'GET', '/review_all_checked/type1', {}),
+    ('review_due', 'GET', '/review_due', {}),
+    ('search', 'GET', '/search?q=問題', {}),
+    ('start_search_quiz', 'POST', '/search/start', {'data': {'q': '問題'}}),
+    ('exam_info', 'GET', '/exam', {}),
+    ('start_exam', 'POST', '/start_exam', {}),
+    ('exam_question', 'GET', '/exam/question/0', {}),
+    ('exam_answer', 'POST', '/exam/answer', {'data': {'q_index': 0, 'question_id': 1, 'selected_option': ['A']}}),
+    ('submit_exam', 'GET', '/submit_exam', {}),
+    ('exam_results', 'GET', '/exam/results', {}),
+]
+
+
+def seed():
+    users = []
+    for i in range(3):
+        user = User(username=f'user{i}', email=f'user{i}@example.com', is_confirmed=True)
+        user.set_password('password')
+        users.append(user)
+    db.session.add_all(users)
+    db.session.add_all(
+        Question(id=i, question_text=f'問題 {i}', options=['A', 'B'], correct_answer=['A'], explanation='')
+        for i in range(1, QUESTION_COUNT + 1)
+    )
+    db.session.flush()
+    for user in users:
+        for i in range(1, QUESTION_COUNT + 1):
+            db.session.add(UserAnswer(user_id=user.id, question_id=i, user_selected_option=['B'], is_correct=i % 3 == 0))
+            if i % 3 == 0:
+                db.session.add(UserCheck(user_id=user.id, question_id=i, check_type='type1'))
+    question_search.rebuild_search_index()
+    db.session.commit()
+
+
+def main():
+    verbose = '-v' in sys.argv[1:]
+    app.config['WTF_CSRF_ENABLED'] = False
+    threshold = app.config['QUERY_REPEAT_THRESHOLD']
+
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        seed()
+        # 本番と同じく、問題データはワーカーの起動時に読み込み済みの状態で計測する (gunicorn.conf.py)
+        warm_question_cache()
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user0', 'password': 'password'})
+    violations = app.extensions['query_budget_violations']
+    violations.clear()
+
+    failures = 0
+    for cold in (False, True):
+        for label, method, path, kwargs in ROUTES:
+            if cold:
+                # 他のワーカーで問題が変更された直後と同じく、版番号を進めてキャッシュを作り直させる
+                with app.app_context():
+                    invalidate_question_cache()
+                label = f'{label} [cold cache]'
+            failures += not check_route(client, label, method, path, kwargs, threshold, verbose)
+
+    for message in violations:
+        print('violation:', message)
+    if failures or violations:
+        print(f'{failures} route(s) over budget, {len(violations)} violation(s) recorded.')
+        sys.exit(1)
+
+
+def check_route(client, label, method, path, kwargs, threshold, verbose):
+    # 発行数にはセッションの読み書きやログインユーザーの読み込みも含まれる
+    # (キャッシュの作り直しの文は uncounted として別に数える)
+    with QueryCounter() as counter:
+        response = client.open(path, method=method, **kwargs)
+    with app.test_request_context(path, method=method) as context:
+        budget = get_query_budget(context.request.endpoint)
+    repeated = counter.repeated(threshold)
+    ok = response.status_code < 400 and (budget is None or counter.count <= budget) and not repeated
+    uncounted = f', +{len(counter.uncounted_statements)} uncounted' if counter.uncounted_statements else ''
+    print(f'{"OK" if ok else "NG"}  {label}: {counter.count} queries{uncounted} '
+          f'(budget {budget if budget is not None else "-"}, status {response.status_code})')
+    for shape, count in repeated:
+        print(f'    repeated {count} times: {shape[:200]}')
+    if verbose or not ok:
+        print(counter.report())
+    return ok
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""主要ルートが解答履歴・チェック関連のテーブルを全件スキャンしていないかを確認するチェック。
+
+    python benchmarks/check_query_plans.py
+
+マイグレーションを適用した一時的な SQLite データベースに対して各ルートを実行し、
+発行された SQL を EXPLAIN QUERY PLAN にかけます。インデックスを使わない
+"SCAN user_answer" などのテーブル全件スキャンが1つでもあれば終了コード1で終了します (CI 用)。
+"""
+import os
+import re
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+WORK_DIR = tempfile.mkdtemp(prefix='quiz_plan_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'plan.db')
+os.environ['SESSION_BACKEND'] = 'local'
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import app as quiz_app  # noqa: E402
+import leaderboard  # noqa: E402
+from models import db, User, Question, UserAnswer, UserCheck  # noqa: E402
+
+app = quiz_app.app
+
+WATCHED_TABLES = ('user_answer', 'user_check', 'user_question_stats', 'user_daily_answer_count')
+FULL_SCAN = re.compile(r'\bSCAN (%s)(_\d+)?\b(?! USING)' % '|'.join(WATCHED_TABLES))
+
+# (説明, メソッド, パス, フォームデータ)
+ROUTES = [
+    ('show_question', 'GET', '/question/1', None),
+    ('handle_answer', 'POST', '/answer', {'question_id': 1, 'selected_option': ['A']}),
+    ('mypage', 'GET', '/mypage', None),
+    ('review_incorrect', 'GET', '/review_incorrect', None),
+    ('review_all_incorrect', 'GET', '/review_all_incorrect', None),
+    ('ranking (daily)', 'GET', '/ranking?period=daily', None),
+    ('ranking (weekly)', 'GET', '/ranking?period=weekly', None),
+    ('ranking (monthly)', 'GET', '/ranking?period=monthly', None),
+    ('checked_questions_overview', 'GET', '/checked_questions_overview', None),
+    ('my_checked_questions_by_type', 'GET', '/my_checked_questions/type1', None),
+]
+
+
+def seed():
+    users = []
+    for i in range(3):
+        user = User(username=f'user{i}', email=f'user{i}@example.com', is_confirmed=True)
+        user.set_password('password')
+        users.append(user)
+    db.session.add_all(users)
+    db.session.add_all(
+        Question(id=i, question_text=f'問題 {i}', options=['A', 'B'], correct_answer=['A'], explanation='')
+        for i in range(1, 21)
+    )
+    db.session.flush()
+    for user in users:
+        for i in range(1, 21):
+            db.session.add(UserAnswer(user_id=user.id, question_id=i, user_selected_option=['B'], is_correct=i % 2 == 0))
+            if i % 4 == 0:
+                db.session.add(UserCheck(user_id=user.id, question_id=i, check_type='type1'))
+    db.session.flush()
+    # ランキングが日別カウンタを読むように、解答履歴からカウンタを作っておく
+    leaderboard.rebuild_leaderboard()
+    db.session.commit()
+
+
+def explain(statement, parameters):
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, tuple(parameters or ())).all()
+    return [row[-1] for row in rows]
+
+
+def main():
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        seed()
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'user0', 'password': 'password'})
+
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and any(table in statement for table in WATCHED_TABLES):
+                captured.append((statement, parameters))
+
+        failures = 0
+        event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            for label, method, path, data in ROUTES:
+                captured.clear()
+                client.open(path, method=method, data=data)
+                statements = list(captured)
+                route_failures = 0
+                for statement, parameters in statements:
+                    scans = [line for line in explain(statement, parameters) if FULL_SCAN.search(line)]
+                    if scans:
+                        route_failures += 1
+                        print(f'NG  {label}: {"; ".join(scans)}\n    {" ".join(statement.split())}')
+                if not route_failures:
+                    print(f'OK  {label} ({len(statements)} statements)')
+                failures += route_failures
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', capture)
+
+    if failures:
+        print(f'{failures} statement(s) scan {"/".join(WATCHED_TABLES)} without an index.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
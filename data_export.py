@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from models import db, User, Question, UserAnswer, ExamResult, ExamResultItem
+
+# 問題・解答履歴・試験結果のストリーミングエクスポート
+# サーバーサイドカーソル (yield_per) で chunk_size 行ずつ読み込み、CSV / JSONL の文字列を
+# チャンクごとに yield する。件数に関係なくメモリ使用量は一定で、最初の行からすぐに送信できる。
+
+DEFAULT_EXPORT_CHUNK_SIZE = 1000
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def _isoformat(dt):
+    return dt.isoformat() if dt else None
+
+
+def _question_rows():
+    query = select(Question.id, Question.question_text, Question.options, Question.correct_answer,
+                   Question.explanation, Question.image_filename, Question.question_type) \
+        .order_by(Question.id)
+
+    def to_record(row):
+        return {
+            'id': row.id,
+            'question_text': row.question_text,
+            'options': _as_list(row.options),
+            'correct_answers': _as_list(row.correct_answer),
+            'explanation': row.explanation,
+            'image_filename': row.image_filename,
+            'question_type': row.question_type,
+        }
+    return query, to_record
+
+
+def _answer_rows():
+    query = select(UserAnswer.id, UserAnswer.user_id, User.username, UserAnswer.question_id,
+                   UserAnswer.user_selected_option, UserAnswer.is_correct, UserAnswer.timestamp) \
+        .join(User, User.id == UserAnswer.user_id) \
+        .order_by(UserAnswer.id)
+
+    def to_record(row):
+        return {
+            'id': row.id,
+            'user_id': row.user_id,
+            'username': row.username,
+            'question_id': row.question_id,
+            'user_selected_option': _as_list(row.user_selected_option),
+            'is_correct': row.is_correct,
+            'timestamp': _isoformat(row.timestamp),
+        }
+    return query, to_record
+
+
+def _exam_result_rows():
+    query = select(ExamResult.id, ExamResult.user_id, User.username, ExamResult.score,
+                   ExamResult.total_questions, ExamResult.submitted_at) \
+        .join(User, User.id == ExamResult.user_id) \
+        .order_by(ExamResult.id)
+
+    def to_record(row):
+        return {
+            'id': row.id,
+            'user_id': row.user_id,
+            'username': row.username,
+            'score': row.score,
+            'total_questions': row.total_questions,
+            'submitted_at': _isoformat(row.submitted_at),
+        }
+    return query, to_record
+
+
+def _exam_result_item_rows():
+    query = select(ExamResultItem.exam_result_id, ExamResultItem.position, ExamResultItem.question_id,
+                   ExamResultItem.user_answer, ExamResultItem.is_correct) \
+        .order_by(ExamResultItem.exam_result_id, ExamResultItem.position)
+
+    def to_record(row):
+        return {
+            'exam_result_id': row.exam_result_id,
+            'position': row.position,
+            'question_id': row.question_id,
+            'user_answer': _as_list(row.user_answer),
+            'is_correct': row.is_correct,
+        }
+    return query, to_record
+
+
+# {データセット名: (表示名, CSVの列, クエリと変換関数を返す関数)}
+EXPORT_DATASETS = {
+    'questions': ('問題', ('id', 'question_text', 'options', 'correct_answers', 'explanation',
+                         'image_filename', 'question_type'), _question_rows),
+    'answers': ('解答履歴', ('id', 'user_id', 'username', 'question_id', 'user_selected_option',
+                          'is_correct', 'timestamp'), _answer_rows),
+    'exam_results': ('本番試験結果', ('id', 'user_id', 'username', 'score', 'total_questions',
+                                  'submitted_at'), _exam_result_rows),
+    'exam_result_items': ('本番試験結果 (問題ごと)', ('exam_result_id', 'position', 'question_id', 'user_answer',
+                                              'is_correct'), _exam_result_item_rows),
+}
+
+
+def _csv_value(value):
+    # 問題のCSVはインポートと同じく、リストを | 区切りで出力する。それ以外の入れ子はJSON文字列にする
+    if isinstance(value, list):
+        if all(isinstance(item, str) for item in value):
+            return '|'.join(value)
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def iter_export(dataset, fmt, chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+    """データセットを CSV / JSONL の文字列チャンクとして順に返すジェネレーター。"""
+    if dataset not in EXPORT_DATASETS:
+        raise ValueError(f'Unknown dataset: {dataset}')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown format: {fmt}')
+
+    _, columns, build_query = EXPORT_DATASETS[dataset]
+    query, to_record = build_query()
+    result = db.session.execute(query.execution_options(yield_per=chunk_size))
+
+    if fmt == 'csv':
+        # CSVはExcelで開いても文字化けしないよう BOM 付きで出力する (インポートも BOM 付きに対応)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(columns)
+        yield '\ufeff' + buffer.getvalue()
+
+    for partition in result.partitions():
+        buffer = io.StringIO()
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            for row in partition:
+                record = to_record(row)
+                writer.writerow(_csv_value(record[column]) for column in columns)
+        else:
+            for row in partition:
+                buffer.write(json.dumps(to_record(row), ensure_ascii=False))
+                buffer.write('\n')
+        yield buffer.getvalue()
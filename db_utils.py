@@ -0,0 +1,38 @@
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db
+
+
+def upsert(table, index_elements, set_=None):
+    """INSERT ... ON CONFLICT DO UPDATE 文を作成します (PostgreSQL / SQLite 対応)。
+
+    値は文に埋め込まず、db.session.execute(stmt, rows) のように実行時に渡します
+    (rows がリストなら executemany になり、コンパイル済みの文も再利用される)。
+    set_ には {列名: 式} を渡します。式の中では stmt.excluded を参照できるよう、
+    set_ に関数を渡した場合は excluded を引数に呼び出します。
+    set_ を省略すると、衝突した行は何もしません (ON CONFLICT DO NOTHING)。
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f'upsert is not supported on {dialect}')
+
+    if set_ is None:
+        return stmt.on_conflict_do_nothing(index_elements=index_elements)
+    if callable(set_):
+        set_ = set_(stmt.excluded)
+    return stmt.on_conflict_do_update(index_elements=index_elements, set_=set_)
+
+
+def relax_commit_durability():
+    """このトランザクションのコミットで、WAL がディスクに書き込まれるのを待たないようにします。
+
+    PostgreSQL の synchronous_commit をこのトランザクションだけ off にする (他のDBでは何もしない)。
+    DBサーバーが異常終了すると直前のコミットが失われることがあるため、失われても困らない更新にだけ使う。
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SET LOCAL synchronous_commit TO OFF'))
@@ -0,0 +1,263 @@
+import json
+import math
+import random
+import secrets
+from collections import namedtuple
+from dataclasses import dataclass
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Question, QuestionAnalytics
+
+# 試験の問題の選び方 (出題条件) と抽選
+# 問題IDを全件読み込んで random.sample() するのではなく、出題条件のセクションごとに、ID範囲の
+# 最小・最大の間から候補のIDを乱数で作り、実在する問題 (難易度の指定があれば問題分析の正答率も) を
+# IN クエリ1本で確かめて、足りなければ候補を増やして繰り返す。削除された問題の欠番が少なければ
+# 1〜2回のクエリで済み、抽選にかかる時間は出題数だけで決まる (問題数が増えても変わらない)。
+# 候補の中に条件に合う問題がほとんどない場合 (欠番だらけの範囲・少ない難易度) は、最後に範囲内の
+# 乱数で選んだ位置から FALLBACK_SCAN_LIMIT 問だけを連続して読み込んで抽選する (範囲全体は読まない)。
+# MAX_CANDIDATES 問以上の候補に1問もなかった難易度 (導入直後で問題分析がなく、easy / hard の問題が
+# ない場合など) は読み込みを打ち切る。足りない分は assemble_exam() で同じ範囲の他の難易度の問題で補う。
+# 抽選は試験ごとのシード値から作る乱数で行うので、同じシード値・出題条件・問題データなら
+# 同じ問題が同じ順番で選ばれる (シード値は exam_attempt と exam_result に保存する)。
+#
+# 出題条件 (EXAM_BLUEPRINT) は JSON のセクションのリストで、セクションごとに次の項目を指定する。
+#   count: 出題数
+#   range: 対象の問題IDの範囲 [開始, 終了] (省略すると全範囲)
+#   difficulty: 難易度ごとの出題数 {"easy": 5, "normal": 10, "hard": 5} (count の代わりに指定する)
+# 例: [{"range": [1, 100], "count": 10}, {"difficulty": {"easy": 3, "normal": 4, "hard": 3}}]
+# 省略した場合は、全範囲から EXAM_QUESTION_COUNT 問を選ぶ。
+
+DIFFICULTY_BANDS = ('easy', 'normal', 'hard')
+# 問題分析 (question_analytics) の正答率による難易度の区分。解答数が少ない問題は normal とする
+EASY_MIN_ACCURACY = 0.8
+HARD_MAX_ACCURACY = 0.5
+MIN_RATED_ATTEMPTS = 10
+SEED_BITS = 63
+# 1回のクエリで確かめる候補の最大数と、候補を増やして繰り返す回数
+MAX_CANDIDATES = 2000
+MAX_ROUNDS = 4
+# 候補の数は、これまでの当たりの割合から見積もった必要数のこの倍にする
+OVERSAMPLE = 1.5
+# 候補で足りなかったときに、範囲内から連続して読み込む問題の最大数
+FALLBACK_SCAN_LIMIT = 2000
+
+BlueprintSection = namedtuple('BlueprintSection', ['count', 'range', 'difficulty'])
+
+
+@dataclass(frozen=True, slots=True)
+class ExamPlan:
+    """抽選した試験の問題 (出題順) と、再現に使うシード値・出題条件。"""
+    question_ids: list
+    seed: int
+    blueprint: list
+    requested_count: int
+
+    @property
+    def is_short(self):
+        return len(self.question_ids) < self.requested_count
+
+
+def difficulty_band(attempts, correct_count):
+    if not attempts or attempts < MIN_RATED_ATTEMPTS:
+        return 'normal'
+    accuracy = correct_count / attempts
+    if accuracy >= EASY_MIN_ACCURACY:
+        return 'easy'
+    if accuracy < HARD_MAX_ACCURACY:
+        return 'hard'
+    return 'normal'
+
+
+def _positive_int(value, name):
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError(f'EXAM_BLUEPRINT: {name} must be a non-negative integer: {value!r}')
+    return value
+
+
+def parse_blueprint(value, default_count):
+    """出題条件 (JSON 文字列またはリスト) を検証し、BlueprintSection のリストを返します。
+
+    value が空なら、全範囲から default_count 問を選ぶ条件を返す。不正な値なら ValueError。
+    """
+    if not value:
+        return [BlueprintSection(default_count, None, None)]
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'EXAM_BLUEPRINT is not valid JSON: {e}') from e
+    if not isinstance(value, list) or not value:
+        raise ValueError('EXAM_BLUEPRINT must be a non-empty list of sections')
+
+    sections = []
+    for section in value:
+        if not isinstance(section, dict) or set(section) - {'count', 'range', 'difficulty'}:
+            raise ValueError(f'EXAM_BLUEPRINT: invalid section: {section!r}')
+        id_range = section.get('range')
+        if id_range is not None:
+            if not isinstance(id_range, list) or len(id_range) != 2:
+                raise ValueError(f'EXAM_BLUEPRINT: range must be [start, end]: {id_range!r}')
+            id_range = [_positive_int(id_range[0], 'range'), _positive_int(id_range[1], 'range')]
+            if id_range[0] > id_range[1]:
+                raise ValueError(f'EXAM_BLUEPRINT: range start is after its end: {id_range!r}')
+        difficulty = section.get('difficulty')
+        if difficulty is not None:
+            if 'count' in section:
+                raise ValueError('EXAM_BLUEPRINT: specify either count or difficulty in a section')
+            if not isinstance(difficulty, dict) or not difficulty or set(difficulty) - set(DIFFICULTY_BANDS):
+                raise ValueError(f'EXAM_BLUEPRINT: difficulty must map {DIFFICULTY_BANDS} to counts: {difficulty!r}')
+            difficulty = {band: _positive_int(difficulty[band], band)
+                          for band in DIFFICULTY_BANDS if band in difficulty}
+            count = sum(difficulty.values())
+        else:
+            count = _positive_int(section.get('count'), 'count')
+        sections.append(BlueprintSection(count, id_range, difficulty))
+    return sections
+
+
+def get_blueprint():
+    """アプリケーションの設定 (EXAM_BLUEPRINT, EXAM_QUESTION_COUNT) の出題条件を返します。"""
+    return parse_blueprint(current_app.config.get('EXAM_BLUEPRINT'), current_app.config['EXAM_QUESTION_COUNT'])
+
+
+def blueprint_question_count(blueprint=None):
+    if blueprint is None:
+        blueprint = get_blueprint()
+    return sum(section.count for section in blueprint)
+
+
+def blueprint_to_json(blueprint):
+    """出題条件を、保存用の (parse_blueprint() で読み直せる) リストに変換します。"""
+    sections = []
+    for section in blueprint:
+        item = {'difficulty': section.difficulty} if section.difficulty is not None else {'count': section.count}
+        if section.range is not None:
+            item['range'] = list(section.range)
+        sections.append(item)
+    return sections
+
+
+def _id_bounds(id_range):
+    """ID範囲 (None なら全範囲) の中にある問題IDの最小値・最大値を返します。問題がなければ None。"""
+    def bound(aggregate):
+        # min と max を別々のサブクエリにする (SQLite は集計関数が1つのときだけ主キーの端を直接読む)
+        query = db.select(aggregate(Question.id))
+        if id_range is not None:
+            query = query.where(Question.id.between(*id_range))
+        return query.scalar_subquery()
+
+    lo, hi = db.session.query(bound(func.min), bound(func.max)).one()
+    return None if lo is None else (lo, hi)
+
+
+def _classify(with_difficulty, question_ids=None, bounds=None, limit=None):
+    """候補のID (または範囲内の問題を ID 順に最大 limit 問) のうち実在するものを、{問題ID: 難易度} で返します。
+
+    with_difficulty でなければ難易度は None。
+    """
+    if with_difficulty:
+        query = db.session.query(Question.id, QuestionAnalytics.attempts, QuestionAnalytics.correct_count) \
+                          .outerjoin(QuestionAnalytics, QuestionAnalytics.question_id == Question.id)
+    else:
+        query = db.session.query(Question.id)
+    if question_ids is not None:
+        query = query.filter(Question.id.in_(question_ids))
+    else:
+        query = query.filter(Question.id.between(*bounds)).order_by(Question.id).limit(limit)
+    if not with_difficulty:
+        return {question_id: None for (question_id,) in query}
+    return {question_id: difficulty_band(attempts, correct_count) for question_id, attempts, correct_count in query}
+
+
+def _scan_block(rng, with_difficulty, lo, hi):
+    """範囲内の乱数で選んだ位置から、ID 順に最大 FALLBACK_SCAN_LIMIT 問を読み込みます (末尾に達したら先頭から)。"""
+    start = rng.randint(lo, hi)
+    found = _classify(with_difficulty, bounds=(start, hi), limit=FALLBACK_SCAN_LIMIT)
+    if len(found) < FALLBACK_SCAN_LIMIT and start > lo:
+        found.update(_classify(with_difficulty, bounds=(lo, start - 1), limit=FALLBACK_SCAN_LIMIT - len(found)))
+    return found
+
+
+def _take(candidates, found, needs, chosen, picked):
+    """候補を抽選した順に見て、needs の残りがある区分の問題を picked に加えます。"""
+    for question_id in candidates:
+        band = found.get(question_id, False)
+        if band is False or question_id in chosen or not needs.get(band):
+            continue
+        chosen.add(question_id)
+        picked.append(question_id)
+        needs[band] -= 1
+
+
+def _sample_section(rng, id_range, needs, chosen):
+    """ID範囲から、区分ごとに needs {難易度 or None: 出題数} の問題を選びます (選んだ問題は chosen に追加)。"""
+    needs = {band: count for band, count in needs.items() if count > 0}
+    if not needs:
+        return []
+    bounds = _id_bounds(id_range)
+    if bounds is None:
+        return []
+    lo, hi = bounds
+    with_difficulty = None not in needs
+    picked = []
+    tried = set()
+    hits = dict.fromkeys(needs, 0)
+    for _ in range(MAX_ROUNDS):
+        remaining = {band: count for band, count in needs.items() if count > 0}
+        untried = hi - lo + 1 - len(tried)
+        if not remaining or untried <= 0:
+            return picked
+        # 区分ごとに、これまでの当たりの割合から必要な候補数を見積もり、いちばん多い区分に合わせる
+        size = min(MAX_CANDIDATES, max(math.ceil(count * (len(tried) + 1) / (hits[band] + 1) * OVERSAMPLE)
+                                       for band, count in remaining.items()) + len(chosen))
+        if size >= untried:
+            candidates = [question_id for question_id in range(lo, hi + 1) if question_id not in tried]
+            rng.shuffle(candidates)
+        else:
+            candidates = [question_id for question_id in rng.sample(range(lo, hi + 1), size)
+                          if question_id not in tried]
+        tried.update(candidates)
+        found = _classify(with_difficulty, question_ids=candidates)
+        for band in found.values():
+            if band in hits:
+                hits[band] += 1
+        _take(candidates, found, needs, chosen, picked)
+        if len(tried) >= MAX_CANDIDATES and not any(hits[band] for band, count in needs.items() if count > 0):
+            # 候補を MAX_CANDIDATES 問以上確かめても残りの区分の問題が1問もない (問題分析がない難易度など) ので、
+            # 読み込みを増やさずに、足りない分は呼び出し側の補充に任せる
+            return picked
+
+    if any(count > 0 for count in needs.values()) and hi - lo + 1 > len(tried):
+        # 候補では足りなかった (条件に合う問題が少ない) ので、範囲内の一部を連続して読み込んで選ぶ
+        found = _scan_block(rng, with_difficulty, lo, hi)
+        candidates = [question_id for question_id in found if question_id not in tried]
+        rng.shuffle(candidates)
+        _take(candidates, found, needs, chosen, picked)
+    return picked
+
+
+def assemble_exam(blueprint=None, seed=None):
+    """出題条件に沿って試験の問題を抽選し、ExamPlan を返します。
+
+    seed を省略すると新しいシード値を作る。条件に合う問題が足りないセクションは、あるだけ出題する
+    (難易度の指定がある場合は、足りない分を同じ範囲の他の難易度の問題で補う)。
+    """
+    if blueprint is None:
+        blueprint = get_blueprint()
+    if seed is None:
+        seed = secrets.randbits(SEED_BITS)
+    rng = random.Random(seed)
+
+    question_ids = []
+    chosen = set()
+    for section in blueprint:
+        needs = section.difficulty if section.difficulty is not None else {None: section.count}
+        picked = _sample_section(rng, section.range, needs, chosen)
+        if section.difficulty is not None and len(picked) < section.count:
+            picked += _sample_section(rng, section.range, {None: section.count - len(picked)}, chosen)
+        question_ids.extend(picked)
+    rng.shuffle(question_ids)
+
+    return ExamPlan(question_ids, seed, blueprint_to_json(blueprint), blueprint_question_count(blueprint))
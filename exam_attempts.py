@@ -0,0 +1,93 @@
+import datetime
+
+from flask import current_app
+
+from db_utils import upsert
+from exam_scoring import score_exam
+from models import db, ExamAttempt, ExamAnswer
+
+# 進行中の試験の保存
+# 出題する問題と期限は exam_attempt に、解答は exam_answer に問題ごとの1行として保存する。
+# 解答のたびに更新するのはその問題の1行だけで、セッションには何も保存しないため、Cookie を失っても
+# 別のワーカー・サーバーに振り分けられても、ログインし直せば同じ試験を続けられる。
+# 期限は開始時刻と EXAM_TIME_LIMIT_MINUTES から計算し、期限を過ぎた解答はサーバー側で受け付けない。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+DEFAULT_TIME_LIMIT_MINUTES = 20
+# 通信の遅れを見込んで、期限からこの秒数までに届いた解答は受け付ける
+DEADLINE_GRACE_SECONDS = 5
+
+
+def _time_limit():
+    return datetime.timedelta(minutes=current_app.config.get('EXAM_TIME_LIMIT_MINUTES', DEFAULT_TIME_LIMIT_MINUTES))
+
+
+def start_attempt(user_id, question_ids, proctored=False, seed=None, blueprint=None):
+    """新しい試験を作成します。ユーザーの途中の試験は削除します。
+
+    seed と blueprint には、問題を抽選したときのシード値と出題条件 (exam_assembly.ExamPlan) を渡す。
+    """
+    discard_attempts(user_id)
+    started_at = datetime.datetime.utcnow()
+    attempt = ExamAttempt(
+        user_id=user_id,
+        question_ids=list(question_ids),
+        proctored=proctored,
+        seed=seed,
+        blueprint=blueprint,
+        started_at=started_at,
+        deadline=started_at + _time_limit(),
+    )
+    db.session.add(attempt)
+    db.session.flush()
+    return attempt
+
+
+def get_active_attempt(user_id):
+    """ユーザーの進行中の試験を返します。なければ None。"""
+    return ExamAttempt.query.filter_by(user_id=user_id).order_by(ExamAttempt.id.desc()).first()
+
+
+def discard_attempts(user_id):
+    """ユーザーの試験と解答を削除します。"""
+    attempt_ids = db.session.query(ExamAttempt.id).filter(ExamAttempt.user_id == user_id)
+    ExamAnswer.query.filter(ExamAnswer.attempt_id.in_(attempt_ids.scalar_subquery())).delete(synchronize_session=False)
+    ExamAttempt.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def is_expired(attempt, now=None):
+    now = now or datetime.datetime.utcnow()
+    return now > attempt.deadline + datetime.timedelta(seconds=DEADLINE_GRACE_SECONDS)
+
+
+def remaining_seconds(attempt, now=None):
+    now = now or datetime.datetime.utcnow()
+    return max(0, int((attempt.deadline - now).total_seconds()))
+
+
+def record_answer(attempt, question_id, selected_options):
+    """解答を保存します (同じ問題に解答し直した場合は上書き)。試験に含まれない問題なら False を返します。"""
+    if question_id not in attempt.question_ids:
+        return False
+    db.session.execute(upsert(
+        ExamAnswer.__table__,
+        index_elements=['attempt_id', 'question_id'],
+        set_=lambda excluded: {
+            'selected_options': excluded.selected_options,
+            'answered_at': excluded.answered_at,
+        },
+    ), {'attempt_id': attempt.id, 'question_id': question_id,
+        'selected_options': list(selected_options), 'answered_at': datetime.datetime.utcnow()})
+    return True
+
+
+def get_answers(attempt):
+    """試験の解答を {str(question_id): [選択肢, ...]} で返します (クエリ1回)。"""
+    rows = db.session.query(ExamAnswer.question_id, ExamAnswer.selected_options) \
+                     .filter(ExamAnswer.attempt_id == attempt.id)
+    return {str(question_id): selected_options for question_id, selected_options in rows}
+
+
+def score_attempt(attempt):
+    """保存済みの解答で採点し、(score, results_detail) を返します。"""
+    return score_exam(attempt.question_ids, get_answers(attempt))
@@ -0,0 +1,65 @@
+from collections import namedtuple
+
+from sqlalchemy import case, func
+
+from models import db, ExamResult, ExamResultItem
+from question_cache import get_questions
+
+# 本番試験の結果の保存と集計
+# 試験結果1件ごとに問題文・解説まで JSON で複製して保存するのではなく、問題ごとの解答と正誤だけを
+# exam_result_item に1行ずつ保存する。問題文などは表示時に問題キャッシュから取得し、問題ごとの
+# 正答率は exam_result_item の集計 (GROUP BY) で求める。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+DIFFICULT_QUESTIONS_LIMIT = 10
+
+ExamResultDetail = namedtuple('ExamResultDetail',
+                              ['position', 'question_id', 'question', 'user_answer', 'is_correct'])
+QuestionDifficulty = namedtuple('QuestionDifficulty',
+                                ['question_id', 'question', 'attempts', 'correct_count', 'accuracy'])
+
+
+def save_exam_result(user_id, score, results_detail, seed=None, blueprint=None):
+    """採点結果 (score_exam() の戻り値) を保存し、ExamResult を返します。
+
+    seed と blueprint は出題の再現用 (試験を開始したときのシード値と出題条件)。
+    """
+    result = ExamResult(user_id=user_id, score=score, total_questions=len(results_detail),
+                        seed=seed, blueprint=blueprint)
+    db.session.add(result)
+    db.session.flush()
+    if results_detail:
+        db.session.execute(ExamResultItem.__table__.insert(), [
+            {'exam_result_id': result.id, 'position': position, 'question_id': detail['question_id'],
+             'user_answer': list(detail['user_answer']), 'is_correct': detail['is_correct']}
+            for position, detail in enumerate(results_detail)
+        ])
+    return result
+
+
+def get_result_details(result_id):
+    """試験結果の問題ごとの結果を出題順に返します (items は ExamResultDetail)。
+
+    問題は問題キャッシュから取得し、削除された問題の question は None になる。
+    """
+    items = ExamResultItem.query.filter_by(exam_result_id=result_id) \
+                                .order_by(ExamResultItem.position).all()
+    questions = get_questions([item.question_id for item in items])
+    return [ExamResultDetail(item.position, item.question_id, questions.get(item.question_id),
+                             item.user_answer or [], item.is_correct)
+            for item in items]
+
+
+def question_difficulty(limit=DIFFICULT_QUESTIONS_LIMIT, min_attempts=1):
+    """本番試験での正答率が低い問題から順に返します (items は QuestionDifficulty)。"""
+    attempts = func.count().label('attempts')
+    correct_count = func.sum(case((ExamResultItem.is_correct == True, 1), else_=0)).label('correct_count')
+    rows = db.session.query(ExamResultItem.question_id, attempts, correct_count) \
+                     .group_by(ExamResultItem.question_id) \
+                     .having(attempts >= min_attempts) \
+                     .order_by((correct_count * 1.0 / attempts).asc(), attempts.desc(), ExamResultItem.question_id) \
+                     .limit(limit).all()
+    questions = get_questions([row.question_id for row in rows])
+    return [QuestionDifficulty(row.question_id, questions.get(row.question_id), row.attempts,
+                               row.correct_count, row.correct_count / row.attempts * 100)
+            for row in rows]
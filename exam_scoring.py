@@ -0,0 +1,34 @@
+from question_cache import get_questions
+
+
+def score_exam(question_ids, answers_map):
+    """試験の解答をまとめて採点します。
+
+    問題は get_questions() で一括取得するため、問題数に関係なくDBへの問い合わせは
+    最大1回 (キャッシュ済みなら0回) です。answers_map は {str(question_id): [選択肢, ...]}。
+    戻り値は (score, results_detail)。存在しなくなった問題は採点対象から除外します。
+    """
+    questions = get_questions(question_ids)
+
+    score = 0
+    results_detail = []
+    for q_id in question_ids:
+        question = questions.get(q_id)
+        if question is None:
+            continue
+
+        user_answer = answers_map.get(str(q_id), [])
+        is_correct = question.is_correct(user_answer)
+        if is_correct:
+            score += 1
+
+        results_detail.append({
+            'question_id': q_id,
+            'question_text': question.question_text,
+            'image_filename': question.image_filename,
+            'user_answer': user_answer,
+            'correct_answer': list(question.correct_answer),
+            'explanation': question.explanation,
+            'is_correct': is_correct
+        })
+    return score, results_detail
@@ -0,0 +1,23 @@
+# Gunicorn の設定ファイル (start.sh の `gunicorn app:app` が自動的に読み込む)
+
+
+def post_worker_init(worker):
+    # 各ワーカーの起動時に問題データをまとめて読み込み、最初のリクエストからキャッシュを使う
+    from app import app, mail_queue
+    from question_cache import warm_question_cache
+
+    with app.app_context():
+        count = warm_question_cache()
+    worker.log.info("Question cache warmed with %d questions", count)
+
+    # 再起動前に送れなかったメールが残っていれば、すぐに送信を再開する
+    mail_queue.wake()
+
+
+def worker_exit(server, worker):
+    # バッファに残っている解答 (ANSWER_WRITE_MODE=batched) を書き込んでから終了する
+    from app import answer_buffer
+
+    count = answer_buffer.close()
+    if count:
+        worker.log.info("Flushed %d buffered answers on exit", count)
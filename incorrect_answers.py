@@ -0,0 +1,69 @@
+import json
+from collections import namedtuple
+
+from sqlalchemy import func, select
+
+from models import db, UserAnswer
+from question_cache import QuestionRecord
+
+# 「間違えた問題の振り返り」用の、問題ごとの最新の不正解の解答
+# 不正解の解答履歴を全件読み込んで Python で重複を除くのではなく、問題ごとに最新の1件だけを
+# SQL で選び (PostgreSQL は DISTINCT ON、SQLite は MAX() の GROUP BY、それ以外はウィンドウ関数)、
+# 問題と結合して1ページ分だけ読み込む。
+
+REVIEW_PAGE_SIZE = 20
+
+IncorrectReviewItem = namedtuple('IncorrectReviewItem',
+                                 ['question', 'user_selected_option', 'correct_answer_display', 'answered_at'])
+
+
+def latest_incorrect_answer_ids(user_id):
+    """問題ごとに最新の不正解の解答の id を選ぶ SELECT を返します。"""
+    incorrect = (UserAnswer.user_id == user_id, UserAnswer.is_correct == False)
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return select(UserAnswer.id).where(*incorrect) \
+            .distinct(UserAnswer.question_id) \
+            .order_by(UserAnswer.question_id, UserAnswer.timestamp.desc(), UserAnswer.id.desc())
+    if dialect == 'sqlite':
+        # SQLite では MAX() と一緒に選んだ列は最大値の行の値になるため、GROUP BY だけで済む
+        # (ウィンドウ関数より速く、ウィンドウ関数のない古い SQLite でも動く)
+        latest = select(UserAnswer.id, func.max(UserAnswer.timestamp)) \
+            .where(*incorrect).group_by(UserAnswer.question_id).subquery()
+        return select(latest.c.id)
+    ranked = select(
+        UserAnswer.id,
+        func.row_number().over(
+            partition_by=UserAnswer.question_id,
+            order_by=(UserAnswer.timestamp.desc(), UserAnswer.id.desc()),
+        ).label('answer_rank'),
+    ).where(*incorrect).subquery()
+    return select(ranked.c.id).where(ranked.c.answer_rank == 1)
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def _to_item(answer):
+    question = QuestionRecord.from_row(answer.question_detail)
+    return IncorrectReviewItem(
+        question=question,
+        user_selected_option=" & ".join(map(str, _as_list(answer.user_selected_option))),
+        correct_answer_display=question.correct_answer_display,
+        answered_at=answer.timestamp,
+    )
+
+
+def paginate_latest_incorrect(user_id, page, per_page=REVIEW_PAGE_SIZE):
+    """問題ごとの最新の不正解を新しい順にページ分けして返します (items は IncorrectReviewItem)。"""
+    statement = select(UserAnswer) \
+        .join(UserAnswer.question_detail) \
+        .options(db.contains_eager(UserAnswer.question_detail)) \
+        .where(UserAnswer.id.in_(latest_incorrect_answer_ids(user_id))) \
+        .order_by(UserAnswer.timestamp.desc(), UserAnswer.id.desc())
+    pagination = db.paginate(statement, page=page, per_page=per_page, error_out=False)
+    pagination.items = [_to_item(answer) for answer in pagination.items]
+    return pagination
@@ -0,0 +1,150 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from flask import current_app
+from itsdangerous import BadData, URLSafeSerializer
+from sqlalchemy import tuple_
+
+# OFFSET を使わないページ分割 (キーセット方式)
+# 一覧を並び順の列 (例: submitted_at, id) の降順に並べ、前のページの最後の行の値より小さい行を
+# LIMIT 件だけ読む。OFFSET のように読み飛ばす行がないので、何ページ目でも同じ速さで返せ、
+# 途中で行が追加・削除されてもページの境目で行が重複したり抜けたりしない。
+# 並び順の列の組は一意になるように、最後に主キーを入れること (NULL になる列は使えない)。
+# ページの位置はカーソル (最後・最初の行の値を署名したトークン) で受け渡す。改ざん・破損したカーソルや
+# 並び順の列が合わないカーソルは無視して最初のページを返す。
+# 件数は毎回 COUNT(*) すると OFFSET と同じく件数に比例して遅くなるので、必要な一覧だけ
+# cached_count() で KEYSET_COUNT_CACHE_TTL 秒キャッシュした概数を表示する。
+
+CURSOR_SALT = 'keyset-cursor'
+MAX_CACHED_COUNTS = 1000
+
+_lock = threading.Lock()
+_counts = OrderedDict()  # {key: (counted_at, count)}
+
+
+@dataclass(frozen=True, slots=True)
+class KeysetPage:
+    """1ページ分の行と、前後のページのカーソル (なければ None)。total は概数 (数えない場合は None)。"""
+    items: list
+    next_cursor: str = None
+    prev_cursor: str = None
+    total: int = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt=CURSOR_SALT)
+
+
+def _dump_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _load_value(value, column):
+    if value is None:
+        raise ValueError('keyset cursor value is null')
+    python_type = column.type.python_type
+    if python_type in (datetime.datetime, datetime.date):
+        return python_type.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_cursor(values, backward=False):
+    return _serializer().dumps(['p' if backward else 'n', [_dump_value(value) for value in values]])
+
+
+def decode_cursor(cursor, keys):
+    """カーソルを (前のページへ戻るか, 並び順の列の値のタプル) に戻します。不正なカーソルなら None。"""
+    if not cursor:
+        return None
+    try:
+        direction, values = _serializer().loads(cursor)
+        if direction not in ('n', 'p') or len(values) != len(keys):
+            return None
+        return direction == 'p', tuple(_load_value(value, key) for value, key in zip(values, keys))
+    except (BadData, TypeError, ValueError, NotImplementedError):
+        return None
+
+
+def _key_values(row, keys):
+    return tuple(getattr(row, key.key) for key in keys)
+
+
+def paginate_keyset(query, keys, cursor=None, per_page=20, total=None):
+    """query (並び順を指定していない Query) を keys の降順に並べ、cursor の位置の1ページを KeysetPage で返します。
+
+    keys は並び順の列のリスト (例: [ExamResult.submitted_at, ExamResult.id])。行の属性名は列名と同じであること。
+    前のページへ戻るときは逆順に読んで並べ直す。カーソルの先に行がない場合や、戻った先が削除などで
+    1ページに満たない場合は、最初のページを返す。
+    """
+    position = decode_cursor(cursor, keys)
+    backward = position is not None and position[0]
+    page_query = query
+    if position is not None:
+        values = position[1]
+        page_query = page_query.filter(tuple_(*keys) > values if backward else tuple_(*keys) < values)
+    rows = page_query.order_by(*[key.asc() if backward else key.desc() for key in keys]) \
+                     .limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if position is not None and not rows:
+        # カーソルの先の行がすべて削除された場合など
+        return paginate_keyset(query, keys, per_page=per_page, total=total)
+    if backward:
+        if not has_more and len(rows) < per_page:
+            return paginate_keyset(query, keys, per_page=per_page, total=total)
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = position is not None, has_more
+
+    return KeysetPage(
+        items=rows,
+        next_cursor=encode_cursor(_key_values(rows[-1], keys)) if has_next and rows else None,
+        prev_cursor=encode_cursor(_key_values(rows[0], keys), backward=True) if has_prev and rows else None,
+        total=total,
+    )
+
+
+def cached_count(key, count_query):
+    """count_query (Query) の件数を KEYSET_COUNT_CACHE_TTL 秒キャッシュして返します (表示用の概数)。
+
+    TTL が 0 なら毎回数える。キャッシュはプロセスごとなので、行の追加・削除はワーカーごとに TTL 以内に反映される。
+    """
+    ttl = current_app.config.get('KEYSET_COUNT_CACHE_TTL', 60)
+    if ttl:
+        with _lock:
+            entry = _counts.get(key)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                _counts.move_to_end(key)
+                return entry[1]
+
+    count = count_query.order_by(None).count()
+    with _lock:
+        _counts[key] = (time.monotonic(), count)
+        _counts.move_to_end(key)
+        while len(_counts) > MAX_CACHED_COUNTS:
+            _counts.popitem(last=False)
+    return count
+
+
+def invalidate_count(key=None):
+    """キャッシュした件数を破棄します (key を省略すると全件)。このプロセスのキャッシュだけが対象。"""
+    with _lock:
+        if key is None:
+            _counts.clear()
+        else:
+            _counts.pop(key, None)
@@ -0,0 +1,137 @@
+import datetime
+import threading
+import time
+from collections import Counter, namedtuple
+
+import pytz
+from flask import current_app
+from sqlalchemy import Date, cast, func, text
+
+from db_utils import upsert
+from models import db, User, UserAnswer, UserDailyAnswerCount
+
+# ランキング用の解答数集計
+# 解答のたびに「ユーザー×JSTの日付」のカウンタを加算し、日間・週間・月間ランキングは
+# 数日分 (最大31日分) のカウンタの合計として求める。集計結果は RANKING_CACHE_TTL 秒だけ
+# キャッシュするが、ランキング非表示・管理者の除外は毎回 user テーブルを見て判定する。
+
+JST = pytz.timezone('Asia/Tokyo')
+RANKING_LIMIT = 100
+# 除外されるユーザーを見越して、user テーブルへはこの件数ずつ問い合わせる
+_CANDIDATE_CHUNK = 200
+
+RankingEntry = namedtuple('RankingEntry', ['username', 'answer_count'])
+
+_lock = threading.Lock()
+_totals_cache = {}  # {(period, start_day): (built_at, [(user_id, answer_count), ...])}
+
+
+def to_jst_date(utc_dt):
+    """naive な UTC の日時を JST の日付に変換します。"""
+    return utc_dt.replace(tzinfo=pytz.utc).astimezone(JST).date()
+
+
+def record_answer(user_id, answered_at):
+    """解答1件をその日 (JST) のカウンタに加算します。コミットは呼び出し側で行います。"""
+    record_answers([(user_id, answered_at)])
+
+
+def record_answers(answers):
+    """解答 [(user_id, answered_at), ...] を、ユーザー×日付ごとにまとめてカウンタに加算します。"""
+    counts = Counter((user_id, to_jst_date(answered_at)) for user_id, answered_at in answers)
+    if not counts:
+        return
+    table = UserDailyAnswerCount.__table__
+    db.session.execute(upsert(
+        table,
+        index_elements=['user_id', 'day'],
+        set_=lambda excluded: {'answer_count': table.c.answer_count + excluded.answer_count},
+    ), [{'user_id': user_id, 'day': day, 'answer_count': count} for (user_id, day), count in counts.items()])
+
+
+def reset_user(user_id):
+    UserDailyAnswerCount.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def reset_all():
+    UserDailyAnswerCount.query.delete(synchronize_session=False)
+
+
+def invalidate_ranking_cache():
+    with _lock:
+        _totals_cache.clear()
+
+
+def period_window(period, now=None):
+    """集計期間から (period, 開始日(JST), タイトル) を返します。未知の期間は週間として扱います。"""
+    today = (now or datetime.datetime.now(pytz.utc)).astimezone(JST).date()
+    if period == 'daily':
+        return period, today, '日間ランキング (解答数)'
+    if period == 'monthly':
+        return period, today.replace(day=1), '月間ランキング (解答数)'
+    # 週間は今日を含む直近7日間 (JST)
+    return 'weekly', today - datetime.timedelta(days=6), '週間ランキング (解答数)'
+
+
+def _load_totals(start_day):
+    total = func.sum(UserDailyAnswerCount.answer_count)
+    rows = db.session.query(UserDailyAnswerCount.user_id, total) \
+                     .filter(UserDailyAnswerCount.day >= start_day) \
+                     .group_by(UserDailyAnswerCount.user_id) \
+                     .order_by(total.desc(), UserDailyAnswerCount.user_id).all()
+    return [(user_id, int(count)) for user_id, count in rows]
+
+
+def _get_totals(period, start_day):
+    key = (period, start_day)
+    ttl = current_app.config.get('RANKING_CACHE_TTL', 30)
+    entry = _totals_cache.get(key)
+    if entry is not None and time.monotonic() - entry[0] < ttl:
+        return entry[1]
+
+    totals = _load_totals(start_day)
+    with _lock:
+        # 日付が変わった後の古い期間のキャッシュはここで捨てる
+        for stale_key in [k for k in _totals_cache if k[0] == period and k != key]:
+            del _totals_cache[stale_key]
+        _totals_cache[key] = (time.monotonic(), totals)
+    return totals
+
+
+def get_ranking(period, start_day, limit=RANKING_LIMIT):
+    """ランキング上位 limit 件を RankingEntry のリストで返します。"""
+    totals = _get_totals(period, start_day)
+
+    ranking = []
+    for offset in range(0, len(totals), _CANDIDATE_CHUNK):
+        chunk = totals[offset:offset + _CANDIDATE_CHUNK]
+        visible = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_([user_id for user_id, _ in chunk]),
+            User.is_admin == False,
+            User.show_in_ranking == True
+        ).all())
+        for user_id, answer_count in chunk:
+            if user_id in visible:
+                ranking.append(RankingEntry(visible[user_id], answer_count))
+                if len(ranking) >= limit:
+                    return ranking
+    return ranking
+
+
+def _jst_date_expr(column):
+    # 日本には夏時間がないため、UTC に9時間足した日付を JST の日付とする
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return func.date(column, '+9 hours')
+    return cast(column + text("INTERVAL '9 hours'"), Date)
+
+
+def rebuild_leaderboard():
+    """user_answer の全履歴から日別カウンタを作り直します。"""
+    UserDailyAnswerCount.query.delete(synchronize_session=False)
+    day = _jst_date_expr(UserAnswer.timestamp)
+    rows = db.session.query(UserAnswer.user_id, day, func.count(UserAnswer.id)) \
+                     .filter(UserAnswer.timestamp.isnot(None)) \
+                     .group_by(UserAnswer.user_id, day)
+    db.session.execute(UserDailyAnswerCount.__table__.insert().from_select(
+        ['user_id', 'day', 'answer_count'], rows))
+    invalidate_ranking_cache()
@@ -0,0 +1,240 @@
+import datetime
+import os
+import random
+import smtplib
+import threading
+
+from flask_mail import Message
+from sqlalchemy import and_, func, or_, update
+
+from models import db, MailOutbox
+
+# メール送信キュー
+# send_email() はメールを mail_outbox テーブルに追加するだけで、実際の送信は MAIL_WORKERS 個の
+# ワーカースレッドが行う。ワーカーは送信待ちのメールを最大 MAIL_BATCH_SIZE 通ずつ取り出し、
+# 1本の SMTP 接続でまとめて送る。送信に失敗したメールは間隔を倍々に延ばしながら再試行し、
+# MAIL_MAX_ATTEMPTS 回失敗したら 'failed' として残す。
+# テーブルに保存してから送るので、プロセスが再起動しても未送信のメールは失われない。
+
+DEFAULT_WORKERS = 2
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 30  # 1回目の再試行までの秒数 (以降は倍々に延ばす)
+MAX_RETRY_DELAY = 3600
+POLL_INTERVAL = 10  # 新しいメールの通知がなくても、この秒数ごとに再試行待ちのメールを確認する
+# 'sending' のままこの秒数が過ぎたメールは、ワーカーが途中で止まったとみなして再び送信する
+CLAIM_TIMEOUT = 300
+
+SMTP_ERRORS = (smtplib.SMTPException, OSError)
+# 接続が切れたことを示すエラー。送信中だったメール以外は、メール自体の問題ではないので試行回数に数えない
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, OSError)
+
+
+class MailQueue:
+    """mail_outbox テーブルを使ったメール送信キューと、送信用のワーカースレッド。"""
+
+    def __init__(self, app=None, mail=None):
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self.sent_total = 0
+        self.retried_total = 0
+        self.failed_total = 0
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        self.app = app
+        self.mail = mail
+        app.extensions['mail_queue'] = self
+
+    @property
+    def workers(self):
+        return self.app.config.get('MAIL_WORKERS', DEFAULT_WORKERS)
+
+    @property
+    def batch_size(self):
+        return self.app.config.get('MAIL_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    @property
+    def max_attempts(self):
+        return self.app.config.get('MAIL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+
+    @property
+    def retry_delay(self):
+        return self.app.config.get('MAIL_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+
+    def enqueue(self, to, subject, html):
+        """メールを送信待ちに追加します。コミットは呼び出し側で行い、その後 wake() を呼ぶこと。"""
+        message = MailOutbox(recipient=to, subject=subject, html=html, status='pending',
+                             attempts=0, next_attempt_at=datetime.datetime.utcnow())
+        db.session.add(message)
+        return message
+
+    def wake(self):
+        """ワーカーを (必要なら起動して) 起こし、送信待ちのメールを送らせます。"""
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        """ワーカースレッドを起動します。fork 後の子プロセスでは新しく起動し直します。"""
+        if not self.workers:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads):
+                return
+            self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for number in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f'mail-worker-{number}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+            try:
+                while self.process_batch():
+                    pass
+            except Exception:
+                # DBに接続できないなどの場合も、ワーカーは止めずに次の確認まで待つ
+                self.app.logger.exception('Mail worker failed')
+
+    def process_batch(self):
+        """送信待ちのメールを最大 batch_size 通取り出して送信し、取り出した件数を返します。"""
+        with self.app.app_context():
+            messages = self._claim()
+            if messages:
+                self._deliver(messages)
+            return len(messages)
+
+    def drain(self):
+        """送信時刻になっているメールがなくなるまで、このスレッドで送信します (CLI用)。"""
+        total = 0
+        while True:
+            count = self.process_batch()
+            if not count:
+                return total
+            total += count
+
+    def _claimable(self, now):
+        return or_(
+            and_(MailOutbox.status == 'pending', MailOutbox.next_attempt_at <= now),
+            and_(MailOutbox.status == 'sending',
+                 MailOutbox.claimed_at < now - datetime.timedelta(seconds=CLAIM_TIMEOUT)),
+        )
+
+    def _claim(self):
+        # 複数のワーカー・プロセスが同じメールを送らないよう、status を条件にした UPDATE で1通ずつ確保する
+        now = datetime.datetime.utcnow()
+        candidate_ids = [message_id for (message_id,) in db.session.query(MailOutbox.id)
+                         .filter(self._claimable(now))
+                         .order_by(MailOutbox.next_attempt_at, MailOutbox.id)
+                         .limit(self.batch_size)]
+        claimed_ids = []
+        for message_id in candidate_ids:
+            result = db.session.execute(
+                update(MailOutbox)
+                .where(MailOutbox.id == message_id, self._claimable(now))
+                .values(status='sending', claimed_at=now)
+            )
+            if result.rowcount == 1:
+                claimed_ids.append(message_id)
+        db.session.commit()
+        if not claimed_ids:
+            return []
+        return MailOutbox.query.filter(MailOutbox.id.in_(claimed_ids)).order_by(MailOutbox.id).all()
+
+    def _deliver(self, messages):
+        remaining = list(messages)
+        sent = 0
+        try:
+            with self.mail.connect() as connection:
+                while remaining:
+                    message = remaining[0]
+                    try:
+                        connection.send(Message(
+                            message.subject,
+                            recipients=[message.recipient],
+                            html=message.html,
+                            sender=self.app.config['MAIL_DEFAULT_SENDER'],
+                        ))
+                    except CONNECTION_ERRORS as e:
+                        # 途中で接続が切れたら、送信中だったメールだけを再試行に回し、残りは試行回数を
+                        # 増やさずに送信待ちに戻す (切れた接続で送り続けると、残りがすべて失敗になる)
+                        remaining.pop(0)
+                        self._schedule_retry(message, e)
+                        self._release(remaining)
+                        remaining = []
+                        break
+                    except Exception as e:
+                        self._schedule_retry(message, e)
+                    else:
+                        db.session.delete(message)
+                        sent += 1
+                    remaining.pop(0)
+        except SMTP_ERRORS as e:
+            # 接続できなかった・途中で切断された場合は、残りのメールをすべて再試行に回す
+            for message in remaining:
+                self._schedule_retry(message, e)
+        db.session.commit()
+        with self._stats_lock:
+            self.sent_total += sent
+
+    def _release(self, messages):
+        # 確保したメールを、試行回数を変えずにすぐ送信できる状態に戻す
+        now = datetime.datetime.utcnow()
+        for message in messages:
+            message.status = 'pending'
+            message.claimed_at = None
+            message.next_attempt_at = now
+
+    def _schedule_retry(self, message, error):
+        message.attempts += 1
+        message.last_error = str(error)[:1000]
+        message.claimed_at = None
+        if message.attempts >= self.max_attempts:
+            message.status = 'failed'
+            self.app.logger.error('Giving up on mail %s to %s after %d attempts: %s',
+                                  message.id, message.recipient, message.attempts, error)
+            with self._stats_lock:
+                self.failed_total += 1
+            return
+        delay = min(self.retry_delay * 2 ** (message.attempts - 1), MAX_RETRY_DELAY)
+        # 同時に失敗したメールの再試行が重ならないよう、少しずらす
+        delay *= random.uniform(0.8, 1.2)
+        message.status = 'pending'
+        message.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        self.app.logger.warning('Mail %s to %s failed (attempt %d), retrying in %ds: %s',
+                                message.id, message.recipient, message.attempts, delay, error)
+        with self._stats_lock:
+            self.retried_total += 1
+
+    def retry_failed(self):
+        """'failed' のメールを送信待ちに戻し、件数を返します。コミットは呼び出し側で行います。"""
+        return MailOutbox.query.filter_by(status='failed').update({
+            MailOutbox.status: 'pending',
+            MailOutbox.attempts: 0,
+            MailOutbox.next_attempt_at: datetime.datetime.utcnow(),
+        }, synchronize_session=False)
+
+    def get_stats(self):
+        """キューの状態を辞書で返します (件数はテーブル全体、*_total はこのプロセスでの累計)。"""
+        counts = dict(db.session.query(MailOutbox.status, func.count(MailOutbox.id))
+                      .group_by(MailOutbox.status).all())
+        oldest = db.session.query(func.min(MailOutbox.created_at)) \
+                           .filter(MailOutbox.status.in_(['pending', 'sending'])).scalar()
+        oldest_age = (datetime.datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'failed': counts.get('failed', 0),
+            'oldest_pending_seconds': oldest_age,
+            'workers_alive': sum(thread.is_alive() for thread in self._threads),
+            'sent_total': self.sent_total,
+            'retried_total': self.retried_total,
+            'failed_total': self.failed_total,
+        }
@@ -0,0 +1,128 @@
+"""Move exam_result.results_detail into per-question exam_result_item rows
+
+Revision ID: c4e8a1d7f362
+Revises: b7d2f94c1e05
+Create Date: 2026-10-18 19:05:51.207734
+
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1d7f362'
+down_revision = 'b7d2f94c1e05'
+branch_labels = None
+depends_on = None
+
+# 既存の試験結果は、この件数ずつ読み込んで変換する (全件をメモリに載せない)
+BATCH_SIZE = 500
+
+exam_result = sa.table('exam_result',
+    sa.column('id', sa.Integer),
+    sa.column('results_detail', sa.JSON),
+)
+exam_result_item = sa.table('exam_result_item',
+    sa.column('exam_result_id', sa.Integer),
+    sa.column('position', sa.Integer),
+    sa.column('question_id', sa.Integer),
+    sa.column('user_answer', sa.JSON),
+    sa.column('is_correct', sa.Boolean),
+)
+question = sa.table('question',
+    sa.column('id', sa.Integer),
+    sa.column('question_text', sa.Text),
+    sa.column('image_filename', sa.String),
+    sa.column('correct_answer', sa.JSON),
+    sa.column('explanation', sa.Text),
+)
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def _iter_batches(bind, query, key):
+    last_id = 0
+    while True:
+        rows = bind.execute(query.where(key > last_id).order_by(key).limit(BATCH_SIZE)).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    op.create_table('exam_result_item',
+    sa.Column('exam_result_id', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('question_id', sa.Integer(), nullable=False),
+    sa.Column('user_answer', sa.JSON(), nullable=False),
+    sa.Column('is_correct', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['exam_result_id'], ['exam_result.id'], ),
+    sa.PrimaryKeyConstraint('exam_result_id', 'position')
+    )
+
+    # results_detail の JSON を問題ごとの行に変換する
+    bind = op.get_bind()
+    query = sa.select(exam_result.c.id, exam_result.c.results_detail)
+    for rows in _iter_batches(bind, query, exam_result.c.id):
+        items = [
+            {'exam_result_id': result_id, 'position': position, 'question_id': int(detail['question_id']),
+             'user_answer': _as_list(detail.get('user_answer')), 'is_correct': bool(detail.get('is_correct'))}
+            for result_id, results_detail in rows
+            for position, detail in enumerate(_as_list(results_detail))
+            if detail.get('question_id') is not None
+        ]
+        if items:
+            bind.execute(exam_result_item.insert(), items)
+
+    with op.batch_alter_table('exam_result_item', schema=None) as batch_op:
+        batch_op.create_index('ix_exam_result_item_question_correct', ['question_id', 'is_correct'], unique=False)
+
+    with op.batch_alter_table('exam_result', schema=None) as batch_op:
+        batch_op.drop_column('results_detail')
+
+
+def downgrade():
+    with op.batch_alter_table('exam_result', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('results_detail', sa.JSON(), nullable=True))
+
+    # 問題ごとの行から results_detail を作り直す (問題文などは現在の問題データから取得する)
+    bind = op.get_bind()
+    query = sa.select(exam_result.c.id)
+    for rows in _iter_batches(bind, query, exam_result.c.id):
+        result_ids = [row.id for row in rows]
+        details = {result_id: [] for result_id in result_ids}
+        items = bind.execute(
+            sa.select(exam_result_item, question.c.question_text, question.c.image_filename,
+                      question.c.correct_answer, question.c.explanation)
+            .select_from(exam_result_item.outerjoin(question, question.c.id == exam_result_item.c.question_id))
+            .where(exam_result_item.c.exam_result_id.in_(result_ids))
+            .order_by(exam_result_item.c.exam_result_id, exam_result_item.c.position)
+        )
+        for item in items:
+            details[item.exam_result_id].append({
+                'question_id': item.question_id,
+                'question_text': item.question_text,
+                'image_filename': item.image_filename,
+                'user_answer': _as_list(item.user_answer),
+                'correct_answer': _as_list(item.correct_answer),
+                'explanation': item.explanation,
+                'is_correct': item.is_correct,
+            })
+        for result_id, results_detail in details.items():
+            bind.execute(exam_result.update().where(exam_result.c.id == result_id)
+                         .values(results_detail=results_detail))
+
+    with op.batch_alter_table('exam_result', schema=None) as batch_op:
+        batch_op.alter_column('results_detail', existing_type=sa.JSON(), nullable=False)
+
+    with op.batch_alter_table('exam_result_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_exam_result_item_question_correct')
+
+    op.drop_table('exam_result_item')
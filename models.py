@@ -16,6 +16,8 @@ class User(UserMixin, db.Model):
     show_in_ranking = db.Column(db.Boolean, nullable=False, default=True)
     is_confirmed = db.Column(db.Boolean, nullable=False, default=False)
     confirmed_on = db.Column(db.DateTime, nullable=True)    
+    # 学習進捗をリセットした日時 (UTC)。これより前の解答は、他のワーカーのバッファから後で届いても書き込まない
+    progress_reset_at = db.Column(db.DateTime, nullable=True)
     answers = db.relationship('UserAnswer', backref='user', lazy='dynamic')
     checks = db.relationship('UserCheck', backref='user', lazy='dynamic')
 
@@ -49,6 +51,23 @@ class Question(db.Model):
         lazy='dynamic',
         cascade='all, delete-orphan'
     )
+    user_question_stats = db.relationship(
+        'UserQuestionStats',
+        backref='question_detail',
+        lazy='dynamic',
+        cascade='all, delete-orphan'
+    )
+    review_schedules = db.relationship(
+        'ReviewSchedule',
+        backref='question_detail',
+        lazy='dynamic',
+        cascade='all, delete-orphan'
+    )
+    search_document = db.relationship(
+        'QuestionSearch',
+        uselist=False,
+        cascade='all, delete-orphan'
+    )
 
     def __repr__(self):
         return f'<Question {self.id}>'
@@ -61,6 +80,14 @@ class UserAnswer(db.Model):
     user_selected_option = db.Column(JSON, nullable=False)
     is_correct = db.Column(db.Boolean, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # マイページ・間違えた問題・ランキングなどの絞り込み条件に合わせた複合インデックス
+    __table_args__ = (
+        db.Index('ix_user_answer_user_question_timestamp', 'user_id', 'question_id', 'timestamp'),
+        # 間違えた問題の振り返り用 (問題ごとの最新の不正解を、表を読まずにインデックスだけで選ぶ)
+        db.Index('ix_user_answer_user_correct_question_timestamp', 'user_id', 'is_correct', 'question_id', 'timestamp'),
+        db.Index('ix_user_answer_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_user_answer_timestamp_user', 'timestamp', 'user_id'),
+    )
 
     def __repr__(self):
         return f'<UserAnswer {self.id} (User:{self.user_id}, Q:{self.question_id}, Correct:{self.is_correct})>'
@@ -73,7 +100,11 @@ class UserCheck(db.Model):
     check_type = db.Column(db.String(50), nullable=False)
     is_checked = db.Column(db.Boolean, default=True, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    __table_args__ = (db.UniqueConstraint('user_id', 'question_id', 'check_type', name='_user_question_check_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'question_id', 'check_type', name='_user_question_check_uc'),
+        # チェック問題の一覧・件数表示用 (user_id, check_type で絞り込み、timestamp で並び替え)
+        db.Index('ix_user_check_user_type_timestamp', 'user_id', 'check_type', 'timestamp'),
+    )
 
     def __repr__(self):
         return f'<UserCheck {self.id} (User:{self.user_id}, Q:{self.question_id}, Type:{self.check_type}, Checked:{self.is_checked})>'
@@ -85,11 +116,243 @@ class ExamResult(db.Model):
     score = db.Column(db.Integer, nullable=False)
     total_questions = db.Column(db.Integer, nullable=False)
     submitted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    # results_detail には、問題、ユーザーの解答、正解、解説などの詳細な結果をJSON形式で保存する
-    results_detail = db.Column(JSON, nullable=False)
+    # 出題の再現用 (exam_assembly.assemble_exam() のシード値と出題条件)。導入前の結果は None
+    seed = db.Column(db.BigInteger, nullable=True)
+    blueprint = db.Column(JSON, nullable=True)
+    # 問題ごとの解答と正誤は exam_result_item に保存する (問題文などは表示時に問題データから取得)
     
     # Userモデルとの関連付け
     user = db.relationship('User', backref=db.backref('exam_results', lazy='dynamic'))
 
+    __table_args__ = (
+        # 管理画面の試験結果一覧 (submitted_at, id の降順のキーセット方式のページ分割) 用
+        db.Index('ix_exam_result_submitted_at', 'submitted_at', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<ExamResult {self.id} for User {self.user_id}>'
+
+
+class ExamResultItem(db.Model):
+    """本番試験の問題ごとの結果 (試験結果×出題順ごとに1行)"""
+    __tablename__ = 'exam_result_item'
+    exam_result_id = db.Column(db.Integer, db.ForeignKey('exam_result.id'), primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)  # 出題順 (0から)
+    # 問題が削除されても結果は残すため、外部キーにはしない
+    question_id = db.Column(db.Integer, nullable=False)
+    user_answer = db.Column(JSON, nullable=False)
+    is_correct = db.Column(db.Boolean, nullable=False)
+
+    __table_args__ = (
+        # 問題ごとの正答率の集計用 (表を読まずにインデックスだけで数える)
+        db.Index('ix_exam_result_item_question_correct', 'question_id', 'is_correct'),
+    )
+
+    def __repr__(self):
+        return f'<ExamResultItem Result:{self.exam_result_id} #{self.position} Q:{self.question_id}>'
+
+class UserStats(db.Model):
+    """ユーザーごとの解答数の集計 (解答のたびに user_stats.record_answer() で更新)"""
+    __tablename__ = 'user_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    total_answered = db.Column(db.Integer, nullable=False, default=0)
+    correct_answered = db.Column(db.Integer, nullable=False, default=0)
+    last_answered_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<UserStats User:{self.user_id} ({self.correct_answered}/{self.total_answered})>'
+
+
+class UserQuestionStats(db.Model):
+    """ユーザー×問題ごとの解答数と最新の解答結果 (マイページの学習履歴用)"""
+    __tablename__ = 'user_question_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    answer_count = db.Column(db.Integer, nullable=False, default=0)
+    correct_count = db.Column(db.Integer, nullable=False, default=0)
+    last_answered_at = db.Column(db.DateTime, nullable=True)
+    last_is_correct = db.Column(db.Boolean, nullable=False)
+    __table_args__ = (
+        # マイページの学習履歴 (last_answered_at, question_id の降順のキーセット方式のページ分割) 用
+        db.Index('ix_user_question_stats_user_last_answered', 'user_id', 'last_answered_at', 'question_id'),
+    )
+
+    def __repr__(self):
+        return f'<UserQuestionStats User:{self.user_id}, Q:{self.question_id} ({self.correct_count}/{self.answer_count})>'
+
+
+class UserDailyAnswerCount(db.Model):
+    """ユーザーごと・日付(JST)ごとの解答数 (ランキング集計用)"""
+    __tablename__ = 'user_daily_answer_count'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    answer_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.Index('ix_user_daily_answer_count_day_user', 'day', 'user_id'),
+    )
+
+    def __repr__(self):
+        return f'<UserDailyAnswerCount User:{self.user_id} {self.day}: {self.answer_count}>'
+
+
+class ServerSession(db.Model):
+    """サーバーサイドセッション (SESSION_BACKEND=database のときに session_store が使用)"""
+    __tablename__ = 'server_session'
+    session_id = db.Column(db.String(255), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    expiry = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<ServerSession {self.session_id[:8]}... expires {self.expiry}>'
+
+
+class CacheVersion(db.Model):
+    """プロセス内キャッシュの版番号 (キャッシュの種類ごとに1行)。全ワーカーがこの値でキャッシュの古さを判定する"""
+    __tablename__ = 'cache_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+
+class QuizRun(db.Model):
+    """進行中のクイズ (出題順と進捗)。セッションには id だけを保存し、操作は quiz_run.py で行う"""
+    __tablename__ = 'quiz_run'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # 'incorrect' (間違えた問題の復習) / 'checked_type1' など (チェック問題の復習)。通常のクイズは None
+    review_type = db.Column(db.String(30), nullable=True)
+    # 出題する問題IDを連続した範囲にまとめたもの [[開始ID, 終了ID], ...]。出題順は seed から計算する
+    id_ranges = db.Column(JSON, nullable=False)
+    # 呼び出し側が決めた出題順 (期限の古い順・関連度の高い順など) の問題IDのリスト。None なら seed でシャッフルする
+    question_order = db.Column(JSON, nullable=True)
+    question_count = db.Column(db.Integer, nullable=False)
+    seed = db.Column(db.BigInteger, nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    # 解答済みの問題のビットマップ (ビットの位置は id_ranges 内での問題の順位)
+    answered = db.Column(db.LargeBinary, nullable=False)
+    answered_count = db.Column(db.Integer, nullable=False, default=0)
+    correct_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<QuizRun {self.id} User:{self.user_id} {self.position + 1}/{self.question_count}>'
+
+
+class ReviewSchedule(db.Model):
+    """ユーザー×問題ごとの復習の予定 (解答のたびに spaced_repetition.record_answers() で更新)"""
+    __tablename__ = 'review_schedule'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    repetitions = db.Column(db.Integer, nullable=False, default=0)  # 続けて期限どおりに正解した回数
+    ease = db.Column(db.Float, nullable=False, default=2.5)  # 間隔を伸ばす倍率 (間違えるほど小さくなる)
+    interval_days = db.Column(db.Float, nullable=False, default=0)
+    due_at = db.Column(db.DateTime, nullable=False)  # 次に復習する日時 (UTC)
+    last_answered_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        # 復習する問題の選択用 (期限の来た問題を、期限の古い順にインデックスだけで選ぶ)
+        db.Index('ix_review_schedule_user_due', 'user_id', 'due_at'),
+    )
+
+    def __repr__(self):
+        return f'<ReviewSchedule User:{self.user_id} Q:{self.question_id} due {self.due_at}>'
+
+
+class QuestionSearch(db.Model):
+    """問題の全文検索用のトークン (question_search.index_questions() で作成。空白区切りの 2-gram と英単語)"""
+    __tablename__ = 'question_search'
+    # 検索用のインデックス (PostgreSQL の GIN 式インデックス・SQLite の FTS5 仮想テーブル) はマイグレーションで作成する
+    question_id = db.Column(db.Integer, db.ForeignKey('question.id'), primary_key=True)
+    question_tokens = db.Column(db.Text, nullable=False, default='')
+    options_tokens = db.Column(db.Text, nullable=False, default='')
+    explanation_tokens = db.Column(db.Text, nullable=False, default='')
+
+    def __repr__(self):
+        return f'<QuestionSearch Q:{self.question_id}>'
+
+
+class QuestionAnalytics(db.Model):
+    """問題ごとの解答の集計 (question_analytics.refresh_question_analytics() で追加分だけ加算する)"""
+    __tablename__ = 'question_analytics'
+    # 問題を削除したら集計も削除する (question_analytics.forget_questions())
+    question_id = db.Column(db.Integer, primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    correct_count = db.Column(db.Integer, nullable=False, default=0)
+    option_counts = db.Column(JSON, nullable=False, default=dict)  # {選択肢: 選ばれた回数}
+    # 識別力の計算用。正答率の高いユーザー (上位群) と低いユーザー (下位群) ごとの解答数と正解数
+    upper_attempts = db.Column(db.Integer, nullable=False, default=0)
+    upper_correct = db.Column(db.Integer, nullable=False, default=0)
+    lower_attempts = db.Column(db.Integer, nullable=False, default=0)
+    lower_correct = db.Column(db.Integer, nullable=False, default=0)
+    # 上位群の正答率 - 下位群の正答率 (どちらかの群の解答がなければ None)
+    discrimination = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<QuestionAnalytics Q:{self.question_id} ({self.correct_count}/{self.attempts})>'
+
+
+class QuestionAnalyticsState(db.Model):
+    """問題の集計をどこまで行ったか (1行だけ)"""
+    __tablename__ = 'question_analytics_state'
+    id = db.Column(db.Integer, primary_key=True)
+    last_user_answer_id = db.Column(db.Integer, nullable=False, default=0)
+    last_exam_result_id = db.Column(db.Integer, nullable=False, default=0)
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<QuestionAnalyticsState answer:{self.last_user_answer_id} exam:{self.last_exam_result_id}>'
+
+
+class ExamAttempt(db.Model):
+    """進行中の試験。問題の順番と制限時間を保存し、操作は exam_attempts.py で行う"""
+    __tablename__ = 'exam_attempt'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    question_ids = db.Column(JSON, nullable=False)  # 出題順の問題IDのリスト
+    proctored = db.Column(db.Boolean, nullable=False, default=False)  # 本番モード (結果を保存する)
+    # 出題の再現用 (exam_assembly.assemble_exam() のシード値と出題条件)
+    seed = db.Column(db.BigInteger, nullable=True)
+    blueprint = db.Column(JSON, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # 解答を受け付ける期限 (UTC)。開始時刻と制限時間から計算し、サーバー側で判定する
+    deadline = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ExamAttempt {self.id} User:{self.user_id} ({len(self.question_ids)} questions)>'
+
+
+class ExamAnswer(db.Model):
+    """試験中の解答 (試験×問題ごとに1行。解答し直すと上書きする)"""
+    __tablename__ = 'exam_answer'
+    attempt_id = db.Column(db.Integer, db.ForeignKey('exam_attempt.id'), primary_key=True)
+    question_id = db.Column(db.Integer, primary_key=True)
+    selected_options = db.Column(JSON, nullable=False)
+    answered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ExamAnswer Attempt:{self.attempt_id} Q:{self.question_id}>'
+
+
+class MailOutbox(db.Model):
+    """送信待ちのメール (mail_queue のワーカーが送信し、送信できたら削除する)"""
+    __tablename__ = 'mail_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    # 'pending' (送信待ち) / 'sending' (ワーカーが送信中) / 'failed' (再試行の上限に達した)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
     def __repr__(self):
-        return f'<ExamResult {self.id} for User {self.user_id}>'
\ No newline at end of file
+        return f'<MailOutbox {self.id} to {self.recipient} ({self.status}, {self.attempts} attempts)>'
@@ -0,0 +1,339 @@
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import before_render_template, request, request_started, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+# リクエスト単位の性能計測
+# PerformanceMiddleware (app.wsgi_app を包む) がリクエストごとに RequestStats を作り、
+# SQLAlchemy のイベント・Flask のシグナル・セッションの読み書きからその値を埋めて、
+# リクエストの終了時 (ストリーミングの場合はレスポンスを送り終えた時) にエンドポイント別に集計する。
+# 集計はプロセスごとに持つので、gunicorn のワーカーが複数ある場合は値もワーカーごとになる。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+UNMATCHED_ENDPOINT = 'unmatched'
+
+_lock = threading.Lock()
+_metrics = {}  # {(endpoint, method): EndpointMetrics}
+_current = ContextVar('perf_request_stats', default=None)
+
+
+class RequestStats:
+    """1リクエスト分の計測値。"""
+    __slots__ = ('method', 'endpoint', 'status', 'started', 'sql_queries', 'sql_time',
+                 'template_time', 'template_starts', 'session_read_bytes', 'session_write_bytes')
+
+    def __init__(self, method):
+        self.method = method
+        self.endpoint = None
+        self.status = 500
+        self.started = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_starts = []
+        self.session_read_bytes = None
+        self.session_write_bytes = None
+
+
+def current_request_stats():
+    """計測中のリクエストの RequestStats を返します (リクエスト外では None)。"""
+    return _current.get()
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """バケットの中を線形補間して q 分位点を推定します (最後のバケットは上限を返す)。"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for index, count in enumerate(self.counts):
+            if index == len(self.bounds):
+                return self.bounds[-1]
+            upper = self.bounds[index]
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.bounds[-1]
+
+
+class EndpointMetrics:
+    """エンドポイント×メソッドごとの集計値。"""
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.statuses = {}
+        self.sql_time = 0.0
+        self.max_queries = 0
+        self.template_time = 0.0
+        self.session_reads = 0
+        self.session_read_bytes = 0
+        self.session_writes = 0
+        self.session_write_bytes = 0
+
+    def record(self, stats, elapsed):
+        self.latency.observe(elapsed)
+        self.queries.observe(stats.sql_queries)
+        self.statuses[stats.status] = self.statuses.get(stats.status, 0) + 1
+        self.sql_time += stats.sql_time
+        self.max_queries = max(self.max_queries, stats.sql_queries)
+        self.template_time += stats.template_time
+        if stats.session_read_bytes is not None:
+            self.session_reads += 1
+            self.session_read_bytes += stats.session_read_bytes
+        if stats.session_write_bytes is not None:
+            self.session_writes += 1
+            self.session_write_bytes += stats.session_write_bytes
+
+
+def _finish(stats):
+    elapsed = time.perf_counter() - stats.started
+    key = (stats.endpoint or UNMATCHED_ENDPOINT, stats.method)
+    with _lock:
+        metrics = _metrics.get(key)
+        if metrics is None:
+            metrics = _metrics[key] = EndpointMetrics()
+        metrics.record(stats, elapsed)
+
+
+class PerformanceMiddleware:
+    """WSGI ミドルウェア。リクエストの開始からレスポンスの送信完了までを計測します。"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats(environ.get('REQUEST_METHOD', 'GET'))
+        _current.set(stats)
+
+        def measured_start_response(status, headers, exc_info=None):
+            stats.status = int(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        def finish():
+            _current.set(None)
+            _finish(stats)
+
+        try:
+            body = self.wsgi_app(environ, measured_start_response)
+        except BaseException:
+            finish()
+            raise
+        return ClosingIterator(body, finish)
+
+
+class MeasuredSessionInterface:
+    """セッションの保存先の前後で、読み込んだ・書き込んだセッションのサイズを記録します。
+
+    サイズは保存先 (Flask-Session) の serializer で変換したバイト数 (圧縮する場合は圧縮後) で数える。
+    """
+
+    def __init__(self, session_interface):
+        self._session_interface = session_interface
+
+    def __getattr__(self, name):
+        return getattr(self._session_interface, name)
+
+    def open_session(self, app, request):
+        session = self._session_interface.open_session(app, request)
+        stats = _current.get()
+        if stats is not None and session:
+            stats.session_read_bytes = self._encoded_size(session)
+        return session
+
+    def save_session(self, app, session, response):
+        self._session_interface.save_session(app, session, response)
+        stats = _current.get()
+        if stats is not None and session.modified:
+            stats.session_write_bytes = self._encoded_size(session) if session else 0
+
+    def _encoded_size(self, session):
+        serializer = getattr(self._session_interface, 'serializer', None)
+        if serializer is None:
+            return 0
+        try:
+            return len(serializer.encode(session))
+        except Exception:
+            return 0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault('perf_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get('perf_query_start')
+    if stats is None or not starts:
+        return
+    stats.sql_queries += 1
+    stats.sql_time += time.perf_counter() - starts.pop()
+
+
+def _on_request_started(sender, **extra):
+    stats = _current.get()
+    if stats is not None:
+        stats.endpoint = request.endpoint
+
+
+def _on_before_render(sender, template, context, **extra):
+    stats = _current.get()
+    if stats is not None:
+        stats.template_starts.append(time.perf_counter())
+
+
+def _on_template_rendered(sender, template, context, **extra):
+    stats = _current.get()
+    if stats is not None and stats.template_starts:
+        started = stats.template_starts.pop()
+        # 描画中に別のテンプレートを描画した場合は、外側の時間に内側の時間を重ねて数えない
+        if not stats.template_starts:
+            stats.template_time += time.perf_counter() - started
+
+
+def init_perf_metrics(app):
+    """SQL・テンプレート・セッションの計測を登録します。
+
+    PerformanceMiddleware で app.wsgi_app を包んだうえで、セッションの保存先を設定した後に呼ぶこと。
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    request_started.connect(_on_request_started, app)
+    before_render_template.connect(_on_before_render, app)
+    template_rendered.connect(_on_template_rendered, app)
+    app.session_interface = MeasuredSessionInterface(app.session_interface)
+
+
+def reset_metrics():
+    with _lock:
+        _metrics.clear()
+
+
+def get_endpoint_summaries():
+    """管理画面用に、エンドポイントごとの集計を合計時間の長い順で返します。"""
+    with _lock:
+        items = list(_metrics.items())
+    summaries = []
+    for (endpoint, method), metrics in items:
+        count = metrics.latency.count
+        summaries.append({
+            'endpoint': endpoint,
+            'method': method,
+            'count': count,
+            'errors': sum(n for status, n in metrics.statuses.items() if status >= 500),
+            'total_ms': metrics.latency.sum * 1000,
+            'avg_ms': metrics.latency.sum / count * 1000,
+            'p50_ms': metrics.latency.quantile(0.5) * 1000,
+            'p95_ms': metrics.latency.quantile(0.95) * 1000,
+            'p99_ms': metrics.latency.quantile(0.99) * 1000,
+            'avg_queries': metrics.queries.sum / count,
+            'max_queries': metrics.max_queries,
+            'avg_sql_ms': metrics.sql_time / count * 1000,
+            'avg_template_ms': metrics.template_time / count * 1000,
+            'avg_session_read_bytes': (metrics.session_read_bytes / metrics.session_reads
+                                       if metrics.session_reads else 0),
+            'session_writes': metrics.session_writes,
+            'avg_session_write_bytes': (metrics.session_write_bytes / metrics.session_writes
+                                        if metrics.session_writes else 0),
+        })
+    summaries.sort(key=lambda summary: summary['total_ms'], reverse=True)
+    return summaries
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def _histogram_lines(name, histogram, labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=_format_bound(bound))} {cumulative}')
+    lines.append(f'{name}_bucket{_labels(**labels, le="+Inf")} {histogram.count}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+    return lines
+
+
+def render_prometheus(extra_gauges=()):
+    """集計値を Prometheus のテキスト形式で返します。
+
+    extra_gauges には (名前, 説明, [(ラベルの辞書, 値), ...]) を渡すと、gauge として出力します。
+    """
+    with _lock:
+        items = sorted(_metrics.items())
+    sections = {
+        'quiz_http_requests_total': ('counter', 'Number of HTTP requests.', []),
+        'quiz_http_request_duration_seconds': ('histogram', 'Request latency until the response is sent.', []),
+        'quiz_sql_queries_per_request': ('histogram', 'Number of SQL statements executed per request.', []),
+        'quiz_sql_duration_seconds_total': ('counter', 'Total time spent executing SQL.', []),
+        'quiz_template_render_seconds_total': ('counter', 'Total time spent rendering templates.', []),
+        'quiz_session_reads_total': ('counter', 'Number of requests that loaded a non-empty session.', []),
+        'quiz_session_read_bytes_total': ('counter', 'Encoded size of loaded sessions.', []),
+        'quiz_session_writes_total': ('counter', 'Number of session writes.', []),
+        'quiz_session_write_bytes_total': ('counter', 'Encoded size of written sessions.', []),
+    }
+    for (endpoint, method), metrics in items:
+        labels = {'endpoint': endpoint, 'method': method}
+        for status, count in sorted(metrics.statuses.items()):
+            sections['quiz_http_requests_total'][2].append(
+                f'quiz_http_requests_total{_labels(**labels, status=status)} {count}')
+        sections['quiz_http_request_duration_seconds'][2].extend(
+            _histogram_lines('quiz_http_request_duration_seconds', metrics.latency, labels))
+        sections['quiz_sql_queries_per_request'][2].extend(
+            _histogram_lines('quiz_sql_queries_per_request', metrics.queries, labels))
+        for name, value in (
+            ('quiz_sql_duration_seconds_total', metrics.sql_time),
+            ('quiz_template_render_seconds_total', metrics.template_time),
+            ('quiz_session_reads_total', metrics.session_reads),
+            ('quiz_session_read_bytes_total', metrics.session_read_bytes),
+            ('quiz_session_writes_total', metrics.session_writes),
+            ('quiz_session_write_bytes_total', metrics.session_write_bytes),
+        ):
+            sections[name][2].append(f'{name}{_labels(**labels)} {value}')
+
+    lines = []
+    for name, (metric_type, help_text, samples) in sections.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(samples)
+    for name, help_text, samples in extra_gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            lines.append(f'{name}{_labels(**labels) if labels else ""} {value}')
+    return '\n'.join(lines) + '\n'
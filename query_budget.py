@@ -0,0 +1,185 @@
+import re
+import threading
+from collections import Counter, deque
+from contextlib import ContextDecorator, contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# SQL の発行数の計測と、ルートごとのクエリ数の上限 (クエリバジェット)
+#
+#   with QueryCounter() as counter:          # 発行数と文を記録する
+#       client.get('/mypage')
+#   with assert_max_queries(5):               # 5本を超えたら QueryBudgetExceeded
+#       ...
+#   @app.route('/mypage')
+#   @query_budget(6)                          # ルートの上限を宣言する (@app.route の直下に書く)
+#
+# QUERY_DEBUG を有効にすると、リクエストごとに発行数を数え、上限を超えたルートや、
+# 同じ形の文を QUERY_REPEAT_THRESHOLD 回以上繰り返したルート (N+1 の疑い) をログに警告する。
+# 発行数はレスポンスの X-Query-Count ヘッダーにも入れる (benchmarks/bench_journeys.py で集計)。
+# QUERY_BUDGET_STRICT を有効にすると警告の代わりに QueryBudgetExceeded を送出する (CI・テスト用)。
+# キャッシュの作り直し (ワーカーの最初のリクエスト、TTL 切れ、無効化の後) のように、たまにしか起きない
+# 文は uncounted_queries() の中で発行し、発行数には含めずに別に記録する (上限はキャッシュが温まった状態で決める)。
+
+DEFAULT_REPEAT_THRESHOLD = 5
+MAX_RECORDED_VIOLATIONS = 100
+
+_active_counters = ContextVar('active_query_counters', default=())
+_uncounted = ContextVar('uncounted_queries', default=False)
+_listen_lock = threading.Lock()
+_listening = False
+
+_WHITESPACE = re.compile(r'\s+')
+# IN (?, ?, ?) や複数行 VALUES のように、件数で長さが変わる部分をまとめる
+_PARAM_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)*\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+_VALUES_LIST = re.compile(r'(VALUES \(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement):
+    """パラメータの個数の違いを無視した、SQL文の形を返します (同じ形の文の繰り返しの検出用)。"""
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _PARAM_LIST.sub('(...)', shape)
+    return _VALUES_LIST.sub(r'\1', shape)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    uncounted = _uncounted.get()
+    for counter in _active_counters.get():
+        (counter.uncounted_statements if uncounted else counter.statements).append(statement)
+
+
+def _ensure_listening():
+    global _listening
+    with _listen_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            _listening = True
+
+
+class QueryCounter(ContextDecorator):
+    """with ブロック (またはデコレートした関数) の中で発行された SQL を記録します。
+
+    max_queries を指定すると発行数が上限を超えたときに、max_repeats を指定すると同じ形の文が
+    その回数を超えて繰り返されたときに、ブロックを抜ける時点で QueryBudgetExceeded を送出する。
+    記録するのは同じスレッド (コンテキスト) で発行された文だけ。uncounted_queries() の中の文は
+    statements ではなく uncounted_statements に記録し、発行数には含めない。
+    """
+
+    def __init__(self, max_queries=None, max_repeats=None):
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.statements = []
+        self.uncounted_statements = []
+
+    def __enter__(self):
+        _ensure_listening()
+        self.statements = []
+        self.uncounted_statements = []
+        _active_counters.set(_active_counters.get() + (self,))
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _active_counters.set(tuple(counter for counter in _active_counters.get() if counter is not self))
+        if exc_type is None:
+            problems = self.problems(self.max_queries, self.max_repeats)
+            if problems:
+                raise QueryBudgetExceeded('; '.join(problems) + '\n' + self.report())
+        return False
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold):
+        """threshold 回以上発行された同じ形の文を [(形, 回数), ...] で返します。"""
+        counts = Counter(statement_shape(statement) for statement in self.statements)
+        return [(shape, count) for shape, count in counts.most_common() if count >= threshold]
+
+    def problems(self, max_queries=None, max_repeats=None):
+        problems = []
+        if max_queries is not None and self.count > max_queries:
+            problems.append(f'{self.count} queries (budget {max_queries})')
+        if max_repeats is not None:
+            for shape, count in self.repeated(max_repeats + 1):
+                problems.append(f'same statement repeated {count} times (possible N+1): {shape[:200]}')
+        return problems
+
+    def report(self):
+        lines = [f'  {number}. {statement_shape(statement)[:300]}'
+                 for number, statement in enumerate(self.statements, 1)]
+        lines += [f'  -. {statement_shape(statement)[:300]} (uncounted)' for statement in self.uncounted_statements]
+        return '\n'.join(lines)
+
+
+@contextmanager
+def uncounted_queries():
+    """with ブロックの中で発行された文を、QueryCounter の発行数に含めないようにします (キャッシュの作り直し用)。"""
+    token = _uncounted.set(True)
+    try:
+        yield
+    finally:
+        _uncounted.reset(token)
+
+
+def assert_max_queries(max_queries, max_repeats=None):
+    """発行数が max_queries を超えたら失敗する QueryCounter を返します (with / デコレーター)。"""
+    return QueryCounter(max_queries=max_queries, max_repeats=max_repeats)
+
+
+def query_budget(max_queries):
+    """ルートの1リクエストあたりの SQL 発行数の上限を宣言するデコレーター。"""
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def get_query_budget(endpoint):
+    view = current_app.view_functions.get(endpoint)
+    return getattr(view, 'query_budget', None)
+
+
+def _start_request_counter():
+    g._query_counter = QueryCounter().__enter__()
+
+
+def _stop_request_counter(exc=None):
+    # ビューで例外が起きて after_request が呼ばれなかった場合も、記録を止める
+    counter = g.pop('_query_counter', None)
+    if counter is not None:
+        counter.__exit__(None, None, None)
+    return counter
+
+
+def _check_request_counter(response):
+    counter = _stop_request_counter()
+    if counter is None:
+        return response
+
+    response.headers['X-Query-Count'] = str(counter.count)
+    threshold = current_app.config.get('QUERY_REPEAT_THRESHOLD', DEFAULT_REPEAT_THRESHOLD)
+    problems = counter.problems(get_query_budget(request.endpoint), threshold - 1)
+    if problems:
+        message = f'{request.method} {request.path} ({request.endpoint}): ' + '; '.join(problems)
+        current_app.extensions['query_budget_violations'].append(message)
+        if current_app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(message + '\n' + counter.report())
+        current_app.logger.warning('Query budget: %s', message)
+    return response
+
+
+def init_query_debug(app):
+    """QUERY_DEBUG が有効なら、リクエストごとのクエリ数の確認を登録します。"""
+    app.extensions['query_budget_violations'] = deque(maxlen=MAX_RECORDED_VIOLATIONS)
+    if not app.config.get('QUERY_DEBUG'):
+        return
+    app.before_request(_start_request_counter)
+    app.after_request(_check_request_counter)
+    app.teardown_request(_stop_request_counter)
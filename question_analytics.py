@@ -0,0 +1,271 @@
+import datetime
+import json
+from collections import Counter, namedtuple
+
+from sqlalchemy import select
+
+from db_utils import upsert
+from models import (db, Question, UserAnswer, UserStats, ExamResult, ExamResultItem,
+                    QuestionAnalytics, QuestionAnalyticsState)
+from question_cache import get_questions
+
+# 問題ごとの解答の集計 (管理画面の問題分析用)
+# 解答履歴と本番試験の結果を毎回全件集計するのではなく、前回どこまで集計したか (解答と試験結果の id) を
+# question_analytics_state に記録し、それより後に追加された分だけを読み込んで question_analytics に
+# 加算する。解答の削除 (やり直しや復習での削除) は反映しないため、集計は「これまでに解答された分」になる。
+# 作り直したい場合は refresh_question_analytics(full=True) を使う。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+ANALYTICS_BATCH_SIZE = 10000
+# 試験結果は1件に複数の解答が含まれるので、この件数ずつ読み込む
+EXAM_RESULT_BATCH_SIZE = 500
+# 識別力の上位群・下位群 (正答率の高い順・低い順にこの割合のユーザー)
+DISCRIMINATION_GROUP_RATIO = 0.27
+# 群分けの対象にするユーザーの最低解答数
+MIN_ANSWERS_FOR_GROUP = 10
+# 書き込み中のトランザクションの解答を飛ばさないよう、この秒数より前の解答だけを集計する
+SETTLE_SECONDS = 60
+ANALYTICS_PAGE_SIZE = 50
+_MERGE_CHUNK_SIZE = 500
+_STATE_ID = 1
+
+RefreshReport = namedtuple('RefreshReport', ['answers', 'exam_answers', 'questions'])
+OptionRate = namedtuple('OptionRate', ['option', 'count', 'rate'])
+QuestionAnalyticsItem = namedtuple('QuestionAnalyticsItem',
+                                   ['question_id', 'question', 'attempts', 'correct_count', 'accuracy',
+                                    'option_rates', 'discrimination'])
+
+# 管理画面の並び順 {キー: (表示名, ORDER BY)}
+_accuracy = QuestionAnalytics.correct_count * 1.0 / QuestionAnalytics.attempts
+SORT_ORDERS = {
+    'accuracy': ('正答率の低い順', (_accuracy.asc(), QuestionAnalytics.question_id)),
+    'discrimination': ('識別力の低い順', (QuestionAnalytics.discrimination.is_(None),
+                                     QuestionAnalytics.discrimination.asc(), QuestionAnalytics.question_id)),
+    'attempts': ('解答数の多い順', (QuestionAnalytics.attempts.desc(), QuestionAnalytics.question_id)),
+    'question': ('問題ID順', (QuestionAnalytics.question_id,)),
+}
+DEFAULT_SORT = 'accuracy'
+
+
+class _QuestionDelta:
+    __slots__ = ('attempts', 'correct', 'options', 'upper_attempts', 'upper_correct',
+                 'lower_attempts', 'lower_correct')
+
+    def __init__(self):
+        self.attempts = self.correct = 0
+        self.upper_attempts = self.upper_correct = self.lower_attempts = self.lower_correct = 0
+        self.options = Counter()
+
+    def add(self, selected_options, is_correct, group):
+        correct = 1 if is_correct else 0
+        self.attempts += 1
+        self.correct += correct
+        self.options.update(map(str, selected_options or ()))
+        if group == 'upper':
+            self.upper_attempts += 1
+            self.upper_correct += correct
+        elif group == 'lower':
+            self.lower_attempts += 1
+            self.lower_correct += correct
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+def _as_dict(value):
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or {}
+
+
+def _get_state():
+    state = db.session.get(QuestionAnalyticsState, _STATE_ID)
+    if state is None:
+        state = QuestionAnalyticsState(id=_STATE_ID, last_user_answer_id=0, last_exam_result_id=0)
+        db.session.add(state)
+    return state
+
+
+def get_last_refreshed_at():
+    state = db.session.get(QuestionAnalyticsState, _STATE_ID)
+    return state.refreshed_at if state else None
+
+
+def _user_groups():
+    """正答率で上位群・下位群に入るユーザーを {user_id: 'upper' | 'lower'} で返します。"""
+    rows = db.session.query(UserStats.user_id, UserStats.correct_answered, UserStats.total_answered) \
+                     .filter(UserStats.total_answered >= MIN_ANSWERS_FOR_GROUP).all()
+    group_size = int(len(rows) * DISCRIMINATION_GROUP_RATIO)
+    if not group_size:
+        return {}
+    ranked = sorted(rows, key=lambda row: row.correct_answered / row.total_answered)
+    groups = {row.user_id: 'lower' for row in ranked[:group_size]}
+    groups.update({row.user_id: 'upper' for row in ranked[-group_size:]})
+    return groups
+
+
+def _collect_answers(deltas, groups, last_id, cutoff, batch_size):
+    """last_id より後の解答を集計に加え、(件数, 最後に集計した id) を返します。"""
+    query = select(UserAnswer.id, UserAnswer.user_id, UserAnswer.question_id,
+                   UserAnswer.user_selected_option, UserAnswer.is_correct, UserAnswer.timestamp) \
+        .order_by(UserAnswer.id).limit(batch_size)
+    count = 0
+    while True:
+        rows = db.session.execute(query.where(UserAnswer.id > last_id)).all()
+        for row in rows:
+            if row.timestamp > cutoff:
+                return count, last_id
+            delta = deltas.get(row.question_id)
+            if delta is None:
+                delta = deltas[row.question_id] = _QuestionDelta()
+            delta.add(_as_list(row.user_selected_option), row.is_correct, groups.get(row.user_id))
+            last_id = row.id
+            count += 1
+        if len(rows) < batch_size:
+            return count, last_id
+
+
+def _collect_exam_answers(deltas, groups, last_id, cutoff, batch_size=EXAM_RESULT_BATCH_SIZE):
+    """last_id より後の本番試験の結果を集計に加え、(解答数, 最後に集計した試験結果の id) を返します。"""
+    results_query = select(ExamResult.id, ExamResult.user_id, ExamResult.submitted_at) \
+        .order_by(ExamResult.id).limit(batch_size)
+    count = 0
+    while True:
+        results = db.session.execute(results_query.where(ExamResult.id > last_id)).all()
+        # 期限より新しい結果があれば、そこで止める (それより後ろは次回に集計する)
+        settled = []
+        for result in results:
+            if result.submitted_at > cutoff:
+                break
+            settled.append(result)
+        if settled:
+            user_ids = {result.id: result.user_id for result in settled}
+            items = db.session.execute(
+                select(ExamResultItem.exam_result_id, ExamResultItem.question_id,
+                       ExamResultItem.user_answer, ExamResultItem.is_correct)
+                .where(ExamResultItem.exam_result_id.in_(list(user_ids)))
+            )
+            for item in items:
+                delta = deltas.get(item.question_id)
+                if delta is None:
+                    delta = deltas[item.question_id] = _QuestionDelta()
+                delta.add(_as_list(item.user_answer), item.is_correct, groups.get(user_ids[item.exam_result_id]))
+                count += 1
+            last_id = settled[-1].id
+        if len(settled) < batch_size:
+            return count, last_id
+
+
+def _discrimination(upper_attempts, upper_correct, lower_attempts, lower_correct):
+    if not upper_attempts or not lower_attempts:
+        return None
+    return upper_correct / upper_attempts - lower_correct / lower_attempts
+
+
+def _merge(deltas, now):
+    """集計した差分を question_analytics に加算します (問題 _MERGE_CHUNK_SIZE 件ごとに読み込みと upsert を1回)。"""
+    table = QuestionAnalytics.__table__
+    columns = [column.name for column in table.columns if column.name != 'question_id']
+    statement = upsert(table, index_elements=['question_id'],
+                       set_=lambda excluded: {name: getattr(excluded, name) for name in columns})
+    question_ids = list(deltas)
+    for offset in range(0, len(question_ids), _MERGE_CHUNK_SIZE):
+        chunk = question_ids[offset:offset + _MERGE_CHUNK_SIZE]
+        existing = {row.question_id: row for row in db.session.execute(
+            select(table).where(table.c.question_id.in_(chunk)))}
+        rows = []
+        for question_id in chunk:
+            delta = deltas[question_id]
+            current = existing.get(question_id)
+            option_counts = Counter(_as_dict(current.option_counts) if current is not None else {})
+            option_counts.update(delta.options)
+            row = {
+                'question_id': question_id,
+                'attempts': delta.attempts,
+                'correct_count': delta.correct,
+                'option_counts': dict(option_counts),
+                'upper_attempts': delta.upper_attempts,
+                'upper_correct': delta.upper_correct,
+                'lower_attempts': delta.lower_attempts,
+                'lower_correct': delta.lower_correct,
+                'updated_at': now,
+            }
+            if current is not None:
+                for name in ('attempts', 'correct_count', 'upper_attempts', 'upper_correct',
+                             'lower_attempts', 'lower_correct'):
+                    row[name] += getattr(current, name)
+            row['discrimination'] = _discrimination(row['upper_attempts'], row['upper_correct'],
+                                                    row['lower_attempts'], row['lower_correct'])
+            rows.append(row)
+        db.session.execute(statement, rows)
+
+
+def refresh_question_analytics(full=False, batch_size=ANALYTICS_BATCH_SIZE, now=None):
+    """前回の集計より後に追加された解答と本番試験の結果を集計に加え、RefreshReport を返します。
+
+    full=True の場合は集計を削除して、全件から作り直す。
+    """
+    now = now or datetime.datetime.utcnow()
+    if full:
+        reset_question_analytics()
+    state = _get_state()
+    cutoff = now - datetime.timedelta(seconds=SETTLE_SECONDS)
+    groups = _user_groups()
+    deltas = {}
+    answers, state.last_user_answer_id = _collect_answers(
+        deltas, groups, state.last_user_answer_id, cutoff, batch_size)
+    exam_answers, state.last_exam_result_id = _collect_exam_answers(
+        deltas, groups, state.last_exam_result_id, cutoff)
+    _merge(deltas, now)
+    state.refreshed_at = now
+    return RefreshReport(answers, exam_answers, len(deltas))
+
+
+def forget_questions(question_ids):
+    """削除した問題の集計を削除します。"""
+    QuestionAnalytics.query.filter(QuestionAnalytics.question_id.in_(question_ids)) \
+                           .delete(synchronize_session=False)
+
+
+def reset_question_analytics():
+    """集計と、どこまで集計したかの記録を削除します (次回は全件から集計する)。
+
+    全問題の削除後など、解答の id が振り直される可能性がある場合にも呼ぶ。
+    """
+    QuestionAnalytics.query.delete(synchronize_session=False)
+    # 記録はこの後すぐ作り直すので、読み込み済みのものもセッションから外す
+    QuestionAnalyticsState.query.delete(synchronize_session='fetch')
+
+
+def _to_item(analytics, question):
+    option_counts = _as_dict(analytics.option_counts)
+    options = list(question.options) if question else []
+    options += [option for option in option_counts if option not in options]
+    return QuestionAnalyticsItem(
+        question_id=analytics.question_id,
+        question=question,
+        attempts=analytics.attempts,
+        correct_count=analytics.correct_count,
+        accuracy=analytics.correct_count / analytics.attempts * 100,
+        option_rates=[OptionRate(option, option_counts.get(option, 0),
+                                 option_counts.get(option, 0) / analytics.attempts * 100)
+                      for option in options],
+        discrimination=analytics.discrimination,
+    )
+
+
+def paginate_question_analytics(page, sort=DEFAULT_SORT, per_page=ANALYTICS_PAGE_SIZE):
+    """問題ごとの集計をページ分けして返します (items は QuestionAnalyticsItem)。削除された問題は含まない。"""
+    _, order_by = SORT_ORDERS.get(sort, SORT_ORDERS[DEFAULT_SORT])
+    statement = select(QuestionAnalytics) \
+        .join(Question, Question.id == QuestionAnalytics.question_id) \
+        .where(QuestionAnalytics.attempts > 0) \
+        .order_by(*order_by)
+    pagination = db.paginate(statement, page=page, per_page=per_page, error_out=False)
+    questions = get_questions([analytics.question_id for analytics in pagination.items])
+    pagination.items = [_to_item(analytics, questions.get(analytics.question_id))
+                        for analytics in pagination.items]
+    return pagination
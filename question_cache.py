@@ -0,0 +1,270 @@
+import json
+import threading
+import time
+from dataclasses import dataclass
+
+from flask import abort, current_app, g, has_request_context, render_template
+from markupsafe import Markup
+from sqlalchemy import func
+
+from db_utils import upsert
+from models import db, CacheVersion, Question
+from query_budget import uncounted_queries
+
+# 問題データのプロセス内キャッシュ (問題範囲一覧と、解析済みの問題レコード)
+# 管理画面で問題が追加・編集・削除・インポートされたら、コミットの後に invalidate_question_cache() を呼ぶ。
+# このプロセスのキャッシュを破棄し、cache_version テーブルの版番号を進める。
+# 採点もこのキャッシュの正解で行うので、他のワーカープロセスはリクエストごとに1回 (キャッシュを使う
+# ときだけ) 版番号を読み、変わっていればキャッシュを作り直す。管理画面を通さずにDBを直接書き換えた
+# 場合だけは、QUIZ_CACHE_TTL 秒で作り直されるまで古いデータが使われる。
+# キャッシュを作り直すクエリはたまにしか発行されないので、ルートのクエリバジェットには数えない
+# (query_budget.uncounted_queries)。版番号の確認はリクエストごとに1本として数える。
+
+SHARED_VERSION_NAME = 'questions'
+
+_lock = threading.Lock()
+_version = 0
+_shared_version = None  # 最後に確かめた cache_version の版番号 (未確認なら None)
+_ranges_cache = {}  # {range_size: (version, built_at, ranges)}
+_range_grid_cache = {}  # {range_size: (version, built_at, html)}
+_questions = {}  # {question_id: QuestionRecord}
+_questions_loaded_at = None  # 問題全件を読み込んだ時刻 (未読み込みなら None)
+
+
+def _as_list(value):
+    # JSON列は環境によって文字列のまま返ることがあるため、ここで一度だけ正規化する
+    if isinstance(value, str):
+        value = json.loads(value)
+    return value or []
+
+
+@dataclass(frozen=True, slots=True)
+class QuestionRecord:
+    """クイズ表示・採点用の問題データ。選択肢と正解は読み込み時に解析済み。"""
+    id: int
+    question_text: str
+    options: tuple
+    correct_answer: tuple
+    correct_answer_set: frozenset
+    explanation: str
+    question_type: str
+    image_filename: str
+
+    @classmethod
+    def from_row(cls, row):
+        correct_answer = tuple(_as_list(row.correct_answer))
+        return cls(
+            id=row.id,
+            question_text=row.question_text,
+            options=tuple(_as_list(row.options)),
+            correct_answer=correct_answer,
+            correct_answer_set=frozenset(correct_answer),
+            explanation=row.explanation,
+            question_type=row.question_type,
+            image_filename=row.image_filename,
+        )
+
+    @property
+    def is_multi_select(self):
+        return len(self.correct_answer) > 1
+
+    @property
+    def correct_answer_display(self):
+        return " & ".join(map(str, self.correct_answer))
+
+    def is_correct(self, selected_options):
+        return frozenset(selected_options) == self.correct_answer_set
+
+
+def invalidate_question_cache(question_ids=None):
+    """問題データが変更されたことを通知し、キャッシュを無効化します (変更をコミットした後に呼ぶこと)。
+
+    このプロセスでは question_ids を指定した場合はその問題だけを、省略した場合は全問題を読み込み直す。
+    他のワーカープロセスは共有の版番号の変化に気付いて、キャッシュ全体を作り直す。
+    """
+    _invalidate_local(question_ids)
+    # リクエストのトランザクションとは別の接続で、すぐにコミットする
+    table = CacheVersion.__table__
+    with db.engine.begin() as conn:
+        conn.execute(upsert(table, index_elements=['name'], set_={'version': table.c.version + 1}),
+                     {'name': SHARED_VERSION_NAME, 'version': 1})
+
+
+def _invalidate_local(question_ids=None):
+    global _version, _questions_loaded_at
+    with _lock:
+        _version += 1
+        _ranges_cache.clear()
+        _range_grid_cache.clear()
+        if question_ids is None:
+            _questions.clear()
+            _questions_loaded_at = None
+        else:
+            for question_id in question_ids:
+                _questions.pop(question_id, None)
+
+
+def get_question_cache_version():
+    return _version
+
+
+def _sync_shared_version():
+    """他のプロセスで問題が変更されていれば、このプロセスのキャッシュを破棄します (リクエストごとに1回)。"""
+    global _shared_version
+    if has_request_context():
+        if g.get('_question_cache_synced'):
+            return
+        g._question_cache_synced = True
+    shared = db.session.query(CacheVersion.version).filter_by(name=SHARED_VERSION_NAME).scalar() or 0
+    if shared != _shared_version:
+        _invalidate_local()
+        _shared_version = shared
+
+
+def _cache_ttl():
+    return current_app.config.get('QUIZ_CACHE_TTL', 300)
+
+
+def _is_fresh(entry):
+    version, built_at, _ = entry
+    if version != _version:
+        return False
+    ttl = _cache_ttl()
+    return not ttl or (time.monotonic() - built_at) < ttl
+
+
+def build_question_ranges(range_size):
+    """問題IDを range_size 件ずつの範囲に分け、問題が存在する範囲だけを返します。
+
+    範囲ごとの COUNT を繰り返す代わりに、GROUP BY の集計クエリ1本で作成します。
+    """
+    bucket = ((Question.id - 1) // range_size).label('bucket')
+    rows = db.session.query(bucket, func.max(Question.id)) \
+                     .group_by(bucket).order_by(bucket).all()
+    if not rows:
+        return {}
+
+    max_id = rows[-1][1]
+    ranges = {}
+    for bucket_no, _ in rows:
+        start_id = bucket_no * range_size + 1
+        end_id = min(start_id + range_size - 1, max_id)
+        range_key = f'range_{start_id}_{end_id}'
+        if start_id == end_id:
+            range_name = f'No.{start_id}'
+        else:
+            range_name = f'No.{start_id} ~ No.{end_id}'
+        ranges[range_key] = {'name': range_name}
+    return ranges
+
+
+def _get_cached(cache, key, builder):
+    _sync_shared_version()
+    entry = cache.get(key)
+    if entry is not None and _is_fresh(entry):
+        return entry[2]
+
+    version = _version
+    with uncounted_queries():
+        value = builder()
+    with _lock:
+        # 構築中に無効化された場合は、古い結果をキャッシュしない
+        if version == _version:
+            cache[key] = (version, time.monotonic(), value)
+    return value
+
+
+def _resolve_range_size(range_size):
+    if range_size is None:
+        return current_app.config.get('QUIZ_RANGE_SIZE', 5)
+    return range_size
+
+
+def get_question_ranges(range_size=None):
+    """キャッシュ済みの問題範囲一覧を返します。"""
+    range_size = _resolve_range_size(range_size)
+    return _get_cached(_ranges_cache, range_size,
+                       lambda: build_question_ranges(range_size))
+
+
+def get_question_range_grid(range_size=None):
+    """問題範囲のチェックボックス一覧をHTML断片としてキャッシュして返します。
+
+    問題数が多いと範囲の数だけテンプレートのループが回るため、描画結果ごと保持します。
+    """
+    range_size = _resolve_range_size(range_size)
+    return _get_cached(_range_grid_cache, range_size, lambda: Markup(render_template(
+        'quiz_range_grid.html', quiz_ranges=get_question_ranges(range_size))))
+
+
+_QUESTION_COLUMNS = (
+    Question.id, Question.question_text, Question.options, Question.correct_answer,
+    Question.explanation, Question.question_type, Question.image_filename,
+)
+
+
+def _load_questions(question_ids=None):
+    query = db.session.query(*_QUESTION_COLUMNS)
+    if question_ids is not None:
+        query = query.filter(Question.id.in_(question_ids))
+    return {row.id: QuestionRecord.from_row(row) for row in query}
+
+
+def warm_question_cache():
+    """全問題をまとめて読み込み、キャッシュを作り直します。"""
+    global _questions_loaded_at
+    _sync_shared_version()
+    version = _version
+    with uncounted_queries():
+        records = _load_questions()
+    with _lock:
+        if version == _version:
+            _questions.clear()
+            _questions.update(records)
+            _questions_loaded_at = time.monotonic()
+    return len(records)
+
+
+def _ensure_warm():
+    _sync_shared_version()
+    ttl = _cache_ttl()
+    if _questions_loaded_at is None or (ttl and time.monotonic() - _questions_loaded_at >= ttl):
+        warm_question_cache()
+
+
+def get_questions(question_ids):
+    """問題IDのリストに対応する QuestionRecord を {id: record} で返します。
+
+    キャッシュにない問題 (他のワーカーで追加された問題など) は IN クエリ1本でまとめて読み込みます。
+    存在しない問題IDは結果に含まれません。
+    """
+    _ensure_warm()
+    found = {}
+    missing = []
+    for question_id in question_ids:
+        record = _questions.get(question_id)
+        if record is None:
+            missing.append(question_id)
+        else:
+            found[question_id] = record
+    if missing:
+        version = _version
+        with uncounted_queries():
+            loaded = _load_questions(missing)
+        with _lock:
+            if version == _version:
+                _questions.update(loaded)
+        found.update(loaded)
+    return found
+
+
+def get_question(question_id):
+    """問題IDに対応する QuestionRecord を返します。存在しなければ None。"""
+    return get_questions([question_id]).get(question_id)
+
+
+def get_question_or_404(question_id):
+    record = get_question(question_id)
+    if record is None:
+        abort(404)
+    return record
@@ -0,0 +1,186 @@
+import csv
+import io
+from dataclasses import dataclass, field
+
+from sqlalchemy import text
+
+from db_utils import upsert
+from models import db, Question, UserAnswer, UserCheck
+from question_analytics import reset_question_analytics
+from question_cache import invalidate_question_cache
+from question_search import index_questions, reset_search_index
+from user_checks import invalidate_user_checks
+import leaderboard
+import spaced_repetition
+import user_stats
+
+# CSV からの問題一括インポート
+# CSV を chunk_size 行ずつ読み込み、チャンクごとに既存IDを IN クエリ1本で確認してから
+# まとめて INSERT / UPSERT し、チャンク単位でコミットする。全行をメモリに保持しない。
+
+DEFAULT_IMPORT_CHUNK_SIZE = 1000
+REQUIRED_COLUMNS = ('question_text', 'options', 'correct_answers')
+
+
+@dataclass
+class ImportReport:
+    inserted: int = 0
+    updated: int = 0
+    errors: list = field(default_factory=list)  # [(CSVの行番号, メッセージ), ...]
+
+
+def _split(value):
+    return [item.strip() for item in (value or '').split('|') if item.strip()]
+
+
+def parse_row(row):
+    """CSVの1行を Question テーブルの列の辞書に変換します。不正な行は ValueError。"""
+    missing = [column for column in REQUIRED_COLUMNS if column not in row]
+    if missing:
+        raise ValueError(f"必須の列がありません: {', '.join(missing)}")
+
+    question_text = (row['question_text'] or '').strip()
+    if not question_text:
+        raise ValueError("問題文が空です。")
+    options_list = _split(row['options'])
+    if not options_list:
+        raise ValueError("選択肢は1つ以上入力してください。")
+    correct_answers_list = _split(row['correct_answers'])
+    if not correct_answers_list:
+        raise ValueError("正解は1つ以上入力してください。")
+    for ca in correct_answers_list:
+        if ca not in options_list:
+            raise ValueError(f"正解 '{ca}' は選択肢の中に存在しません。")
+
+    values = {
+        'question_text': question_text,
+        'options': options_list,
+        'correct_answer': correct_answers_list,
+        'explanation': row.get('explanation') or '',
+        'image_filename': row.get('image_filename') or None,
+    }
+    question_id = (row.get('id') or '').strip()
+    if question_id:
+        try:
+            values['id'] = int(question_id)
+        except ValueError:
+            raise ValueError(f"IDが数値ではありません: {question_id}")
+    return values
+
+
+def delete_all_questions():
+    """全問題と、それに紐づく解答履歴・チェック・集計 (ランキングの日別カウンタを含む) を削除してコミットします。"""
+    UserAnswer.query.delete()
+    UserCheck.query.delete()
+    user_stats.reset_all_stats()
+    leaderboard.reset_all()
+    spaced_repetition.reset_all()
+    reset_search_index()
+    # 解答の id が振り直される場合があるので、問題の集計も最初から作り直す
+    reset_question_analytics()
+    Question.query.delete()
+    # 'question'テーブルのIDシーケンスをリセットするSQLを実行
+    # このSQLはPostgreSQLに特有のものです
+    try:
+        db.session.execute(text('TRUNCATE TABLE question RESTART IDENTITY CASCADE;'))
+        db.session.commit()
+    except Exception:
+        # SQLiteなど、TRUNCATEをサポートしないDBの場合は通常のDELETEに戻す
+        db.session.rollback()
+        UserAnswer.query.delete()
+        UserCheck.query.delete()
+        user_stats.reset_all_stats()
+        leaderboard.reset_all()
+        spaced_repetition.reset_all()
+        reset_search_index()
+        reset_question_analytics()
+        Question.query.delete()
+        db.session.commit()
+    invalidate_question_cache()
+    invalidate_user_checks()
+    leaderboard.invalidate_ranking_cache()
+
+
+def _read_chunks(reader, chunk_size):
+    chunk = []
+    for row in reader:
+        chunk.append((reader.line_num, row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _write_chunk(rows, report):
+    with_id = {}
+    without_id = []
+    for values in rows:
+        if 'id' in values:
+            # 同じチャンク内で同じIDが複数回出てきた場合は後の行を優先する
+            with_id[values['id']] = values
+        else:
+            without_id.append(values)
+
+    if with_id:
+        existing_ids = {question_id for (question_id,) in db.session.query(Question.id)
+                        .filter(Question.id.in_(list(with_id)))}
+        table = Question.__table__
+        db.session.execute(upsert(
+            table, index_elements=['id'],
+            set_=lambda excluded: {column: excluded[column] for column in
+                                   ('question_text', 'options', 'correct_answer', 'explanation', 'image_filename')},
+        ), list(with_id.values()))
+        report.updated += len(existing_ids)
+        report.inserted += len(with_id) - len(existing_ids)
+
+    inserted_ids = []
+    if without_id:
+        table = Question.__table__
+        inserted_ids = db.session.execute(table.insert().returning(table.c.id), without_id).scalars().all()
+        report.inserted += len(without_id)
+
+    # 追加・更新した問題の検索用トークンも同じトランザクションで作り直す
+    index_questions(list(with_id) + inserted_ids)
+    db.session.commit()
+
+
+def _sync_id_sequence():
+    # ID を指定して INSERT すると PostgreSQL のシーケンスが進まないため、最大IDに合わせる
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('question', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM question), 0) + 1, false)"))
+        db.session.commit()
+
+
+def import_questions_csv(stream, chunk_size=DEFAULT_IMPORT_CHUNK_SIZE):
+    """CSV (テキストストリーム) から問題をインポートし、ImportReport を返します。
+
+    id 列がある行は同じIDの問題を更新 (なければそのIDで追加) し、id 列が空の行は新規追加します。
+    不正な行はスキップし、行番号とエラー内容を report.errors に記録します。
+    """
+    report = ImportReport()
+    reader = csv.DictReader(stream)
+    try:
+        for chunk in _read_chunks(reader, chunk_size):
+            rows = []
+            for line_num, row in chunk:
+                try:
+                    rows.append(parse_row(row))
+                except ValueError as e:
+                    report.errors.append((line_num, str(e)))
+            if rows:
+                _write_chunk(rows, report)
+    finally:
+        # 失敗したチャンクの書き込みを破棄してから (成功時は何もしない)、キャッシュの版番号を進める
+        db.session.rollback()
+        _sync_id_sequence()
+        invalidate_question_cache()
+    return report
+
+
+def import_questions_file(file_storage, chunk_size=DEFAULT_IMPORT_CHUNK_SIZE):
+    """アップロードされたCSVファイル (BOM付きUTF-8にも対応) をインポートします。"""
+    stream = io.TextIOWrapper(file_storage.stream, 'utf-8-sig')
+    return import_questions_csv(stream, chunk_size)
@@ -0,0 +1,274 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, column, event, func, literal_column, select, table
+
+from db_utils import upsert
+from models import db, Question, QuestionSearch
+
+# 問題の全文検索 (問題文・選択肢・解説)
+# 日本語は単語の区切りがないため、文字の 2-gram に分けた語 (トークン) を question_search に保存し、
+# 検索語も同じように分けて、トークンが連続して並ぶ (= 検索語をそのまま含む) 問題を探す。
+# 英数字は NFKC で半角・小文字にそろえて単語ごとに1トークンとする。
+#   - PostgreSQL: question_search のトークンから作る tsvector の GIN インデックス (式インデックス) で検索し、
+#     ts_rank で並べる (問題文 > 選択肢 > 解説 の重み)
+#   - SQLite: question_search を外部コンテンツとする FTS5 の仮想テーブル question_fts で検索し、bm25 で並べる
+#     (question_fts はトリガーで question_search と同期する)
+# インデックスとトリガーはマイグレーションで作成する (db.create_all() の場合は下の DDL で作成する)。問題を追加・編集・インポートしたら
+# index_questions() を呼ぶ (削除は Question のリレーションで question_search も削除される)。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+# PostgreSQL の GIN インデックス (ix_question_search_document) と同じ式にすること
+DOCUMENT_SQL = ("setweight(to_tsvector('simple', question_tokens), 'A') || "
+                "setweight(to_tsvector('simple', options_tokens), 'B') || "
+                "setweight(to_tsvector('simple', explanation_tokens), 'C')")
+FTS_TABLE = 'question_fts'
+_FTS_COLUMNS = 'question_tokens, options_tokens, explanation_tokens'
+_FTS_NEW_VALUES = 'new.question_id, new.question_tokens, new.options_tokens, new.explanation_tokens'
+_FTS_OLD_VALUES = "'delete', old.question_id, old.question_tokens, old.options_tokens, old.explanation_tokens"
+# bm25() の列ごとの重み (問題文, 選択肢, 解説)
+FTS_WEIGHTS = (3.0, 2.0, 1.0)
+SEARCH_PER_PAGE = 20
+# 検索結果からクイズを始めるときの最大問題数
+SEARCH_QUIZ_LIMIT = 50
+MAX_QUERY_LENGTH = 100
+SNIPPET_WIDTH = 80
+DEFAULT_REBUILD_BATCH_SIZE = 1000
+
+# 英数字の単語と、それ以外の文字 (日本語など) の並び
+_RUN_RE = re.compile(r'[0-9a-z]+|[^\W0-9a-z_]+')
+_fts_table = table(FTS_TABLE, column('rowid'))
+
+# db.create_all() (ベンチマークなど) で question_search を作成したときにも、検索用のインデックスを作る
+# (マイグレーション a1e6b9d3f457 と同じ内容)
+for _dialect, _statement in (
+    ('postgresql', f'CREATE INDEX ix_question_search_document ON question_search USING gin (({DOCUMENT_SQL}))'),
+    ('sqlite', f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5({_FTS_COLUMNS}, "
+               f"content='question_search', content_rowid='question_id')"),
+    ('sqlite', f'CREATE TRIGGER question_search_ai AFTER INSERT ON question_search BEGIN '
+               f'INSERT INTO {FTS_TABLE} (rowid, {_FTS_COLUMNS}) VALUES ({_FTS_NEW_VALUES}); END'),
+    ('sqlite', f'CREATE TRIGGER question_search_ad AFTER DELETE ON question_search BEGIN '
+               f'INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ({_FTS_OLD_VALUES}); END'),
+    ('sqlite', f'CREATE TRIGGER question_search_au AFTER UPDATE ON question_search BEGIN '
+               f'INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, {_FTS_COLUMNS}) VALUES ({_FTS_OLD_VALUES}); '
+               f'INSERT INTO {FTS_TABLE} (rowid, {_FTS_COLUMNS}) VALUES ({_FTS_NEW_VALUES}); END'),
+):
+    event.listen(QuestionSearch.__table__, 'after_create', DDL(_statement).execute_if(dialect=_dialect))
+event.listen(QuestionSearch.__table__, 'before_drop', DDL(f'DROP TABLE IF EXISTS {FTS_TABLE}').execute_if(dialect='sqlite'))
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _runs(text):
+    return _RUN_RE.findall(normalize(text))
+
+
+def _is_word(run):
+    return run.isascii()
+
+
+def _ngrams(run):
+    # 2-gram に加えて末尾の1文字も入れておくと、どの文字もいずれかのトークンの先頭になるので、
+    # 1文字の検索語を前方一致で探せる
+    return [a + b for a, b in zip(run, run[1:])] + [run[-1]]
+
+
+def tokenize(text):
+    """検索用のトークン (空白区切りの文字列) を返します。"""
+    tokens = []
+    for run in _runs(text):
+        if _is_word(run):
+            tokens.append(run)
+        else:
+            tokens.extend(_ngrams(run))
+    return ' '.join(tokens)
+
+
+def query_terms(query):
+    """検索語を、トークンの並び (フレーズ) ごとに分けて返します: [(トークンのリスト, 前方一致か), ...]"""
+    terms = []
+    for run in _runs((query or '')[:MAX_QUERY_LENGTH]):
+        if _is_word(run):
+            terms.append(([run], False))
+        elif len(run) == 1:
+            terms.append(([run], True))
+        else:
+            terms.append(([a + b for a, b in zip(run, run[1:])], False))
+    return terms
+
+
+def _options_text(options):
+    return ' '.join(map(str, options or []))
+
+
+def _document_row(question_id, question_text, options, explanation):
+    return {
+        'question_id': question_id,
+        'question_tokens': tokenize(question_text),
+        'options_tokens': tokenize(_options_text(options)),
+        'explanation_tokens': tokenize(explanation),
+    }
+
+
+def index_questions(question_ids):
+    """問題のトークンを作り直して question_search に保存します (未保存の変更は先に flush される)。"""
+    question_ids = list(question_ids)
+    if not question_ids:
+        return
+    rows = db.session.query(Question.id, Question.question_text, Question.options, Question.explanation) \
+                     .filter(Question.id.in_(question_ids)).all()
+    if not rows:
+        return
+    db.session.execute(upsert(
+        QuestionSearch.__table__,
+        index_elements=['question_id'],
+        set_=lambda excluded: {name: getattr(excluded, name) for name in
+                               ('question_tokens', 'options_tokens', 'explanation_tokens')},
+    ), [_document_row(*row) for row in rows])
+
+
+def reset_search_index():
+    QuestionSearch.query.delete(synchronize_session=False)
+
+
+def rebuild_search_index(batch_size=DEFAULT_REBUILD_BATCH_SIZE):
+    """全問題のトークンを作り直します (導入時・トークンの作り方を変えたとき用)。件数を返します。"""
+    reset_search_index()
+    count = 0
+    last_id = 0
+    while True:
+        question_ids = [question_id for (question_id,) in
+                        db.session.query(Question.id).filter(Question.id > last_id)
+                        .order_by(Question.id).limit(batch_size)]
+        if not question_ids:
+            return count
+        index_questions(question_ids)
+        count += len(question_ids)
+        last_id = question_ids[-1]
+
+
+def is_index_empty():
+    """問題があるのに検索用のトークンがない (rebuild_search_index() が必要) かどうかを返します。"""
+    has_questions = db.session.query(select(Question.id).exists()).scalar()
+    has_documents = db.session.query(select(QuestionSearch.question_id).exists()).scalar()
+    return has_questions and not has_documents
+
+
+def _postgresql_query(terms):
+    # 'デー' <-> 'ータ' & 'python' & '猫':*
+    phrases = []
+    for tokens, prefix in terms:
+        phrase = ' <-> '.join(f"'{token}'" for token in tokens)
+        phrases.append(phrase + ':*' if prefix else phrase)
+    return ' & '.join(phrases)
+
+
+def _sqlite_query(terms):
+    # "デー ータ" AND "python" AND "猫"*
+    phrases = []
+    for tokens, prefix in terms:
+        phrase = '"' + ' '.join(tokens) + '"'
+        phrases.append(phrase + '*' if prefix else phrase)
+    return ' AND '.join(phrases)
+
+
+def search_statement(query):
+    """検索語に一致する Question を関連度の高い順に返す SELECT 文を作ります。検索語が空なら None。"""
+    terms = query_terms(query)
+    if not terms:
+        return None
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        document = literal_column(DOCUMENT_SQL)
+        tsquery = func.to_tsquery('simple', _postgresql_query(terms))
+        return select(Question).join(QuestionSearch, QuestionSearch.question_id == Question.id) \
+                               .where(document.op('@@')(tsquery)) \
+                               .order_by(func.ts_rank(document, tsquery).desc(), Question.id.desc())
+    if dialect == 'sqlite':
+        fts = literal_column(FTS_TABLE)
+        return select(Question).join(_fts_table, _fts_table.c.rowid == Question.id) \
+                               .where(fts.op('MATCH')(_sqlite_query(terms))) \
+                               .order_by(func.bm25(fts, *FTS_WEIGHTS), Question.id.desc())
+    raise NotImplementedError(f'question search is not supported on {dialect}')
+
+
+def paginate_search(query, page=1, per_page=SEARCH_PER_PAGE):
+    """検索結果を関連度の高い順にページ分割して返します (items は Question)。検索語が空なら None。"""
+    statement = search_statement(query)
+    if statement is None:
+        return None
+    return db.paginate(statement, page=page, per_page=per_page, error_out=False)
+
+
+def search_question_ids(query, limit):
+    """検索結果の問題IDを、関連度の高い順に最大 limit 件返します。"""
+    statement = search_statement(query)
+    if statement is None:
+        return []
+    return db.session.execute(statement.with_only_columns(Question.id).limit(limit)).scalars().all()
+
+
+def highlight_terms(query):
+    """検索結果の強調表示に使う文字列のリストを返します (正規化した検索語の並び)。"""
+    return _runs((query or '')[:MAX_QUERY_LENGTH])
+
+
+def highlight(text, terms, width=None):
+    """text の中の検索語を <mark> で囲んだ HTML を返します。
+
+    width を指定すると、最初に一致した箇所の前後 width 文字程度だけを切り出す (一致しなければ先頭から)。
+    一致は大文字・小文字を区別しない (全角・半角の違いは強調されない)。
+    """
+    text = text or ''
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE) if terms else None
+    prefix = suffix = ''
+    if width and len(text) > width:
+        match = pattern.search(text) if pattern else None
+        start = max(0, match.start() - width // 4) if match else 0
+        end = min(len(text), start + width)
+        prefix = '…' if start > 0 else ''
+        suffix = '…' if end < len(text) else ''
+        text = text[start:end]
+    if pattern is None:
+        return escape(prefix + text + suffix)
+
+    parts = [escape(prefix)]
+    last = 0
+    for match in pattern.finditer(text):
+        parts.append(escape(text[last:match.start()]))
+        parts.append(Markup('<mark>%s</mark>') % match.group())
+        last = match.end()
+    parts.append(escape(text[last:] + suffix))
+    return Markup('').join(parts)
+
+
+@dataclass(frozen=True, slots=True)
+class SearchHit:
+    """検索結果の1件と、強調表示済みの問題文・選択肢・解説 (HTML)。"""
+    question: Question
+    question_html: Markup
+    options_html: Markup
+    explanation_html: Markup
+
+
+def highlight_hits(questions, query, width=SNIPPET_WIDTH):
+    terms = highlight_terms(query)
+    return [SearchHit(question,
+                      highlight(question.question_text, terms, width),
+                      highlight(_options_text(question.options), terms),
+                      highlight(question.explanation, terms, width))
+            for question in questions]
+
+
+def include_name(name, type_, parent_names):
+    """マイグレーションの自動生成で、FTS5 の仮想テーブルとその内部テーブル・式インデックスを無視します。"""
+    if type_ == 'table':
+        return not name.startswith(FTS_TABLE)
+    if type_ == 'index':
+        return name != 'ix_question_search_document'
+    return True
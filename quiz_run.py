@@ -0,0 +1,158 @@
+import bisect
+import random
+
+from flask import session
+
+from models import db, QuizRun
+
+# クイズの出題順と進捗のサーバーサイド保存
+# 出題する問題IDは連続した範囲 [[開始ID, 終了ID], ...] にまとめて保存し、出題順は乱数の seed から
+# 必要な位置の分だけ計算する (全問題IDの並べ替え済みリストは保存しない)。進捗はビットマップで持つため、
+# 全問題を選んだ場合でも1回の解答で更新するのは quiz_run の1行だけで、セッションは書き換えない。
+# 復習や検索結果のように呼び出し側が出題順を決める場合 (shuffle=False) は、その順番の問題IDのリストを
+# question_order に保存する (これらの問題数は REVIEW_BATCH_SIZE などで上限が決まっている)。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+SESSION_KEY = 'quiz_run_id'
+_MASK64 = (1 << 64) - 1
+_FEISTEL_ROUNDS = 4
+
+
+def _mix64(value):
+    # splitmix64 の混合関数
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+def permute(index, count, seed):
+    """0 〜 count-1 の index を、seed ごとに決まる並べ替え後の位置に写します。
+
+    Feistel 構造で 0 〜 4^k-1 上の全単射を作り、count 以上の値になった場合はもう一度写す
+    (cycle walking)。並べ替え全体を作らずに、1つの位置だけを O(1) で計算できる。
+    """
+    half_bits = max(1, ((count - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    round_keys = [_mix64(seed + round_no) for round_no in range(_FEISTEL_ROUNDS)]
+    value = index
+    while True:
+        left, right = value >> half_bits, value & mask
+        for round_key in round_keys:
+            left, right = right, left ^ (_mix64(round_key ^ right) & mask)
+        value = (left << half_bits) | right
+        if value < count:
+            return value
+
+
+def to_id_ranges(question_ids):
+    """問題IDのリストを、重複を除いて昇順の連続した範囲 [[開始ID, 終了ID], ...] にまとめます。"""
+    ranges = []
+    for question_id in sorted(set(question_ids)):
+        if ranges and ranges[-1][1] + 1 == question_id:
+            ranges[-1][1] = question_id
+        else:
+            ranges.append([question_id, question_id])
+    return ranges
+
+
+def _range_offsets(run):
+    # 各範囲の先頭の問題が、選択された問題全体の中で何番目か
+    offsets = []
+    total = 0
+    for start_id, end_id in run.id_ranges:
+        offsets.append(total)
+        total += end_id - start_id + 1
+    return offsets
+
+
+def _id_at_rank(run, rank):
+    offsets = _range_offsets(run)
+    range_no = bisect.bisect_right(offsets, rank) - 1
+    return run.id_ranges[range_no][0] + rank - offsets[range_no]
+
+
+def _rank_of(run, question_id):
+    offsets = _range_offsets(run)
+    starts = [start_id for start_id, _ in run.id_ranges]
+    range_no = bisect.bisect_right(starts, question_id) - 1
+    if range_no < 0 or question_id > run.id_ranges[range_no][1]:
+        return None
+    return offsets[range_no] + question_id - starts[range_no]
+
+
+def question_id_at(run, position):
+    """出題順で position 番目 (0始まり) の問題IDを返します。範囲外なら None。"""
+    if not 0 <= position < run.question_count:
+        return None
+    if run.question_order is not None:
+        return run.question_order[position]
+    return _id_at_rank(run, permute(position, run.question_count, run.seed))
+
+
+def contains(run, question_id):
+    """問題がクイズに含まれているかを返します。"""
+    return _rank_of(run, question_id) is not None
+
+
+def current_question_id(run):
+    return question_id_at(run, run.position)
+
+
+def start_run(user_id, question_ids, review_type=None, shuffle=True):
+    """新しいクイズを作成し、セッションに id を保存します。ユーザーの以前のクイズは削除します。
+
+    shuffle=False なら question_ids の順番 (重複は最初の位置) のまま出題する。
+    """
+    discard_run(user_id)
+    id_ranges = to_id_ranges(question_ids)
+    question_count = sum(end_id - start_id + 1 for start_id, end_id in id_ranges)
+    run = QuizRun(
+        user_id=user_id,
+        review_type=review_type,
+        id_ranges=id_ranges,
+        question_order=None if shuffle else list(dict.fromkeys(question_ids)),
+        question_count=question_count,
+        seed=random.getrandbits(63),
+        position=0,
+        answered=bytes((question_count + 7) // 8),
+        answered_count=0,
+        correct_count=0,
+    )
+    db.session.add(run)
+    db.session.flush()
+    session[SESSION_KEY] = run.id
+    return run
+
+
+def get_run(user_id):
+    """セッションに保存されたユーザーのクイズを返します。なければ None。"""
+    run_id = session.get(SESSION_KEY)
+    if run_id is None:
+        return None
+    run = db.session.get(QuizRun, run_id)
+    if run is None or run.user_id != user_id:
+        return None
+    return run
+
+
+def discard_run(user_id):
+    """ユーザーのクイズを削除し、セッションからも取り除きます。"""
+    QuizRun.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    session.pop(SESSION_KEY, None)
+
+
+def record_answer(run, question_id, is_correct):
+    """解答を進捗に記録します。同じ問題への2回目以降の解答と、クイズに含まれない問題は数えません。"""
+    rank = _rank_of(run, question_id)
+    if rank is None:
+        return
+    byte_no, bit = divmod(rank, 8)
+    answered = bytearray(run.answered)
+    if answered[byte_no] & (1 << bit):
+        return
+    answered[byte_no] |= 1 << bit
+    run.answered = bytes(answered)
+    run.answered_count += 1
+    if is_correct:
+        run.correct_count += 1
@@ -0,0 +1,206 @@
+import datetime
+import threading
+import time
+import zlib
+
+from flask_session import Session
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+from flask_session.defaults import Defaults
+from sqlalchemy import delete, select
+
+from db_utils import upsert
+from models import db, ServerSession
+
+# サーバーサイドセッションの保存先 (SESSION_BACKEND で切り替える)
+#   filesystem: 従来どおりファイルに保存する (1台のサーバーでしか共有できない)
+#   database:   server_session テーブルに保存する (複数ワーカー・複数ノードで共有できる)
+#   redis:      SESSION_REDIS_URL の Redis 互換サーバー (Redis / Valkey など) に保存する。redis パッケージが必要
+#   local:      Redis の代わりにプロセス内の LocalKeyValueStore に保存する (開発・動作確認用。ワーカー間では共有されない)
+# database / redis / local では msgpack でエンコードし、試験結果のような大きなセッションは zlib で圧縮する。
+
+SESSION_BACKENDS = ('filesystem', 'database', 'redis', 'local')
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+# 圧縮したデータの先頭に付ける印。セッションは必ず辞書なので、msgpack / JSON のデータが 0x00 で始まることはない
+_COMPRESSED = b'\x00'
+
+
+class CompactSerializer:
+    """Flask-Session の serializer (msgpack) の出力を、min_size バイト以上なら zlib で圧縮します。"""
+
+    def __init__(self, serializer, min_size=DEFAULT_COMPRESS_MIN_SIZE):
+        self.serializer = serializer
+        self.min_size = min_size
+
+    def encode(self, session):
+        data = self.serializer.encode(session)
+        if self.min_size and len(data) >= self.min_size:
+            compressed = zlib.compress(data)
+            if len(compressed) + 1 < len(data):
+                return _COMPRESSED + compressed
+        return data
+
+    def decode(self, data):
+        if data[:1] == _COMPRESSED:
+            data = zlib.decompress(data[1:])
+        return self.serializer.decode(data)
+
+
+class DatabaseSessionInterface(ServerSideSessionInterface):
+    """server_session テーブルにセッションを保存します。
+
+    リクエスト中の db.session とは別の接続で読み書きするので、セッションの保存が
+    アプリ側の変更をコミットしたりロールバックしたりすることはない。
+    期限切れの行は SESSION_CLEANUP_N_REQUESTS 回に1回程度の割合で削除する
+    (0 を指定した場合は `flask session_cleanup` を定期実行する)。
+    """
+    session_class = ServerSideSession
+    ttl = False
+
+    def __init__(self, app, compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, **options):
+        super().__init__(app, **options)
+        self.serializer = CompactSerializer(self.serializer, compress_min_size)
+
+    def _retrieve_session_data(self, store_id):
+        table = ServerSession.__table__
+        with db.engine.connect() as conn:
+            data = conn.execute(select(table.c.data).where(
+                table.c.session_id == store_id,
+                table.c.expiry > datetime.datetime.utcnow(),
+            )).scalar()
+        if data is None:
+            return None
+        return self.serializer.decode(data)
+
+    def _delete_session(self, store_id):
+        table = ServerSession.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.session_id == store_id))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        table = ServerSession.__table__
+        stmt = upsert(table, index_elements=['session_id'],
+                      set_=lambda excluded: {'data': excluded.data, 'expiry': excluded.expiry})
+        with db.engine.begin() as conn:
+            conn.execute(stmt, {
+                'session_id': store_id,
+                'data': self.serializer.encode(session),
+                'expiry': datetime.datetime.utcnow() + session_lifetime,
+            })
+
+    def _delete_expired_sessions(self):
+        table = ServerSession.__table__
+        with db.engine.begin() as conn:
+            result = conn.execute(delete(table).where(table.c.expiry <= datetime.datetime.utcnow()))
+        return result.rowcount
+
+
+class KeyValueSessionInterface(ServerSideSessionInterface):
+    """Redis 互換のキーバリューストアにセッションを保存します。
+
+    client には get(name) / set(name, value, ex=秒) / delete(name) を持つオブジェクト
+    (redis.Redis または LocalKeyValueStore) を渡す。期限切れのセッションはストアの TTL で消える。
+    """
+    session_class = ServerSideSession
+    ttl = True
+
+    def __init__(self, app, client, compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, **options):
+        self.client = client
+        super().__init__(app, **options)
+        self.serializer = CompactSerializer(self.serializer, compress_min_size)
+
+    def _retrieve_session_data(self, store_id):
+        data = self.client.get(store_id)
+        if data is None:
+            return None
+        return self.serializer.decode(data)
+
+    def _delete_session(self, store_id):
+        self.client.delete(store_id)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        self.client.set(store_id, self.serializer.encode(session),
+                        ex=max(1, int(session_lifetime.total_seconds())))
+
+
+class LocalKeyValueStore:
+    """redis.Redis の get / set / delete だけを真似た、プロセス内のキーバリューストア。
+
+    期限切れのキーは読み込み時と、SWEEP_INTERVAL 回の書き込みごとの一括削除で消える。
+    """
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # {key: (期限 (time.monotonic() の値、なければ None), value)}
+        self._writes = 0
+
+    def get(self, name):
+        entry = self._data.get(name)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            with self._lock:
+                if self._data.get(name) is entry:
+                    del self._data[name]
+            return None
+        return value
+
+    def set(self, name, value, ex=None):
+        expires_at = time.monotonic() + ex if ex else None
+        with self._lock:
+            self._data[name] = (expires_at, value)
+            self._writes += 1
+            if self._writes >= self.SWEEP_INTERVAL:
+                self._writes = 0
+                self._sweep()
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def _sweep(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._data.items()
+                    if expires_at is not None and expires_at <= now]:
+            del self._data[key]
+
+
+def _redis_client(url):
+    try:
+        import redis
+    except ImportError as e:
+        raise RuntimeError("SESSION_BACKEND=redis を使うには redis パッケージをインストールしてください。") from e
+    return redis.Redis.from_url(url)
+
+
+def init_session_store(app):
+    """SESSION_BACKEND の設定に従って、アプリのセッションの保存先を設定します。"""
+    backend = app.config.get('SESSION_BACKEND', 'filesystem').lower()
+    if backend not in SESSION_BACKENDS:
+        raise ValueError(f'Unknown SESSION_BACKEND: {backend}')
+
+    if backend == 'filesystem':
+        app.config['SESSION_TYPE'] = 'filesystem'
+        Session(app)
+        return
+
+    config = app.config
+    options = {
+        'key_prefix': config.get('SESSION_KEY_PREFIX', Defaults.SESSION_KEY_PREFIX),
+        'use_signer': config.get('SESSION_USE_SIGNER', Defaults.SESSION_USE_SIGNER),
+        'permanent': config.get('SESSION_PERMANENT', Defaults.SESSION_PERMANENT),
+        'sid_length': config.get('SESSION_ID_LENGTH', Defaults.SESSION_ID_LENGTH),
+        'serialization_format': config.get('SESSION_SERIALIZATION_FORMAT',
+                                           Defaults.SESSION_SERIALIZATION_FORMAT),
+        'compress_min_size': config.get('SESSION_COMPRESS_MIN_SIZE', DEFAULT_COMPRESS_MIN_SIZE),
+    }
+    if backend == 'database':
+        app.session_interface = DatabaseSessionInterface(
+            app, cleanup_n_requests=config.get('SESSION_CLEANUP_N_REQUESTS'), **options)
+    elif backend == 'redis':
+        app.session_interface = KeyValueSessionInterface(
+            app, _redis_client(config['SESSION_REDIS_URL']), **options)
+    else:
+        app.session_interface = KeyValueSessionInterface(app, LocalKeyValueStore(), **options)
@@ -0,0 +1,136 @@
+import datetime
+
+from sqlalchemy import func, tuple_
+
+from db_utils import upsert
+from models import db, UserAnswer, ReviewSchedule
+
+# 間隔反復 (SM-2 を正解・不正解の2段階に簡略化したもの) による復習の予定
+# ユーザー×問題ごとに1行の review_schedule を、解答のたびに更新する。
+#   - 正解: 期限が来ていれば間隔を 1日 → 6日 → 前回の間隔 × ease と伸ばす。期限前の正解では伸ばさない
+#     (同じ日に何度も解いて間隔だけが伸びないようにする)
+#   - 不正解: 続けて正解した回数を0に戻し、ease を下げ、RELEARN_MINUTES 分後にもう一度出題する
+# 「今日の復習」は (user_id, due_at) のインデックスで期限の来た問題を期限の古い順に選ぶだけなので、
+# 解答履歴の件数に関係なく、1回分 (REVIEW_BATCH_SIZE 問) を読む時間で作れる。
+# 以下の関数はいずれもコミットしないので、呼び出し側でコミットすること。
+
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+# 不正解のときに ease から引く値 (SM-2 で品質 1 の場合の値)
+EASE_PENALTY = 0.54
+FIRST_INTERVAL_DAYS = 1
+SECOND_INTERVAL_DAYS = 6
+MAX_INTERVAL_DAYS = 365
+RELEARN_MINUTES = 10
+REVIEW_BATCH_SIZE = 20
+_LOAD_CHUNK_SIZE = 500
+
+
+def next_state(state, is_correct, answered_at):
+    """解答1件の後の (repetitions, ease, interval_days, due_at) を返します。state は未解答なら None。"""
+    if state is None:
+        repetitions, ease, interval_days, due_at = 0, INITIAL_EASE, 0.0, answered_at
+    else:
+        repetitions, ease, interval_days, due_at = state
+
+    if not is_correct:
+        ease = max(MIN_EASE, ease - EASE_PENALTY)
+        return 0, ease, 0.0, answered_at + datetime.timedelta(minutes=RELEARN_MINUTES)
+
+    if repetitions and answered_at < due_at:
+        # 期限前に正解しても予定は変えない
+        return repetitions, ease, interval_days, due_at
+    repetitions += 1
+    if repetitions == 1:
+        interval_days = FIRST_INTERVAL_DAYS
+    elif repetitions == 2:
+        interval_days = SECOND_INTERVAL_DAYS
+    else:
+        interval_days = min(MAX_INTERVAL_DAYS, interval_days * ease)
+    return repetitions, ease, interval_days, answered_at + datetime.timedelta(days=interval_days)
+
+
+def _load_states(keys):
+    states = {}
+    keys = list(keys)
+    for offset in range(0, len(keys), _LOAD_CHUNK_SIZE):
+        chunk = keys[offset:offset + _LOAD_CHUNK_SIZE]
+        rows = db.session.query(ReviewSchedule.user_id, ReviewSchedule.question_id, ReviewSchedule.repetitions,
+                                ReviewSchedule.ease, ReviewSchedule.interval_days, ReviewSchedule.due_at) \
+                         .filter(tuple_(ReviewSchedule.user_id, ReviewSchedule.question_id).in_(chunk))
+        for user_id, question_id, *state in rows:
+            states[(user_id, question_id)] = tuple(state)
+    return states
+
+
+def _save_states(states, answered_at_by_key):
+    table = ReviewSchedule.__table__
+    db.session.execute(upsert(
+        table,
+        index_elements=['user_id', 'question_id'],
+        set_=lambda excluded: {name: getattr(excluded, name) for name in
+                               ('repetitions', 'ease', 'interval_days', 'due_at', 'last_answered_at')},
+    ), [{'user_id': user_id, 'question_id': question_id, 'repetitions': repetitions, 'ease': ease,
+         'interval_days': interval_days, 'due_at': due_at, 'last_answered_at': answered_at_by_key[(user_id, question_id)]}
+        for (user_id, question_id), (repetitions, ease, interval_days, due_at) in states.items()])
+
+
+def record_answers(answers):
+    """解答 [(user_id, question_id, is_correct, answered_at), ...] を解答した順に反映します。
+
+    対象の予定を IN クエリでまとめて読み込み、更新後の予定を upsert 1回 (executemany) で保存する。
+    """
+    answers = list(answers)
+    if not answers:
+        return
+    states = _load_states({(user_id, question_id) for user_id, question_id, _, _ in answers})
+    answered_at_by_key = {}
+    for user_id, question_id, is_correct, answered_at in answers:
+        key = (user_id, question_id)
+        states[key] = next_state(states.get(key), is_correct, answered_at)
+        answered_at_by_key[key] = answered_at
+    _save_states({key: states[key] for key in answered_at_by_key}, answered_at_by_key)
+
+
+def due_question_ids(user_id, now=None, limit=REVIEW_BATCH_SIZE):
+    """期限の来た問題のIDを、期限の古い順に最大 limit 件返します。"""
+    now = now or datetime.datetime.utcnow()
+    return [question_id for (question_id,) in
+            db.session.query(ReviewSchedule.question_id)
+            .filter(ReviewSchedule.user_id == user_id, ReviewSchedule.due_at <= now)
+            .order_by(ReviewSchedule.due_at, ReviewSchedule.question_id)
+            .limit(limit)]
+
+
+def count_due(user_id, now=None):
+    """期限の来た問題の数と、まだ期限の来ていない次の予定の日時を返します。"""
+    now = now or datetime.datetime.utcnow()
+    due_count = db.session.query(func.count()).select_from(ReviewSchedule) \
+                          .filter(ReviewSchedule.user_id == user_id, ReviewSchedule.due_at <= now).scalar()
+    next_due_at = db.session.query(func.min(ReviewSchedule.due_at)) \
+                            .filter(ReviewSchedule.user_id == user_id, ReviewSchedule.due_at > now).scalar()
+    return due_count, next_due_at
+
+
+def reset_user(user_id):
+    ReviewSchedule.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def reset_all():
+    ReviewSchedule.query.delete(synchronize_session=False)
+
+
+def rebuild_review_schedule(batch_size=10000):
+    """user_answer の全履歴を解答した順に再生して、復習の予定を作り直します (導入時・復旧用)。"""
+    reset_all()
+    last_id = 0
+    while True:
+        rows = db.session.query(UserAnswer.id, UserAnswer.user_id, UserAnswer.question_id,
+                                UserAnswer.is_correct, UserAnswer.timestamp) \
+                         .filter(UserAnswer.id > last_id) \
+                         .order_by(UserAnswer.id).limit(batch_size).all()
+        if not rows:
+            return
+        # 前のバッチで保存した予定は record_answers() が読み込み、その続きから反映する
+        record_answers((row.user_id, row.question_id, row.is_correct, row.timestamp) for row in rows)
+        last_id = rows[-1].id
@@ -0,0 +1,145 @@
+import dataclasses
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, has_request_context, session
+from sqlalchemy import func
+
+from keyset_pagination import paginate_keyset
+from models import db, UserCheck
+from question_cache import QuestionRecord
+
+# ユーザーごとのチェック状態のプロセス内キャッシュ
+# ユーザーがチェックしている問題を1回のクエリでまとめて読み込み、{問題ID: チェックの種類の集合} として
+# 保持する。問題ページの表示では、キャッシュがあればチェック状態のためのクエリを発行しない。
+# チェックを切り替えたら set_check() でキャッシュを更新し、セッションの版番号を進める。他のワーカー
+# プロセスは版番号が合わないキャッシュを読み込み直す。別の端末での変更は CHECK_CACHE_TTL 秒で反映される。
+
+CHECK_TYPES = ('type1', 'type2', 'type3')
+CHECK_TYPE_NAMES = {'type1': '重要（緑）', 'type2': '苦手（オレンジ）', 'type3': '後で（ピンク）'}
+CHECKED_PAGE_SIZE = 20
+SESSION_KEY = 'check_version'
+MAX_CACHED_USERS = 1000
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # {user_id: (version, built_at, {question_id: frozenset(check_types)})}
+
+
+def _session_version():
+    return session.get(SESSION_KEY, 0) if has_request_context() else 0
+
+
+def _cache_ttl():
+    return current_app.config.get('CHECK_CACHE_TTL', 60)
+
+
+def _load(user_id):
+    checks = {}
+    rows = db.session.query(UserCheck.question_id, UserCheck.check_type) \
+                     .filter(UserCheck.user_id == user_id, UserCheck.is_checked == True)
+    for question_id, check_type in rows:
+        checks.setdefault(question_id, set()).add(check_type)
+    return {question_id: frozenset(types) for question_id, types in checks.items()}
+
+
+def get_user_checks(user_id):
+    """ユーザーのチェック状態を {問題ID: チェックの種類の集合} で返します (チェックのない問題は含まない)。"""
+    version = _session_version()
+    ttl = _cache_ttl()
+    with _lock:
+        entry = _cache.get(user_id)
+        if entry is not None:
+            cached_version, built_at, checks = entry
+            if cached_version == version and (not ttl or time.monotonic() - built_at < ttl):
+                _cache.move_to_end(user_id)
+                return checks
+
+    checks = _load(user_id)
+    with _lock:
+        _cache[user_id] = (version, time.monotonic(), checks)
+        _cache.move_to_end(user_id)
+        while len(_cache) > MAX_CACHED_USERS:
+            _cache.popitem(last=False)
+    return checks
+
+
+def status_of(check_types):
+    return {check_type: check_type in check_types for check_type in CHECK_TYPES}
+
+
+def get_check_status(user_id, question_id):
+    """問題のチェック状態を {'type1': bool, 'type2': bool, 'type3': bool} で返します。"""
+    return status_of(get_user_checks(user_id).get(question_id, frozenset()))
+
+
+def set_check(user_id, question_id, check_type, checked):
+    """チェックの切り替えをキャッシュに反映します。DBへの保存とコミットの後に呼ぶこと。"""
+    previous_version = _session_version()
+    version = previous_version + 1
+    if has_request_context():
+        session[SESSION_KEY] = version
+    with _lock:
+        entry = _cache.get(user_id)
+        if entry is None:
+            return
+        cached_version, built_at, checks = entry
+        if cached_version != previous_version:
+            # 他のプロセスでの変更を反映していない古いキャッシュは、更新せずに破棄する
+            del _cache[user_id]
+            return
+        checks = dict(checks)
+        types = set(checks.get(question_id, ()))
+        if checked:
+            types.add(check_type)
+        else:
+            types.discard(check_type)
+        if types:
+            checks[question_id] = frozenset(types)
+        else:
+            checks.pop(question_id, None)
+        _cache[user_id] = (version, built_at, checks)
+
+
+def invalidate_user_checks(user_id=None):
+    """キャッシュを破棄します。user_id を省略すると全ユーザー分を破棄します。
+
+    user_id を指定するのはログイン中のユーザー自身の変更の場合で、セッションの版番号も進める。
+    """
+    if user_id is not None and has_request_context():
+        session[SESSION_KEY] = _session_version() + 1
+    with _lock:
+        if user_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(user_id, None)
+
+
+def count_by_type(user_id):
+    """チェックの種類ごとの問題数を {check_type: 件数} で返します (GROUP BY 1回)。"""
+    counts = dict(db.session.query(UserCheck.check_type, func.count(UserCheck.id))
+                  .filter(UserCheck.user_id == user_id, UserCheck.is_checked == True)
+                  .group_by(UserCheck.check_type))
+    return {check_type: counts.get(check_type, 0) for check_type in CHECK_TYPES}
+
+
+def checked_questions_page(user_id, check_type, cursor=None, per_page=CHECKED_PAGE_SIZE):
+    """チェックした問題を新しい順に1ページ分、KeysetPage で返します (items は表示用の dict)。
+
+    OFFSET を使わず、前のページの最後のチェック (日時, id) より古いものを読む (キーセット方式) ので、
+    チェックが何千件あってもどのページも同じ速さで返せる。
+    """
+    query = UserCheck.query \
+        .filter(UserCheck.user_id == user_id, UserCheck.check_type == check_type, UserCheck.is_checked == True) \
+        .options(db.joinedload(UserCheck.question_detail, innerjoin=True))
+    page = paginate_keyset(query, [UserCheck.timestamp, UserCheck.id], cursor, per_page)
+
+    items = []
+    for check in page.items:
+        question = QuestionRecord.from_row(check.question_detail)
+        items.append({
+            'question': question,
+            'correct_answer_display': question.correct_answer_display,
+            'check_type': check.check_type,
+        })
+    return dataclasses.replace(page, items=items)
@@ -0,0 +1,149 @@
+from sqlalchemy import case, func, select, text, update
+
+from db_utils import upsert
+from models import db, UserAnswer, UserStats, UserQuestionStats
+
+# ユーザーごと・ユーザー×問題ごとの解答集計
+# UserAnswer を追加・削除する処理と同じトランザクションで更新し、マイページでは
+# 解答履歴を全件読み込まずにこの集計だけを参照する。
+# 以下の関数はいずれもコミットしないので、呼び出し側でまとめてコミットすること。
+
+
+def record_answer(user_id, question_id, is_correct, answered_at):
+    """解答1件分を集計に加算します。"""
+    record_answers([(user_id, question_id, is_correct, answered_at)])
+
+
+def record_answers(answers):
+    """解答 [(user_id, question_id, is_correct, answered_at), ...] をまとめて集計に加算します。
+
+    ユーザーごと・ユーザー×問題ごとに件数をまとめてから、それぞれ upsert 1回 (executemany) で加算する。
+    answers は解答した順に渡すこと (最新の解答結果は最後の解答から取る)。
+    """
+    users = {}
+    questions = {}
+    for user_id, question_id, is_correct, answered_at in answers:
+        correct = 1 if is_correct else 0
+        user_row = users.setdefault(user_id, {'user_id': user_id, 'total_answered': 0, 'correct_answered': 0})
+        user_row['total_answered'] += 1
+        user_row['correct_answered'] += correct
+        user_row['last_answered_at'] = answered_at
+        question_row = questions.setdefault((user_id, question_id), {
+            'user_id': user_id, 'question_id': question_id, 'answer_count': 0, 'correct_count': 0})
+        question_row['answer_count'] += 1
+        question_row['correct_count'] += correct
+        question_row['last_answered_at'] = answered_at
+        question_row['last_is_correct'] = bool(is_correct)
+    if not users:
+        return
+
+    user_table = UserStats.__table__
+    db.session.execute(upsert(
+        user_table,
+        index_elements=['user_id'],
+        set_=lambda excluded: {
+            'total_answered': user_table.c.total_answered + excluded.total_answered,
+            'correct_answered': user_table.c.correct_answered + excluded.correct_answered,
+            'last_answered_at': excluded.last_answered_at,
+        },
+    ), list(users.values()))
+
+    question_table = UserQuestionStats.__table__
+    db.session.execute(upsert(
+        question_table,
+        index_elements=['user_id', 'question_id'],
+        set_=lambda excluded: {
+            'answer_count': question_table.c.answer_count + excluded.answer_count,
+            'correct_count': question_table.c.correct_count + excluded.correct_count,
+            'last_answered_at': excluded.last_answered_at,
+            'last_is_correct': excluded.last_is_correct,
+        },
+    ), list(questions.values()))
+
+
+def forget_answers(user_id, question_id, removed_count, removed_correct=0):
+    """解答履歴から削除した件数を集計から差し引きます (間違えた問題の復習で正解した場合など)。"""
+    if not removed_count:
+        return
+    UserStats.query.filter_by(user_id=user_id).update({
+        UserStats.total_answered: UserStats.total_answered - removed_count,
+        UserStats.correct_answered: UserStats.correct_answered - removed_correct,
+    }, synchronize_session=False)
+    UserQuestionStats.query.filter_by(user_id=user_id, question_id=question_id).update({
+        UserQuestionStats.answer_count: UserQuestionStats.answer_count - removed_count,
+        UserQuestionStats.correct_count: UserQuestionStats.correct_count - removed_correct,
+    }, synchronize_session=False)
+
+
+def forget_question(question_id):
+    """問題の削除に合わせて、その問題の解答数を各ユーザーの集計から差し引きます。
+
+    解答したユーザーの数によらず、UPDATE 1本で差し引く (user_question_stats にユーザーごとの件数がある)。
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # UPDATE user_stats ... FROM user_question_stats
+        statement = update(UserStats).where(
+            UserQuestionStats.user_id == UserStats.user_id,
+            UserQuestionStats.question_id == question_id,
+        ).values(
+            total_answered=UserStats.total_answered - UserQuestionStats.answer_count,
+            correct_answered=UserStats.correct_answered - UserQuestionStats.correct_count,
+        )
+    else:
+        # UPDATE ... FROM のない DB (古い SQLite など) では、相関サブクエリで同じ行を参照する
+        def question_stats(column):
+            return select(column).where(UserQuestionStats.user_id == UserStats.user_id,
+                                        UserQuestionStats.question_id == question_id).scalar_subquery()
+
+        statement = update(UserStats).where(
+            UserStats.user_id.in_(select(UserQuestionStats.user_id).where(UserQuestionStats.question_id == question_id)),
+        ).values(
+            total_answered=UserStats.total_answered - question_stats(UserQuestionStats.answer_count),
+            correct_answered=UserStats.correct_answered - question_stats(UserQuestionStats.correct_count),
+        )
+    db.session.execute(statement, execution_options={'synchronize_session': False})
+    UserQuestionStats.query.filter_by(question_id=question_id).delete(synchronize_session=False)
+
+
+def reset_user_stats(user_id):
+    UserQuestionStats.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    UserStats.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+
+def reset_all_stats():
+    UserQuestionStats.query.delete(synchronize_session=False)
+    UserStats.query.delete(synchronize_session=False)
+
+
+def get_user_summary(user_id):
+    """(総解答数, 総正解数) を返します。"""
+    stats = db.session.get(UserStats, user_id)
+    if stats is None:
+        return 0, 0
+    return stats.total_answered, stats.correct_answered
+
+
+def rebuild_user_stats():
+    """user_answer の全履歴から集計を作り直します (集計が壊れた場合の復旧用)。"""
+    reset_all_stats()
+    correct = func.sum(case((UserAnswer.is_correct, 1), else_=0))
+
+    user_rows = db.session.query(
+        UserAnswer.user_id, func.count(UserAnswer.id), correct, func.max(UserAnswer.timestamp)
+    ).group_by(UserAnswer.user_id)
+    db.session.execute(UserStats.__table__.insert().from_select(
+        ['user_id', 'total_answered', 'correct_answered', 'last_answered_at'], user_rows))
+
+    # 問題ごとの最新の解答結果は、timestamp (同時刻なら id) が最大の行から取る
+    db.session.execute(text("""
+        INSERT INTO user_question_stats
+            (user_id, question_id, answer_count, correct_count, last_answered_at, last_is_correct)
+        SELECT ua.user_id, ua.question_id, COUNT(*),
+               SUM(CASE WHEN ua.is_correct THEN 1 ELSE 0 END),
+               MAX(ua.timestamp),
+               (SELECT latest.is_correct FROM user_answer latest
+                 WHERE latest.user_id = ua.user_id AND latest.question_id = ua.question_id
+                 ORDER BY latest.timestamp DESC, latest.id DESC LIMIT 1)
+        FROM user_answer ua
+        GROUP BY ua.user_id, ua.question_id
+    """))